@@ -3,7 +3,7 @@
 # Copyright (C) 2015-2016 University of Central Florida. All rights reserved.
 # BART is under an open-source, reproducible-research license (see LICENSE).
 
-import sys, os, re, shutil, time, subprocess
+import sys, os, re, time, glob, subprocess
 import argparse, ConfigParser
 import numpy as np
 
@@ -15,14 +15,17 @@ Transitdir = BARTdir + "/modules/transit/"
 
 # Add path to submodules and import:
 sys.path.append(BARTdir + "/code")
-import makeP     as mp
-import InitialPT as ipt
 import        PT as  pt
 import makeatm   as mat
 import makecfg   as mc
+import pipeline  as pl
 import bestFit   as bf
 import cf        as cf
 import mcplots   as mcp
+import staging   as stg
+import atmio     as aio
+import timer     as t
+import cache
 
 sys.path.append(MC3dir)
 import MCcubed.utils as mu
@@ -73,6 +76,17 @@ def main():
   group.add_argument("--logfile", dest="logfile",
            help="MCMC log file [default: %(default)s]",
            type=str, action="store", default="MCMC.log")
+  group.add_argument("--stage_cache", dest="stage_cache",
+           help="If True, reuse the outputs of the setup stages (pressure, "
+                "abundances, pre-atmospheric, TEA, atmospheric, and opacity "
+                "files) from the BART cache when their inputs did not change "
+                "[default: %(default)s]",
+           type=eval, action="store", default=False)
+  group.add_argument("--file_cache", dest="file_cache",
+           help="If True, keep the parsed Kurucz models, the resampled "
+                "filters, and the checksums of large input files in the "
+                "BART cache for later runs [default: %(default)s]",
+           type=eval, action="store", default=True)
   # Pressure layers options:
   group = parser.add_argument_group("Layers pressure sampling")
   group.add_argument("--n_layers", dest="n_layers",
@@ -136,6 +150,10 @@ def main():
   group.add_argument("--atmfile", dest="atmfile",
            help="Atmospheric model file [default: %(default)s]",
            type=str, action="store", default="")
+  group.add_argument("--tea_workers", dest="tea_workers",
+           help="Number of concurrent TEA processes, each one on a chunk "
+                "of layers [default: %(default)s]",
+           type=int, action="store", default=1)
   group.add_argument("--uniform", dest="uniform",
            help="If not None, set uniform abundances with the specified "
                 "values for each species in out_spec [default: %(default)s]",
@@ -168,6 +186,32 @@ def main():
   group.add_argument("--nchains",  dest="nchains", 
            help="Number of parallel chains for MCMC", 
            type=int,       action="store", default=10)
+  group.add_argument("--nbatch",  dest="nbatch",
+           help="Number of parameter sets evaluated by each worker per "
+                "MPI exchange [default: %(default)s]",
+           type=int,       action="store", default=1)
+  group.add_argument("--timing",  dest="timing",
+           help="If True, save per-stage timing histograms of the forward "
+                "model into loc_dir [default: %(default)s]",
+           type=eval,      action="store", default=False)
+  group.add_argument("--timing_interval",  dest="timing_interval",
+           help="Number of iterations between dumps of the timing "
+                "histograms [default: %(default)s]",
+           type=int,       action="store", default=1000)
+  group.add_argument("--emulator", dest="emulator",
+           help="If True, run the emulator-accelerated (delayed-acceptance) "
+                "MCMC on local processes (without MPI) instead of MC3 "
+                "[default: %(default)s]",
+           type=eval,      action="store", default=False)
+  group.add_argument("--ntrain",   dest="ntrain",
+           help="Maximum number of burn-in models to train the emulator "
+                "[default: %(default)s]",
+           type=int,       action="store", default=1000)
+  group.add_argument("--nworkers", dest="nworkers",
+           help="Number of local forward-model processes for the emulator "
+                "MCMC, only used with --emulator (MC3 runs its workers with "
+                "mpiexec) [default: number of CPUs]",
+           type=int,       action="store", default=None)
   group.add_argument("--stepsize", dest="stepsize",
            help="Parameters stepsize",
            type=mu.parray, action="store", default=None)
@@ -199,6 +243,11 @@ def main():
   group.add_argument("--kurucz_file",           action="store",
            help="Stellar Kurucz file [default: %(default)s]",
            dest="kurucz",   type=str,       default=None)
+  group.add_argument("--kurucz_interp",         action="store",
+           help="If True, interpolate the Kurucz models at the stellar "
+                "temperature and log(g) instead of taking the nearest model "
+                "[default: %(default)s]",
+           dest="kurucz_interp", type=eval,  default=False)
   group.add_argument("--solution",                    action="store",
            help="Solution geometry [default: %(default)s]",
            dest="solution", type=str,       default="None",
@@ -215,6 +264,10 @@ def main():
   group.add_argument("--outspec", dest="outspec",
            help="Output spectrum filename [default: %(default)s]",
            type=str, action="store", default="outspec.dat")
+  group.add_argument("--opacity_store", dest="opacity_store",
+           help="Directory of the opacity tables shared across runs "
+                "[default: the BART cache with stage_cache, else none]",
+           type=str, action="store", default=None)
   group.add_argument("--shareOpacity", dest="shareOpacity",
            help="If True, use shared memory for the Transit opacity file "
                 "[default: %(default)s]",
@@ -283,6 +336,17 @@ def main():
     print('Please correct this and run again.')
     sys.exit()
 
+  # Caches of the Kurucz models, filters, and file digests:
+  cache.enable(file_cache)
+
+  # Check that the chains can be evenly distributed in batches:
+  if nbatch < 1 or nchains % nbatch != 0:
+    mu.error("The number of chains ({:d}) must be a multiple of nbatch "
+             "({:d}).".format(nchains, nbatch))
+  if tea_workers < 1:
+    mu.error("The number of TEA workers (tea_workers={:d}) must be at "
+             "least 1.".format(tea_workers))
+
   # Make output directory:
   # Make a subdirectory with the date and time
   dirfmt = loc_dir + "%4d-%02d-%02d_%02d:%02d:%02d"
@@ -300,14 +364,19 @@ def main():
     else:
       mu.error("Cannot create folder '{:s}'. {:s}.".format(date_dir,
                                                      os.strerror(e.errno)))
-  # Copy files to date dir:
+  # Stage files into date dir (see staging.py), the strategy and size
+  # of each file are recorded in the manifest:
+  manifest = date_dir + "staged_files.txt"
+  # The manifest lists the files staged by this run:
+  if os.path.isfile(manifest):
+    os.remove(manifest)
   # BART configuration file:
-  shutil.copy2(cfile, date_dir)
+  stg.stage(cfile, date_dir + os.path.basename(cfile), manifest)
   # TEP file:
   if not os.path.isfile(tep_name):
     mu.error("Tepfile ('{:s}') Not found.".format(tep_name))
   else:
-    shutil.copy2(tep_name, date_dir + os.path.basename(tep_name))
+    stg.stage(tep_name, date_dir + os.path.basename(tep_name), manifest)
 
   # Check if files already exist:
   runMCMC = 0  # Flag that indicate which steps to run
@@ -317,84 +386,123 @@ def main():
   # Atmospheric file:
   if os.path.isfile(atmfile):
     atmfile = os.path.realpath(atmfile)
-    shutil.copy2(atmfile, date_dir + os.path.basename(atmfile))
-    mu.msg(1, "Atmospheric file copied from: '{:s}'.".format(atmfile),indent=2)
+    stg.stage(atmfile, date_dir + os.path.basename(atmfile), manifest,
+              writable=True)
+    # A container left by a previous run does not describe this file:
+    npzfile = aio.container(date_dir + os.path.basename(atmfile))
+    if npzfile != atmfile and os.path.isfile(npzfile):
+      os.remove(npzfile)
+    mu.msg(1, "Atmospheric file staged from: '{:s}'.".format(atmfile),indent=2)
     runMCMC |= 8
   # Pre-atmospheric file:
   if os.path.isfile(preatm_file):
     preatm_file = os.path.realpath(preatm_file)
-    shutil.copy2(preatm_file, date_dir + os.path.basename(preatm_file))
-    mu.msg(1, "Pre-atmospheric file copied from: '{:s}'.".format(preatm_file),
+    stg.stage(preatm_file, date_dir + os.path.basename(preatm_file),
+              manifest, writable=True)
+    mu.msg(1, "Pre-atmospheric file staged from: '{:s}'.".format(preatm_file),
            indent=2)
     runMCMC |= 4
   # Elemental-abundances file:
   if abun_file is not None and os.path.isfile(abun_file):
-    shutil.copy2(abun_file, date_dir + os.path.basename(abun_file))
-    mu.msg(1, "Elemental abundances file copied from: '{:s}'.".
+    stg.stage(abun_file, date_dir + os.path.basename(abun_file), manifest,
+              writable=True)
+    mu.msg(1, "Elemental abundances file staged from: '{:s}'.".
               format(abun_file), indent=2)
     runMCMC |= 2
   # Pressure file:
   if press_file is not None and os.path.isfile(press_file):
-    shutil.copy2(press_file, date_dir + os.path.basename(press_file))
-    mu.msg(1, "Pressure file copied from: '{:s}'.".format(press_file), indent=2)
+    stg.stage(press_file, date_dir + os.path.basename(press_file), manifest,
+              writable=True)
+    mu.msg(1, "Pressure file staged from: '{:s}'.".format(press_file), indent=2)
     runMCMC |= 1
 
+  # The atmospheric-setup stages pass their arrays in memory:
+  pipe = pl.Pipeline(date_dir, tep_name, stage_cache=stage_cache,
+                     opacity_store=opacity_store)
+
+  # With the stage cache, files left by a previous run are not reused
+  # as they are, but regenerated (or restored) from their current inputs:
+  for flag, filename in [(1, press_file), (2, abun_file),
+                         (4, preatm_file), (8, atmfile)]:
+    if runMCMC & flag and pipe.generated(filename):
+      mu.msg(1, "File '{:s}' was made by a previous run, check it against "
+                "the stage cache.".format(filename), indent=2)
+      runMCMC &= ~flag
+  # The atmospheric file in the run directory:
+  atmfile = date_dir + os.path.basename(atmfile)
 
   # Generate files as needed:
   if runMCMC < 1:  # Pressure file
-    press_file = date_dir + press_file
-    mp.makeP(n_layers, p_top, p_bottom, press_file, log)
-    mu.msg(1, "Created new pressure file.", indent=2)
+    press_file = date_dir + os.path.basename(press_file)
+    if pipe.make_pressure(n_layers, p_top, p_bottom, press_file, log):
+      mu.msg(1, "Pressure file restored from the stage cache.", indent=2)
+    else:
+      mu.msg(1, "Created new pressure file.", indent=2)
+  elif runMCMC < 8:
+    pipe.read_pressure(press_file)
 
   # Make uniform-abundance profiles if requested:
   if uniform is not None and runMCMC < 8:
     # Calculate the temperature profile:
-    temp = ipt.initialPT2(date_dir, PTinit,         press_file, 
-                          PTtype,   PTfunc[PTtype], tep_name)
+    temp = pipe.temperature_profile(PTinit, PTtype, PTfunc[PTtype])
     # Generate the uniform-abundance profiles file:
-    mat.uniform(date_dir+atmfile, press_file, abun_basic, tep_name,
-               out_spec, uniform, temp, refpress)
+    if pipe.uniform(atmfile, abun_basic, out_spec, uniform,
+                    refpress):
+      mu.msg(1, "Atmospheric file restored from the stage cache.", indent=2)
     # Update the runMCMC flag to skip upcoming steps:
     runMCMC |= 8
 
   if runMCMC < 2:  # Elemental-abundances file
-    abun_file = date_dir + abun_file
+    abun_file = date_dir + os.path.basename(abun_file)
     mu.msg(1, "CO swap: {}".format(COswap), indent=2)
-    mat.makeAbun(abun_basic, abun_file, solar_times, COswap)
-    mu.msg(1, "Created new elemental abundances file.", indent=2)
+    if pipe.make_abun(abun_basic, abun_file, solar_times, COswap):
+      mu.msg(1, "Elemental abundances file restored from the stage cache.",
+             indent=2)
+    else:
+      mu.msg(1, "Created new elemental abundances file.", indent=2)
 
   if runMCMC < 4:  # Pre-atmospheric file
     # Calculate the temperature profile:
-    temp = ipt.initialPT2(date_dir, PTinit,         press_file, 
-                          PTtype,   PTfunc[PTtype], tep_name)
+    temp = pipe.temperature_profile(PTinit, PTtype, PTfunc[PTtype])
     # Choose a pressure-temperature profile
     mu.msg(1, "\nChoose temperature and pressure profile:", indent=2)
     raw_input("  open Initial PT profile figure and\n" 
               "  press enter to continue or quit and choose other initial "
               "PT parameters.")
-    preatm_file = date_dir + preatm_file
-    mat.make_preatm(tep_name, press_file, abun_file, in_elem, out_spec,
-                  preatm_file, temp)
-    mu.msg(1, "Created new pre-atmospheric file.", indent=2)
+    preatm_file = date_dir + os.path.basename(preatm_file)
+    if pipe.preatm(abun_file, in_elem, out_spec, preatm_file):
+      mu.msg(1, "Pre-atmospheric file restored from the stage cache.",
+             indent=2)
+    else:
+      mu.msg(1, "Created new pre-atmospheric file.", indent=2)
 
   if runMCMC < 8:  # Atmospheric file
     # Generate the TEA configuration file:
     mc.makeTEA(cfile, TEAdir)
-    # Call TEA to calculate the atmospheric file:
-    TEAcall = TEAdir + "tea/runatm.py"
-    TEAout  = os.path.splitext(atmfile)[0]  # Remove extension
-    # Execute TEA:
+    # Execute TEA to calculate the atmospheric file:
     mu.msg(1, "\nExecute TEA:")
-    proc = subprocess.Popen([TEAcall, preatm_file, 'TEA'])
-    proc.communicate()
-
-    shutil.copy2(date_dir+"TEA/results/TEA.tea", date_dir+atmfile) 
-    # Add radius array:
-    mat.makeRadius(out_spec, date_dir+atmfile, abun_file, tep_name, refpress)
-    mu.msg(1, "Added radius column to TEA atmospheric file.", indent=2)
-    # Re-format file for use with transit:
-    mat.reformat(atmfile)
-    mu.msg(1, "Atmospheric file reformatted for Transit.", indent=2)
+    maxiter = "100"
+    if config.has_option("MCMC", "maxiter"):
+      maxiter = config.get("MCMC", "maxiter")
+    teafile = date_dir + "TEA/results/TEA.tea"
+    try:
+      if pipe.run_tea(TEAdir, preatm_file, teafile, abun_basic, maxiter,
+                      tea_workers):
+        mu.msg(1, "TEA output restored from the stage cache.", indent=2)
+      elif pipe.tea_hits is not None:
+        hits, nlayers = pipe.tea_hits
+        mu.msg(1, "TEA layer cache: reused {:d} of {:d} layers ({:.1f}% hit "
+                  "rate).".format(hits, nlayers, 100.0*hits/nlayers), indent=2)
+    except ValueError as e:
+      mu.error(str(e))
+
+    # Add radius array and re-format for use with transit:
+    if pipe.tea_atmosphere(teafile, atmfile, out_spec, abun_file,
+                           refpress):
+      mu.msg(1, "Atmospheric file restored from the stage cache.", indent=2)
+    else:
+      mu.msg(1, "Added radius column to TEA atmospheric file.", indent=2)
+      mu.msg(1, "Atmospheric file reformatted for Transit.", indent=2)
 
   if justTEA:
     mu.msg(1, "~~ BART End (after TEA) ~~")
@@ -403,31 +511,57 @@ def main():
   # Make the MC3 configuration file:
   if runMCMC < 16: # MCMC
     MCMC_cfile = os.path.realpath(loc_dir) + "/MCMC_" + os.path.basename(cfile)
-    mc.makeMCMC(cfile, MCMC_cfile, logfile)
+    mc.makeMCMC(cfile, MCMC_cfile, logfile, nchains, nbatch)
     # Make transit configuration file:
     mc.makeTransit(MCMC_cfile, tep_name, shareOpacity)
 
-    # Generate the opacity file if it doesn't exist:
-    if not os.path.isfile(opacityfile):
-      mu.msg(1, "Transit call to generate the Opacity grid table.")
+    # Generate the opacity file if it doesn't exist (or if it comes from
+    # the opacity store, check it against the current inputs):
+    if not os.path.isfile(opacityfile) or pipe.in_store(opacityfile):
       Tcall = Transitdir + "/transit/transit"
-      subprocess.call(["{:s} -c {:s} --justOpacity".format(Tcall, tconfig)],
-                      shell=True, cwd=date_dir)
+      if pipe.opacity(Tcall, date_dir + os.path.basename(tconfig),
+                      date_dir + os.path.basename(opacityfile)):
+        mu.msg(1, "Linked the Opacity grid table from the opacity store: "
+                  "'{:s}'.".format(pipe.opacity_store), indent=2)
+      else:
+        mu.msg(1, "Transit generated the Opacity grid table.", indent=2)
     else:
-      mu.msg(1, "\nTransit copies the existing opacity file from:\n '{:s}'.".
-                   format(opacityfile), indent=2)
-      shutil.copy2(opacityfile, date_dir + os.path.basename(opacityfile))
+      strategy = stg.stage(opacityfile,
+                           date_dir + os.path.basename(opacityfile), manifest)
+      mu.msg(1, "\nTransit uses the existing opacity file ({:s}) from:\n"
+                " '{:s}'.".format(strategy, opacityfile), indent=2)
 
   if justOpacity:
     mu.msg(1, "~~ BART End (after Transit opacity calculation) ~~")
     return
 
 
-  # Run the MCMC:
+  # Check that no linked input changed since it was staged:
   if runMCMC < 16:
+    changed = stg.verify(manifest)
+    if len(changed) > 0:
+      mu.error("These staged input files changed during the run (their "
+               "source was modified): {:s}.".format(", ".join(changed)))
+
+  # Run the MCMC:
+  if runMCMC < 16 and emulator:
+    mu.msg(1, "\nRun the emulator-accelerated MCMC.")
+    # Imported here since it loads the compiled transit module:
+    import emulator as em
+    em.run(MCMC_cfile, nworkers, nbatch, ntrain)
+  elif runMCMC < 16:
+    # Remove the timing files of previous runs in this folder:
+    tfiles = date_dir + "timing_rank*.npz"
+    if timing:
+      for tfile in glob.glob(tfiles):
+        os.remove(tfile)
     MC3call = MC3dir + "/MCcubed/mccubed.py"
     subprocess.call(["mpiexec {:s} -c {:s}".format(MC3call, MCMC_cfile)],
                     shell=True, cwd=date_dir)
+    # Summary of the forward-model timing over all workers:
+    if timing and len(glob.glob(tfiles)) > 0:
+      mu.msg(1, "\nTiming of the forward model:")
+      t.summary(sorted(glob.glob(tfiles)))
 
   # Re-plot MCMC results in prettier format
   mcp.mcplots('output.npy', burnin,   thinning, nchains, uniform, molfit, 
@@ -442,13 +576,13 @@ def main():
   MCfile = date_dir + logfile
   
   # Call bestFit submodule: make new bestFit_tconfig.cfg, run best-fit Transit
-  bf.callTransit(date_dir+atmfile, tep_name, MCfile,  stepsize, molfit, 
+  bf.callTransit(atmfile, tep_name, MCfile,  stepsize, molfit, 
                  solution,         refpress, tconfig, date_dir, burnin, 
                  abun_basic,       PTtype,   PTfunc[PTtype],    filters)
 
   # Plot best-fit eclipse or modulation spectrum, depending on solution:
   bf.plot_bestFit_Spectrum(filters, kurucz, tep_name, solution, outspec,
-                           data, uncert, date_dir)
+                           data, uncert, date_dir, kurucz_interp)
 
   bestFit_atmfile = 'bestFit.atm'
 
@@ -475,7 +609,7 @@ def main():
     ctf = cf.transmittance(date_dir, bestFit_atmfile, filters)
 
   # Make a plot of MCMC profiles with contribution functions/transmittance
-  bf.callTransit(date_dir+atmfile, tep_name, MCfile,   stepsize, molfit, 
+  bf.callTransit(atmfile, tep_name, MCfile,   stepsize, molfit, 
                  solution,         refpress, tconfig,  date_dir, burnin, 
                  abun_basic,       PTtype,   PTfunc[PTtype],     filters,  ctf)
 
@@ -7,13 +7,14 @@ import sys, os
 import argparse, ConfigParser
 import numpy as np
 import scipy.constants as sc
-from mpi4py import MPI
 
 import makeatm   as mat
+import atmio     as aio
 import PT        as pt
 import wine      as w
 import reader    as rd
 import constants as c
+import timer     as t
 
 BARTdir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(BARTdir + "/../modules/MCcubed/")
@@ -22,20 +23,46 @@ import MCcubed.utils as mu
 sys.path.append(BARTdir + "/../modules/transit/transit/python")
 import transit_module as trm
 
+# Timed stages and counters of the forward model:
+STAGES   = ["PT", "abundances", "transit", "bandintegrate"]
+COUNTERS = ["rejectT", "rejectq"]
 
-def main(comm):
+
+def index_slice(indices):
   """
-  This is a hacked version of MC3's func.py.
-  This function directly call's the modeling function for the BART project.
+  Return a slice equivalent to a set of indices if they are consecutive
+  (indexing with a slice gives views rather than copies), else return
+  the indices array.
+  """
+  indices = np.asarray(indices)
+  if len(indices) > 0 and np.all(np.diff(indices) == 1):
+    return slice(indices[0], indices[-1]+1)
+  return indices
+
+
+def parse_args(argv=None):
+  """
+  Parse the BARTfunc arguments from the command line (or from argv)
+  and from the configuration file.
+
+  Parameters:
+  -----------
+  argv: List of strings
+     Command-line arguments.  If None, use sys.argv.
+
+  Returns:
+  --------
+  args2: Namespace
+     The parsed arguments.
   """
   # Parse arguments:
   cparser = argparse.ArgumentParser(description=__doc__, add_help=False,
                          formatter_class=argparse.RawDescriptionHelpFormatter)
   # Add config file option:
-  cparser.add_argument("-c", "--config_file", 
+  cparser.add_argument("-c", "--config_file",
                        help="Configuration file", metavar="FILE")
   # Remaining_argv contains all other command-line-arguments:
-  args, remaining_argv = cparser.parse_known_args()
+  args, remaining_argv = cparser.parse_known_args(argv)
 
   # Get parameters from configuration file:
   cfile = args.config_file
@@ -47,9 +74,9 @@ def main(comm):
   else:
     defaults = {}
   parser = argparse.ArgumentParser(parents=[cparser])
-  parser.add_argument("--func",      dest="func",      type=mu.parray, 
+  parser.add_argument("--func",      dest="func",      type=mu.parray,
                                      action="store",  default=None)
-  parser.add_argument("--indparams", dest="indparams", type=mu.parray, 
+  parser.add_argument("--indparams", dest="indparams", type=mu.parray,
                                      action="store",   default=[])
   parser.add_argument("--params",    dest="params",    type=mu.parray,
                                      action="store",   default=None,
@@ -63,9 +90,24 @@ def main(comm):
   parser.add_argument("--Tmax",      dest="Tmax",      type=float,
                       action="store",  default=3000.0,
                       help="Higher Temperature boundary [default: %(default)s]")
+  parser.add_argument("--nbatch",    dest="nbatch",    type=int,
+                      action="store",  default=1,
+                      help="Number of parameter sets evaluated per MPI "
+                           "exchange [default: %(default)s]")
   parser.add_argument("--quiet",             action="store_true",
                       help="Set verbosity level to minimum",
                       dest="quiet")
+  parser.add_argument("--loc_dir",   dest="loc_dir",   type=str,
+                      action="store",  default=".",
+                      help="Output directory [default: %(default)s]")
+  parser.add_argument("--timing",    dest="timing",    type=eval,
+                      action="store",  default=False,
+                      help="If True, record the wall time of each stage of "
+                           "the worker loop [default: %(default)s]")
+  parser.add_argument("--timing_interval", dest="timing_interval", type=int,
+                      action="store",  default=1000,
+                      help="Number of iterations between dumps of the timing "
+                           "histograms [default: %(default)s]")
   # Input-Converter Options:
   group = parser.add_argument_group("Input Converter Options")
   group.add_argument("--atmospheric_file",  action="store",
@@ -94,6 +136,11 @@ def main(comm):
   group.add_argument("--kurucz_file",           action="store",
                      help="Stellar Kurucz file [default: %(default)s]",
                      dest="kurucz",   type=str,       default=None)
+  group.add_argument("--kurucz_interp",         action="store",
+                     help="If True, interpolate the Kurucz models at the "
+                     "stellar temperature and log(g) instead of taking the "
+                     "nearest model [default: %(default)s]",
+                     dest="kurucz_interp", type=eval,  default=False)
   group.add_argument("--solution",                    action="store",
                      help="Solution geometry [default: %(default)s]",
                      dest="solution", type=str,       default="None",
@@ -102,6 +149,329 @@ def main(comm):
   parser.set_defaults(**defaults)
   args2, unknown = parser.parse_known_args(remaining_argv)
 
+  return args2
+
+
+class Model:
+  """
+  BART forward model: input converter (temperature and abundance
+  profiles), transit radiative-transfer, and output converter
+  (band-integrated fluxes).
+
+  The transit module keeps its state per process, thus there can be
+  only one initialized Model per process.
+
+  Parameters:
+  -----------
+  args: Namespace
+     BARTfunc arguments (see parse_args).
+  nbatch: Integer
+     Maximum number of parameter sets evaluated per call.
+  verb: Boolean
+     If True, print info to screen.
+  timer: Timer instance
+     If not None, record the wall time of the model stages ('PT',
+     'abundances', 'transit', and 'bandintegrate') and count the
+     rejected samples ('rejectT' and 'rejectq').
+  comm: MPI communicator
+     If not None, the stellar model and filters are read and resampled
+     only by the rank 0 of comm, which broadcasts them to the other
+     ranks (all ranks of comm must create their Model together).
+
+  Example:
+  --------
+  >>> import BARTfunc as bf
+  >>> args  = bf.parse_args(["-c", "MCMC_BART.cfg"])
+  >>> model = bf.Model(args, nbatch=2)
+  >>> bandflux = model(np.tile(args.params, (2,1)))
+  >>> model.free()
+  """
+  def __init__(self, args, nbatch=1, verb=False, timer=None, comm=None):
+    # :::::::  Initialize the Input converter ::::::::::::::::::::::::::
+    atmfile  = args.atmfile
+    molfit   = args.molfit
+    PTtype   = args.PTtype
+    params   = args.params
+    tepfile  = args.tep_name
+    tint     = args.tint
+    self.Tmin     = args.Tmin
+    self.Tmax     = args.Tmax
+    self.nbatch   = nbatch         # Maximum number of models per call
+    self.solution = args.solution  # Solution type
+    self.verb     = verb
+    if timer is None:
+      timer = t.Timer(STAGES, COUNTERS, enabled=False)
+    self.timer    = timer
+
+    # Dictionary of functions to calculate temperature for PTtype
+    PTfunc = {'iso'         : pt.PT_iso,
+              'line'        : pt.PT_line,
+              'madhu_noinv' : pt.PT_NoInversion,
+              'madhu_inv'   : pt.PT_Inversion}
+    self.PTfunc = PTfunc[PTtype]
+
+    # Extract necessary values from the TEP file:
+    tep = rd.File(tepfile)
+    # Stellar temperature in K:
+    tstar = float(tep.getvalue('Ts')[0])
+    # Stellar radius (in meters):
+    rstar = float(tep.getvalue('Rs')[0]) * c.Rsun
+    # Semi-major axis (in meters):
+    sma   = float(tep.getvalue( 'a')[0]) * sc.au
+    # Planetary radius (in meters):
+    rplanet = float(tep.getvalue('Rp')[0]) * c.Rjup
+    # Planetary mass (in kg):
+    mplanet = float(tep.getvalue('Mp')[0]) * c.Mjup
+
+    # Number of fitting parameters:
+    nfree   = len(params)                      # Total number of free params
+    nmolfit = len(molfit)                      # Number of molecular params
+    nradfit = int(self.solution == 'transit')  # 1 for transit, 0 for eclipse
+    nPT     = nfree - nmolfit - nradfit        # Number of PT free parameters
+    self.nPT     = nPT
+    self.imolpar = slice(nPT+nradfit, nPT+nradfit+nmolfit)
+
+    # Read atmospheric file to get data arrays (from its binary
+    # container, if the setup stages saved one):
+    species, pressure, temp, abundances = \
+        mat.readatm(aio.prefer_container(atmfile))
+    # Reverse pressure order (for PT to work):
+    self.pressure = pressure[::-1]
+    nlayers  = len(pressure)   # Number of atmospheric layers
+    nspecies = len(species)    # Number of species in the atmosphere
+    mu.msg(verb, "There are {:d} layers and {:d} species.".format(nlayers,
+                                                                  nspecies))
+    self.abundances = abundances
+    # Find index for Hydrogen and Helium:
+    species = np.asarray(species)
+    self.iH2 = np.where(species=="H2")[0][0]
+    self.iHe = np.where(species=="He")[0][0]
+    # Get H2/He abundance ratio:
+    self.ratio  = abundances[:,self.iH2] / abundances[:,self.iHe]
+    self.ratio1 = 1.0 + self.ratio
+    # Find indices for the metals:
+    self.imetals = index_slice(np.where((species != "He") & (species != "H2")
+                               & (species != "H-") & (species != 'e-'))[0])
+    # Index of molecular abundances being modified:
+    imol = np.zeros(nmolfit, dtype='i')
+    for i in np.arange(nmolfit):
+      imol[i] = np.where(species == molfit[i])[0]
+    self.imol = index_slice(imol)
+    # Initial abundances of the fitted molecules:
+    self.molabun = np.ascontiguousarray(abundances[:, imol].T)
+
+    # Pressure-Temperature profile:
+    if PTtype == "line":
+      # Planetary surface gravity (in cm s-2):
+      gplanet = 100.0 * sc.G * mplanet / rplanet**2
+      # Additional PT arguments:
+      self.PTargs = (rstar, tstar, tint, sma, gplanet)
+    else:
+      self.PTargs = ()
+
+    # Allocate arrays for the temperature and abundance profiles:
+    self.profiles = np.zeros((nbatch, nspecies+1, nlayers), dtype='d')
+    # This are sub-sections of profiles, containing just the temperature
+    # and the abundance profiles, respectively:
+    self.tprofiles = self.profiles[:, 0, :]
+    self.aprofiles = self.profiles[:, 1:,:]
+
+    # Store abundance profiles:
+    self.aprofiles[:] = abundances.T
+    # Flattened view of the profiles (as taken by transit):
+    self.flatprofiles = self.profiles.reshape((nbatch, -1))
+
+    # Workspace of the input converter:
+    self.molscale = np.zeros((nbatch, nmolfit, 1))
+    self.molprof  = np.zeros((nbatch, nmolfit, nlayers))
+    self.q        = np.zeros((nbatch, nlayers))
+    self.flags    = np.zeros((nbatch, nlayers), bool)
+    self.reject   = np.zeros(nbatch, bool)
+    self.rejectq  = np.zeros(nbatch, bool)
+
+    # :::::::  Spawn transit code  :::::::::::::::::::::::::::::::::::::
+    # # transit configuration file:
+    transitcfile = args.tconfig
+
+    # Initialize the transit python module:
+    transit_args = ["transit", "-c", transitcfile]
+    trm.transit_init(len(transit_args), transit_args)
+
+    # Get wavenumber array from transit:
+    self.nwave  = nwave  = trm.get_no_samples()
+    self.specwn = specwn = trm.get_waveno_arr(nwave)
+
+    # :::::::  Output Converter  :::::::::::::::::::::::::::::::::::::::
+    ffile    = args.filters    # Filter files
+    kurucz   = args.kurucz     # Kurucz file
+
+    # Log10(stellar gravity)
+    gstar = float(tep.getvalue('loggstar')[0])
+    # Planet-to-star radius ratio:
+    rprs  = rplanet / rstar
+
+    self.nfilters = nfilters = len(ffile)  # Number of filters:
+
+    # Read the stellar model and filters, and resample them on specwn.
+    # With comm, only its first rank does it and broadcasts the result
+    # (or its error, so that no rank is left waiting):
+    setup, message = None, None
+    if comm is None or comm.Get_rank() == 0:
+      try:
+        setup = w.bandsetup(specwn, ffile, kurucz, tstar, gstar,
+                            args.kurucz_interp)
+      except Exception as error:
+        message = "{:s}: {:s}".format(type(error).__name__, str(error))
+    if comm is not None:
+      setup, message = comm.bcast((setup, message), root=0)
+    if message is not None:
+      mu.exit(message=message)
+    nifilter, istarfl, wnindices = setup
+
+    # Band-integration operator (spectrum to band-integrated values):
+    if self.solution == "eclipse":
+      self.bandop = w.bandoperator(specwn, nifilter, wnindices, istarfl, rprs)
+    elif self.solution == "transit":
+      self.bandop = w.bandoperator(specwn, nifilter, wnindices)
+
+
+  def __call__(self, params, bandflux=None):
+    """
+    Evaluate the band-integrated model for a set of parameters.
+
+    Parameters:
+    -----------
+    params: 2D float ndarray
+       Array of shape (nmodels, npars) with the model parameters
+       (nmodels <= nbatch).  A 1D array is evaluated as a single model.
+    bandflux: 2D float ndarray
+       If not None, array of shape (nmodels, nfilters) where to store
+       the output.
+
+    Returns:
+    --------
+    bandflux: 2D float ndarray
+       Band-integrated values of shape (nmodels, nfilters).  Non-physical
+       models (non-physical PT profile, temperature out of bounds, or
+       negative H2+He abundance) return -1.0.
+    """
+    params = np.atleast_2d(params)
+    nmodels = len(params)
+    if bandflux is None:
+      bandflux = np.zeros((nmodels, self.nfilters), dtype='d')
+    timer = self.timer
+
+    # Input converter calculate the profiles:
+    reject = self.convert(params)
+
+    for k in np.arange(nmodels):
+      # Skip non-physical models:
+      if reject[k]:
+        bandflux[k] = -1.0
+        continue
+
+      # Set the 'surface' level:
+      if self.solution == "transit":
+        trm.set_radius(params[k, self.nPT])
+
+      # Let transit calculate the model spectrum:
+      spectrum = trm.run_transit(self.flatprofiles[k], self.nwave)
+      timer.tick("transit")
+
+      # Calculate the band-integrated intensity per filter:
+      bandflux[k] = self.bandop.dot(spectrum)
+      timer.tick("bandintegrate")
+
+    return bandflux
+
+
+  def convert(self, params):
+    """
+    Input converter, compute the temperature and abundance profiles of
+    a set of parameters into the profiles array.  All operations work
+    in place on preallocated arrays.
+
+    Parameters:
+    -----------
+    params: 2D float ndarray
+       Array of shape (nmodels, npars) with the model parameters.
+
+    Returns:
+    --------
+    reject: 1D bool ndarray
+       Flags of the non-physical models (non-physical PT profile,
+       temperature out of bounds, or negative H2+He abundance).
+    """
+    nmodels = len(params)
+    # Sub-sections of the profiles and workspace for this set of models:
+    tprofiles = self.tprofiles[:nmodels]
+    aprofiles = self.aprofiles[:nmodels]
+    molscale  = self.molscale [:nmodels]
+    q         = self.q        [:nmodels]
+    flags     = self.flags    [:nmodels]
+    reject    = self.reject   [:nmodels]
+    rejectq   = self.rejectq  [:nmodels]
+    timer = self.timer
+
+    # Temperature profiles (batched):
+    tprofiles[:, ::-1] = pt.PT_generator_batch(self.pressure,
+                           params[:, 0:self.nPT], self.PTfunc, self.PTargs)
+    timer.tick("PT")
+
+    # Flag the non-physical profiles (NaN) and the models whose
+    # temperature goes out of bounds:
+    np.isnan(tprofiles[:, 0], out=reject)
+    if np.any(reject):
+      mu.msg(self.verb, 'Input parameters give non-physical profile.')
+    np.less(tprofiles, self.Tmin, out=flags)
+    np.logical_or.reduce(flags, axis=1, out=rejectq)
+    reject |= rejectq
+    np.greater(tprofiles, self.Tmax, out=flags)
+    np.logical_or.reduce(flags, axis=1, out=rejectq)
+    reject |= rejectq
+    if timer.enabled:
+      timer.count("rejectT", np.sum(reject))
+
+    # Scale abundance profiles (use variable as the log10):
+    np.power(10.0, params[:, self.imolpar, np.newaxis], out=molscale)
+    np.multiply(self.molabun, molscale, out=self.molprof[:nmodels])
+    aprofiles[:, self.imol] = self.molprof[:nmodels]
+
+    # Update H2, He abundances so sum(abundances) = 1.0 in each layer:
+    np.add.reduce(aprofiles[:, self.imetals], axis=1, out=q)
+    np.subtract(1.0, q, out=q)
+    np.less(q, 0.0, out=flags)
+    np.logical_or.reduce(flags, axis=1, out=rejectq)
+    if timer.enabled:
+      timer.count("rejectq", np.sum(rejectq & ~reject))
+    reject |= rejectq
+    h2 = aprofiles[:, self.iH2]
+    np.multiply(self.ratio, q, out=h2)
+    np.divide(h2, self.ratio1, out=h2)
+    np.divide(q,  self.ratio1, out=aprofiles[:, self.iHe])
+    timer.tick("abundances")
+
+    return reject
+
+
+  def free(self):
+    """
+    Free the transit memory.
+    """
+    trm.free_memory()
+
+
+def main(comm):
+  """
+  This is a hacked version of MC3's func.py.
+  This function directly call's the modeling function for the BART project.
+  """
+  from mpi4py import MPI
+
+  # Parse arguments:
+  args2 = parse_args()
+  nbatch = args2.nbatch  # Number of models per exchange
+
   # Quiet all threads except rank 0:
   rank = comm.Get_rank()
   verb = rank == 0
@@ -111,206 +481,61 @@ def main(comm):
   mu.comm_bcast(comm, array1)
   npars, niter = array1
 
-  # :::::::  Initialize the Input converter ::::::::::::::::::::::::::
-  atmfile  = args2.atmfile
-  molfit   = args2.molfit
-  PTtype   = args2.PTtype
-  params   = args2.params
-  tepfile  = args2.tep_name
-  tint     = args2.tint
-  Tmin     = args2.Tmin
-  Tmax     = args2.Tmax
-  solution = args2.solution  # Solution type
-
-  # Dictionary of functions to calculate temperature for PTtype
-  PTfunc = {'iso'         : pt.PT_iso,
-            'line'        : pt.PT_line, 
-            'madhu_noinv' : pt.PT_NoInversion,
-            'madhu_inv'   : pt.PT_Inversion}
-
-  # Extract necessary values from the TEP file:
-  tep = rd.File(tepfile)
-  # Stellar temperature in K:
-  tstar = float(tep.getvalue('Ts')[0])
-  # Stellar radius (in meters):
-  rstar = float(tep.getvalue('Rs')[0]) * c.Rsun
-  # Semi-major axis (in meters):
-  sma   = float(tep.getvalue( 'a')[0]) * sc.au
-  # Planetary radius (in meters):
-  rplanet = float(tep.getvalue('Rp')[0]) * c.Rjup
-  # Planetary mass (in kg):
-  mplanet = float(tep.getvalue('Mp')[0]) * c.Mjup
-
-  # Number of fitting parameters:
-  nfree   = len(params)                 # Total number of free parameters
-  nmolfit = len(molfit)                 # Number of molecular free parameters
-  nradfit = int(solution == 'transit')  # 1 for transit, 0 for eclipse
-  nPT     = nfree - nmolfit - nradfit   # Number of PT free parameters
-
-  # Read atmospheric file to get data arrays:
-  species, pressure, temp, abundances = mat.readatm(atmfile)
-  # Reverse pressure order (for PT to work):
-  pressure = pressure[::-1]
-  nlayers  = len(pressure)   # Number of atmospheric layers
-  nspecies = len(species)    # Number of species in the atmosphere
-  mu.msg(verb, "There are {:d} layers and {:d} species.".format(nlayers,
-                                                                nspecies))
-  # Find index for Hydrogen and Helium:
-  species = np.asarray(species)
-  iH2     = np.where(species=="H2")[0]
-  iHe     = np.where(species=="He")[0]
-  # Get H2/He abundance ratio:
-  ratio = (abundances[:,iH2] / abundances[:,iHe]).squeeze()
-  # Find indices for the metals:
-  imetals = np.where((species != "He") & (species != "H2") & \
-                     (species != "H-") & (species != 'e-'))[0]
-  # Index of molecular abundances being modified:
-  imol = np.zeros(nmolfit, dtype='i')
-  for i in np.arange(nmolfit):
-    imol[i] = np.where(np.asarray(species) == molfit[i])[0]
-  
-  # Pressure-Temperature profile:
-  if PTtype == "line":
-    # Planetary surface gravity (in cm s-2):
-    gplanet = 100.0 * sc.G * mplanet / rplanet**2
-    # Additional PT arguments:
-    PTargs  = [rstar, tstar, tint, sma, gplanet]
-  else:
-    PTargs  = None
+  # Stage timer (one output file per rank):
+  timer = t.Timer(["scatter"] + STAGES + ["gather"], COUNTERS,
+                  enabled=args2.timing)
+  tfile = "{:s}/timing_rank{:03d}.npz".format(args2.loc_dir, rank)
 
-  # Allocate arrays for receiving and sending data to master:
-  freepars = np.zeros(nfree,                 dtype='d')
-  profiles = np.zeros((nspecies+1, nlayers), dtype='d')
-  # This are sub-sections of profiles, containing just the temperature and
-  # the abundance profiles, respectively:
-  tprofile  = profiles[0, :]
-  aprofiles = profiles[1:,:]
-
-  # Store abundance profiles:
-  for i in np.arange(nspecies):
-    aprofiles[i] = abundances[:, i]
-
-  # :::::::  Spawn transit code  :::::::::::::::::::::::::::::::::::::
-  # # transit configuration file:
-  transitcfile = args2.tconfig
- 
-  # Initialize the transit python module:
-  transit_args = ["transit", "-c", transitcfile]
-  trm.transit_init(len(transit_args), transit_args)
-
-  # Get wavenumber array from transit:
-  nwave  = trm.get_no_samples()
-  specwn = trm.get_waveno_arr(nwave)
-
-  # :::::::  Output Converter  :::::::::::::::::::::::::::::::::::::::
-  ffile    = args2.filters    # Filter files
-  kurucz   = args2.kurucz     # Kurucz file
-
-  # Log10(stellar gravity)
-  gstar = float(tep.getvalue('loggstar')[0])
-  # Planet-to-star radius ratio:
-  rprs  = rplanet / rstar
-
-  nfilters = len(ffile)  # Number of filters:
-
-  # FINDME: Separate filter/stellar interpolation?
-  # Get stellar model:
-  starfl, starwn, tmodel, gmodel = w.readkurucz(kurucz, tstar, gstar)
-  # Read and resample the filters:
-  nifilter  = [] # Normalized interpolated filter
-  istarfl   = [] # interpolated stellar flux
-  wnindices = [] # wavenumber indices used in interpolation
-  for i in np.arange(nfilters):
-    # Read filter:
-    filtwaven, filttransm = w.readfilter(ffile[i])
-    # Check that filter boundaries lie within the spectrum wn range:
-    if filtwaven[0] < specwn[0] or filtwaven[-1] > specwn[-1]:
-      mu.exit(message="Wavenumber array ({:.2f} - {:.2f} cm-1) does not "
-              "cover the filter[{:d}] wavenumber range ({:.2f} - {:.2f} "
-              "cm-1).".format(specwn[0], specwn[-1], i, filtwaven[0],
-                                                        filtwaven[-1]))
-
-    # Resample filter and stellar spectrum:
-    nifilt, strfl, wnind = w.resample(specwn, filtwaven, filttransm,
-                                              starwn,    starfl)
-    nifilter.append(nifilt)
-    istarfl.append(strfl)
-    wnindices.append(wnind)
+  # Initialize the forward model (sharing the stellar and filter setup
+  # among the workers):
+  model = Model(args2, nbatch, verb, timer, MPI.COMM_WORLD)
 
   # Allocate arrays for receiving and sending data to master:
-  spectrum = np.zeros(nwave,    dtype='d')
-  bandflux = np.zeros(nfilters, dtype='d')
+  bandflux = np.zeros((nbatch, model.nfilters), dtype='d')
 
   # Allocate array to receive parameters from MPI:
-  params = np.zeros(npars, np.double)
+  params = np.zeros((nbatch, npars), np.double)
 
   # ::::::  Main MCMC Loop  ::::::::::::::::::::::::::::::::::::::::::
   # ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
 
+  iteration = 0
+  timer.reset()
   while niter >= 0:
     niter -= 1
     # Receive parameters from MCMC:
     mu.comm_scatter(comm, params)
+    timer.tick("scatter")
 
     # Check for the MCMC-end flag:
-    if params[0] == np.inf:
+    if params[0,0] == np.inf:
       break
 
-    # Input converter calculate the profiles:
-    try:
-      tprofile[:] = pt.PT_generator(pressure,       params[0:nPT], 
-                                    PTfunc[PTtype], PTargs       )[::-1]
-    except ValueError:
-      mu.msg(verb, 'Input parameters give non-physical profile.')
-      # FINDME: what to do here?
-
-    # If the temperature goes out of bounds:
-    if np.any(tprofile < Tmin) or np.any(tprofile > Tmax):
-      mu.comm_gather(comm, -np.ones(nfilters), MPI.DOUBLE)
-      continue
-    # Scale abundance profiles:
-    for i in np.arange(nmolfit):
-      m = imol[i]
-      # Use variable as the log10:
-      aprofiles[m] = abundances[:, m] * 10.0**params[nPT+nradfit+i]
-
-    # Update H2, He abundances so sum(abundances) = 1.0 in each layer:
-    q = 1.0 - np.sum(aprofiles[imetals], axis=0)
-    if np.any(q < 0.0):
-      mu.comm_gather(comm, -np.ones(nfilters), MPI.DOUBLE)
-      continue
-    aprofiles[iH2] = ratio * q / (1.0 + ratio)
-    aprofiles[iHe] =         q / (1.0 + ratio)
-
-    # Set the 'surface' level:
-    if solution == "transit":
-      trm.set_radius(params[nPT])
-
-    # Let transit calculate the model spectrum:
-    spectrum = trm.run_transit(profiles.flatten(), nwave)
-
-    # Calculate the band-integrated intensity per filter:
-    for i in np.arange(nfilters):
-      if   solution == "eclipse":
-        fluxrat = (spectrum[wnindices[i]]/istarfl[i]) * rprs*rprs
-        bandflux[i] = w.bandintegrate(fluxrat, specwn,
-                                      nifilter[i], wnindices[i])
-      elif solution == "transit":
-        bandflux[i] = w.bandintegrate(spectrum[wnindices[i]], specwn,
-                                      nifilter[i], wnindices[i])
+    # Evaluate the models:
+    model(params, bandflux)
 
     # Send resutls back to MCMC:
     mu.comm_gather(comm, bandflux, MPI.DOUBLE)
+    timer.tick("gather")
+
+    # Periodically save the timing histograms:
+    iteration += 1
+    if iteration % args2.timing_interval == 0:
+      timer.dump(tfile)
 
   # ::::::  End main Loop  :::::::::::::::::::::::::::::::::::::::::::
   # ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
 
+  # Save the timing histograms:
+  timer.dump(tfile)
+
   # Close communications and disconnect:
   mu.comm_disconnect(comm)
-  trm.free_memory()
+  model.free()
 
 
 if __name__ == "__main__":
+  from mpi4py import MPI
   # Open communications with the master:
   comm = MPI.Comm.Get_parent()
   main(comm)
@@ -36,6 +36,11 @@ import reader as rd
      Generate an isothermal PT profile.
   PT_generator:
      Wrapper that calls either inverted or non-inverted generator.
+  PT_Inversion_batch, PT_NoInversion_batch, PT_line_batch, PT_iso_batch:
+     Batched versions of the PT functions, compute a set of profiles
+     at once.
+  PT_generator_batch:
+     Batched version of PT_generator.
   plot_PT:
      Plot the PT profile.
 
@@ -71,7 +76,8 @@ def read_press_file(press_file):
      Parameters
      ----------
      press_file: String
-        Name ASCII file that contains a pressure array data.
+        Name ASCII file that contains a pressure array data (if it is
+        a pressure array instead, it is returned as is).
 
      Returns
      -------
@@ -84,6 +90,10 @@ def read_press_file(press_file):
      2014-08-15  Patricio  Cleaned up.
      '''
   
+     # Pressure array already in memory:
+     if not isinstance(press_file, str):
+          return np.asarray(press_file, np.double)
+
      # Open and read the pressure array file
      f = open(press_file, 'r')
      lines = f.readlines()
@@ -766,6 +776,203 @@ def PT_generator(p, free_params, PTfunc, PTargs=None):
   return Temp
 
 
+def PT_Inversion_batch(p, params):
+  """
+  Batched version of PT_Inversion, compute the smoothed inverted PT
+  profiles of a set of parameters at once.
+
+  Parameters:
+  -----------
+  p: 1D float ndarray
+     Pressure array (in bars), equally spaced in log space.
+  params: 2D float ndarray
+     Array of shape (N, 6) with the parameters (a1, a2, p1, p2, p3, T3)
+     of each profile.
+
+  Returns:
+  --------
+  T_smooth: 2D float ndarray
+     Smoothed temperature profiles of shape (N, nlayers).  Non-physical
+     profiles (negative temperature at the layer boundaries or unordered
+     pressure boundaries) are set to NaN.
+  """
+  a1, a2, p1, p2, p3, T3 = [params[:,i:i+1] for i in np.arange(6)]
+  p0 = np.amin(p)
+
+  # Temperatures at the layer boundaries (see PT_Inversion):
+  T2 = T3 - (np.log(p3/p2) / a2)**2
+  T0 = T2 + (np.log(p1/p2) / -a2)**2 - (np.log(p1/p0) / a1)**2
+  T1 = T0 + (np.log(p1/p0) / a1)**2
+
+  # Layer masks:
+  l1     = (p >= p0) & (p < p1)
+  l2_pos = (p >= p1) & (p < p2)
+  l2_neg = (p >= p2) & (p < p3)
+  l3     = (p >= p3) & (p <= np.amax(p))
+
+  T = np.empty((len(params), len(p)))
+  T[l1]     = ((np.log(p/p0) / a1)**2  + T0)[l1]
+  T[l2_pos] = ((np.log(p/p2) / -a2)**2 + T2)[l2_pos]
+  T[l2_neg] = ((np.log(p/p2) / a2)**2  + T2)[l2_neg]
+  T[l3]     = (T3 + 0*p)[l3]
+
+  # Each layer must belong to exactly one region:
+  invalid = (np.any(1*l1 + l2_pos + l2_neg + l3 != 1, axis=1) |
+             ((T0 < 0) | (T1 < 0) | (T2 < 0) | (T3 < 0))[:,0])
+  T[invalid] = np.nan
+
+  # Smooth with a Gaussian filter (along the layers):
+  T_smooth = gaussian_filter1d(T, 4, axis=1, mode='nearest')
+  T_smooth[invalid] = np.nan
+  return T_smooth
+
+
+def PT_NoInversion_batch(p, params):
+  """
+  Batched version of PT_NoInversion, compute the smoothed non-inverted
+  PT profiles of a set of parameters at once.
+
+  Parameters:
+  -----------
+  p: 1D float ndarray
+     Pressure array (in bars), equally spaced in log space.
+  params: 2D float ndarray
+     Array of shape (N, 5) with the parameters (a1, a2, p1, p3, T3) of
+     each profile.
+
+  Returns:
+  --------
+  T_smooth: 2D float ndarray
+     Smoothed temperature profiles of shape (N, nlayers).  Non-physical
+     profiles (negative temperature at the layer boundaries or unordered
+     pressure boundaries) are set to NaN.
+  """
+  a1, a2, p1, p3, T3 = [params[:,i:i+1] for i in np.arange(5)]
+  p0 = np.amin(p)
+
+  # Temperatures at the layer boundaries (see PT_NoInversion):
+  T1 = T3 - (np.log(p3/p1) / a2)**2.0
+  T0 = T1 - (np.log(p1/p0) / a1)**2.0
+
+  # Layer masks:
+  l1     = (p >= p0) & (p < p1)
+  l2_neg = (p >= p1) & (p < p3)
+  l3     = (p >= p3) & (p <= np.amax(p))
+
+  T = np.empty((len(params), len(p)))
+  T[l1]     = ((np.log(p/p0) / a1)**2 + T0)[l1]
+  T[l2_neg] = ((np.log(p/p1) / a2)**2 + T1)[l2_neg]
+  T[l3]     = (T3 + 0*p)[l3]
+
+  # Each layer must belong to exactly one region:
+  invalid = (np.any(1*l1 + l2_neg + l3 != 1, axis=1) |
+             ((T0 < 0) | (T1 < 0) | (T3 < 0))[:,0])
+  T[invalid] = np.nan
+
+  # Smooth with a Gaussian filter (along the layers):
+  T_smooth = gaussian_filter1d(T, 4, axis=1, mode='nearest')
+  T_smooth[invalid] = np.nan
+  return T_smooth
+
+
+def PT_line_batch(pressure, params, R_star, T_star, T_int, sma, grav):
+  """
+  Batched version of PT_line, compute the Line et al. (2013) PT
+  profiles of a set of parameters at once.
+
+  Parameters:
+  -----------
+  pressure: 1D float ndarray
+     Array of pressure values in bars.
+  params: 2D float ndarray
+     Array of shape (N, 5) with the parameters (log10(kappa),
+     log10(gamma1), log10(gamma2), alpha, beta) of each profile.
+  R_star: Float
+     Stellar radius (in meters).
+  T_star: Float
+     Stellar effective temperature (in Kelvin degrees).
+  T_int:  Float
+     Planetary internal heat flux (in Kelvin degrees).
+  sma:    Float
+     Semi-major axis (in meters).
+  grav:   Float
+     Planetary surface gravity (at 1 bar) in cm/second^2.
+
+  Returns:
+  --------
+  temperature: 2D float ndarray
+     Temperature profiles of shape (N, nlayers).
+  """
+  kappa  = 10**(params[:,0:1])
+  gamma1 = 10**(params[:,1:2])
+  gamma2 = 10**(params[:,2:3])
+  alpha  = params[:,3:4]
+  beta   = params[:,4:5]
+
+  T_irr = beta * (R_star / (2.0*sma))**0.5 * T_star
+  tau = kappa * (pressure*1e6) / grav # Convert bars to barye (CGS)
+  xi1 = xi(gamma1, tau)
+  xi2 = xi(gamma2, tau)
+
+  temperature = (0.75 * (T_int**4 * (2.0/3.0 + tau) +
+                         T_irr**4 * (1-alpha) * xi1 +
+                         T_irr**4 * alpha     * xi2 ) )**0.25
+  return temperature
+
+
+def PT_iso_batch(p, params):
+  """
+  Batched version of PT_iso.
+
+  Parameters:
+  -----------
+  p: 1D float ndarray
+     Array of pressure values in bars.
+  params: 2D float ndarray
+     Array of shape (N, 1) with the temperature of each profile.
+
+  Returns:
+  --------
+  temperature: 2D float ndarray
+     Isothermal profiles of shape (N, nlayers).
+  """
+  return np.ones((len(params), len(p))) * params[:,0:1]
+
+
+# Batched version of each PT function:
+PT_batch = {PT_Inversion:   PT_Inversion_batch,
+            PT_NoInversion: PT_NoInversion_batch,
+            PT_line:        PT_line_batch,
+            PT_iso:         PT_iso_batch}
+
+
+def PT_generator_batch(p, free_params, PTfunc, PTargs=None):
+  """
+  Batched version of PT_generator, compute the temperature profiles of
+  a set of parameters with the batched version of PTfunc.
+
+  Parameters:
+  -----------
+  p: 1D float ndarray
+     Atmospheric pressure profile (in bar).
+  free_params: 2D float ndarray
+     Array of shape (N, nPT) with the PT parameters of each profile.
+  PTfunc: pointer to function
+     PT function (PT_Inversion, PT_NoInversion, PT_line, or PT_iso).
+  PTargs: list
+     If not None, additional arguments passed to the batched PTfunc.
+
+  Returns:
+  --------
+  Temp: 2D float ndarray
+     Temperature profiles of shape (N, nlayers).  Non-physical
+     profiles are set to NaN.
+  """
+  if PTargs is None:
+    PTargs = []
+  return PT_batch[PTfunc](p, np.atleast_2d(free_params), *PTargs)
+
+
 # plots PT profiles
 def plot_PT(p, PT, T_smooth, MadhuPT):
      '''
@@ -0,0 +1,388 @@
+# Copyright (C) 2015-2016 University of Central Florida. All rights reserved.
+# BART is under an open-source, reproducible-research license (see LICENSE).
+
+"""
+    Reader and writers of the data block of TEA/transit atmospheric files.
+
+    The data lines are parsed in a single NumPy call, and written with a
+    single string-formatting operation over all the layers.  The output
+    is byte-identical to the per-value formatting used previously by
+    makeatm and bestFit.
+
+    Atmospheres are also stored in a binary container: an .npz file with
+    the header lines, species, and the radius (if any), pressure,
+    temperature, and abundance columns as separate arrays (loaded on
+    access), plus provenance metadata (source file, its SHA-1 digest,
+    size, modification time, and creation time).  read() takes either
+    format.  The BART setup stages write the layer arrays into a
+    container next to the ASCII atmospheric file (see write), which the
+    forward model and the post-processing read instead of parsing the
+    ASCII file (see prefer_container).  The ASCII format remains the
+    interface to TEA and transit (export() writes it from a container).
+
+    Functions
+    ---------
+    markers:
+          Find the species and data lines of an atmospheric file.
+    parse:
+          Parse the data lines into a 2D array.
+    read:
+          Read an atmospheric file (ASCII or binary container).
+    columns:
+          Header, species, and data array of a loaded binary container.
+    container:
+          Name of the binary container of an ASCII atmospheric file.
+    write:
+          Write an atmospheric file and its binary container.
+    prefer_container:
+          The container written along with an atmospheric file, if any.
+    save:
+          Save an atmosphere into a binary container.
+    load:
+          Load a binary container (lazy column access).
+    export:
+          Write the ASCII atmospheric file of a binary container.
+    write_tea:
+          Write a TEA data block (pressure, temperature, abundances).
+    write_layers:
+          Write a data block with radius, pressure, temperature, and
+          abundances.
+    format_tea, format_layers:
+          Text of the data blocks written by write_tea and write_layers.
+    quantize:
+          Values as read back from a file written with a given format.
+"""
+
+import os
+import time
+import numpy as np
+
+import cache
+
+
+def markers(lines):
+  """
+  Find the species and data lines of an atmospheric file.
+
+  Parameters:
+  -----------
+  lines: List of strings
+     Lines of an atmospheric file.
+
+  Returns:
+  --------
+  imol: Integer
+     Index of the line with the species names (after '#SPECIES').
+  start: Integer
+     Index of the first data line (after '#TEADATA' and the column
+     labels).
+  """
+  lines = list(lines)
+  imol  = lines.index("#SPECIES\n") + 1
+  start = lines.index("#TEADATA\n") + 2
+  return imol, start
+
+
+def parse(lines):
+  """
+  Parse the data lines of an atmospheric file.
+
+  Parameters:
+  -----------
+  lines: List of strings
+     Data lines (same number of columns in every line).
+
+  Returns:
+  --------
+  data: 2D float ndarray
+     Array of shape (nlines, ncolumns) with the data values.
+  """
+  nlines = len(lines)
+  ncols  = len(lines[0].split())
+  data = np.fromstring(''.join(lines), np.double, sep=" ")
+  if len(data) != nlines*ncols:
+    data = np.array([line.split() for line in lines], np.double)
+  return np.reshape(data, (nlines, ncols))
+
+
+def read(atmfile):
+  """
+  Read an atmospheric file.
+
+  Parameters:
+  -----------
+  atmfile: String
+     Name of TEA atmospheric ASCII file, or of a binary container (.npz).
+
+  Returns:
+  --------
+  header: List of strings
+     Lines of the file before the data (including the column labels).
+  molecules: List of strings
+     Species names.
+  data: 2D float ndarray
+     Array of shape (nlayers, ncolumns) with the data values.
+  """
+  if atmfile.endswith(".npz"):
+    with load(atmfile) as atm:
+      return columns(atm)
+
+  f = open(atmfile, 'r')
+  lines = f.readlines()
+  f.close()
+
+  imol, start = markers(lines)
+  return lines[:start], lines[imol].split(), parse(lines[start:])
+
+
+def columns(atm):
+  """
+  Assemble the header, species, and data array of a loaded binary
+  container (see read).
+  """
+  names = ["pressure", "temperature"]
+  if "radius" in atm.files:
+    names = ["radius"] + names
+  data = np.column_stack([atm[name] for name in names] + [atm["abundances"]])
+  header    = [str(line) for line in atm["header"]]
+  molecules = [str(mol)  for mol  in atm["species"]]
+  return header, molecules, data
+
+
+def container(atmfile):
+  """
+  Name of the binary container of an ASCII atmospheric file: the same
+  name with the .npz extension.
+  """
+  return os.path.splitext(atmfile)[0] + ".npz"
+
+
+def write(atmfile, header, molecules, data, npzfile=None):
+  """
+  Write an atmosphere into an ASCII atmospheric file (the format read
+  by transit) and, optionally, into a binary container that records
+  the size and modification time of the ASCII file (see
+  prefer_container).
+
+  Parameters:
+  -----------
+  atmfile: String
+     Output ASCII atmospheric file.
+  header: List of strings
+     Lines of the file before the data (including the column labels).
+  molecules: List of strings
+     Species names.
+  data: 2D float ndarray
+     Array of shape (nlayers, nspecies+3) with the radius, pressure,
+     temperature, and abundances per layer, as read back from the ASCII
+     file (see quantize and format_layers).
+  npzfile: String
+     If not None, output binary container.
+  """
+  f = open(atmfile, 'w')
+  f.writelines(header)
+  write_layers(f, data[:,0], data[:,1], data[:,2], data[:,3:])
+  f.close()
+  if npzfile is not None:
+    stat = os.stat(atmfile)
+    save(npzfile, header, molecules, data, source=os.path.realpath(atmfile),
+         size=stat.st_size, mtime=stat.st_mtime)
+
+
+def prefer_container(atmfile):
+  """
+  Return the binary container of atmfile (see container) if it was
+  written along with atmfile (see write), i.e., if the size and
+  modification time that it records match those of atmfile (to the
+  millisecond, copies may not keep a finer time).  Else return atmfile.
+  """
+  filename = container(atmfile)
+  if filename == atmfile or not os.path.isfile(filename):
+    return atmfile
+  stat = os.stat(atmfile)
+  with load(filename) as atm:
+    if ("size" in atm.files and int(atm["size"]) == stat.st_size and
+        abs(float(atm["mtime"]) - stat.st_mtime) < 1e-3):
+      return filename
+  return atmfile
+
+
+def save(filename, header, molecules, data, source="", sha1="", size=-1,
+         mtime=0.0):
+  """
+  Save an atmosphere into a binary container.
+
+  Parameters:
+  -----------
+  filename: String
+     Output .npz file.
+  header: List of strings
+     Lines of the ASCII file before the data (including the column
+     labels).
+  molecules: List of strings
+     Species names.
+  data: 2D float ndarray
+     Array of shape (nlayers, ncolumns) with the radius (unless ncolumns
+     is nspecies+2), pressure, temperature, and abundances per layer.
+  source: String
+     Provenance: name of the file the atmosphere comes from.
+  sha1: String
+     Provenance: SHA-1 digest of the source file.
+  size: Integer
+     Provenance: size of the source file.
+  mtime: Float
+     Provenance: modification time of the source file.
+  """
+  arrays = {"header":  np.asarray(header,    str),
+            "species": np.asarray(molecules, str),
+            "source":  source,
+            "sha1":    sha1,
+            "size":    size,
+            "mtime":   mtime,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S")}
+  icol = 0
+  if np.shape(data)[1] != len(molecules) + 2:
+    arrays["radius"] = data[:,0]
+    icol = 1
+  arrays["pressure"]    = data[:,icol]
+  arrays["temperature"] = data[:,icol+1]
+  arrays["abundances"]  = data[:,icol+2:]
+  cache.atomic_savez(filename, **arrays)
+
+
+def load(filename):
+  """
+  Load a binary container.  The arrays ('header', 'species', 'radius'
+  (if any), 'pressure', 'temperature', 'abundances', and the provenance
+  'source', 'sha1', 'size', 'mtime', and 'created') are read from disk
+  when accessed.
+
+  Parameters:
+  -----------
+  filename: String
+     Input .npz file.
+
+  Returns:
+  --------
+  atm: NpzFile
+     Dictionary-like object with the container arrays.
+
+  Example:
+  --------
+  >>> import atmio as aio
+  >>> atm = aio.load("atmosphere.npz")
+  >>> temperature = atm["temperature"]
+  """
+  return np.load(filename)
+
+
+def export(filename, atmfile):
+  """
+  Write the ASCII atmospheric file (as read by transit or TEA) of a
+  binary container.
+
+  Parameters:
+  -----------
+  filename: String
+     Input .npz file.
+  atmfile: String
+     Output ASCII atmospheric file.
+  """
+  atm = load(filename)
+  f = open(atmfile, 'w')
+  f.writelines([str(line) for line in atm["header"]])
+  if "radius" in atm.files:
+    write_layers(f, atm["radius"], atm["pressure"], atm["temperature"],
+                 atm["abundances"])
+  else:
+    write_tea(f, atm["pressure"], atm["temperature"], atm["abundances"])
+  f.close()
+  atm.close()
+
+
+def format_tea(pressure, temp, abundances):
+  """
+  Text of a TEA data block, each line has the pressure ('%10.4e'),
+  temperature ('%8.2f'), and abundances ('%16.10e') of a layer.
+
+  Parameters:
+  -----------
+  pressure: 1D float ndarray
+     Layers' pressure.
+  temp: 1D float ndarray
+     Layers' temperature.
+  abundances: 2D float ndarray
+     Array of shape (nlayers, nspecies) with the layers' abundances.
+
+  Returns:
+  --------
+  text: String
+     The data block.
+  """
+  data = np.column_stack((pressure, temp, abundances))
+  line = "%10.4e %8.2f  " + "  ".join(["%16.10e"]*np.shape(abundances)[1])
+  return ((line + "\n") * len(data)) % tuple(data.ravel().tolist())
+
+
+def format_layers(radius, pressure, temp, abundances):
+  """
+  Text of a data block with radius ('%10.3f'), pressure ('%10.4e'),
+  temperature ('%7.2f'), and abundances ('%1.4e') per layer.
+
+  Parameters:
+  -----------
+  radius: 1D float ndarray
+     Layers' radius.
+  pressure: 1D float ndarray
+     Layers' pressure.
+  temp: 1D float ndarray
+     Layers' temperature.
+  abundances: 2D float ndarray
+     Array of shape (nlayers, nspecies) with the layers' abundances.
+
+  Returns:
+  --------
+  text: String
+     The data block.
+  """
+  data = np.column_stack((radius, pressure, temp, abundances))
+  line = "%10.3f %10.4e %7.2f " + "%1.4e "*np.shape(abundances)[1]
+  return ((line + "\n") * len(data)) % tuple(data.ravel().tolist())
+
+
+def write_tea(f, pressure, temp, abundances):
+  """
+  Write a TEA data block into the file object f (see format_tea).
+  """
+  f.write(format_tea(pressure, temp, abundances))
+
+
+def write_layers(f, radius, pressure, temp, abundances):
+  """
+  Write a data block with radius, pressure, temperature, and abundances
+  into the file object f (see format_layers).
+  """
+  f.write(format_layers(radius, pressure, temp, abundances))
+
+
+def quantize(values, fmt):
+  """
+  Return the values as they are read back from a file where they were
+  written with the format fmt (e.g., '%8.2f').  This lets in-memory
+  stages give the same results as stages that exchange files.
+
+  Parameters:
+  -----------
+  values: ndarray
+     Input values.
+  fmt: String
+     Printf-style format of a value.
+
+  Returns:
+  --------
+  quantized: ndarray
+     Array of the same shape as values.
+  """
+  values = np.asarray(values, np.double)
+  text = ((fmt + " ") * values.size) % tuple(values.ravel().tolist())
+  return np.reshape(np.fromstring(text, np.double, sep=" "), values.shape)
@@ -16,6 +16,10 @@
           Write best-fit atm file with scaled H2 and He to abundances sum of 1
     bestFit_tconfig:
           Write best-fit config file for best-fit Transit run
+    unique_samples:
+          Compress the MCMC chains into unique samples and multiplicities
+    PT_quantiles:
+          Per-layer quantiles of the posterior PT profiles (bounded memory)
     callTransit:
           Call Transit to produce best-fit outputs. Plot MCMC posterior PT plot.
     plot_bestFit_Spectrum:
@@ -43,6 +47,7 @@ import matplotlib
 import matplotlib.pyplot as plt
 
 import makeatm as mat
+import atmio as aio
 import PT as pt
 import cf
 import wine as w
@@ -158,47 +163,20 @@ def write_atmfile(atmfile, abun_file, molfit, T_line, abun_fact, date_dir,
     date_dir: String
       Directory where to store the best-fit atmospheric file.
     """
-    # Open atmfile to read
-    f = open(atmfile, 'r')
-    lines = np.asarray(f.readlines())
-    f.close()
-
-    # Get the molecules
-    imol      = np.where(lines == "#SPECIES\n")[0][0] + 1
-    molecules = lines[imol].split()
-
-    # Find the line where the layers info begins
-    start     = np.where(lines == "#TEADATA\n")[0][0] + 2
-    headers   = lines[start-1].split()
-    datalines = lines[start:]
-
-    # Number of columns
-    ncol = len(lines[start].split())
+    # Read atmfile (header lines, molecules, and data block):
+    header, molecules, data = aio.read(aio.prefer_container(atmfile))
+    headers = header[-1].split()
 
     # Number of layers
-    ndata = len(datalines)
-
-    # Allocate space for pressure:
-    pressure = np.zeros(ndata, np.double)
-
-    # Number of abundances (elements per line except Radius, Press and T)
-    nabun = len(lines[start].split()) - 3
-
-    data = np.zeros((ndata, len(headers)))
-    for i in np.arange(ndata):
-        data[i] = datalines[i].split()
+    ndata = len(data)
 
     # Extract pressure data:
     pressure = data[:,1]
 
     # Fill out the abundances array:
-    abundances = np.zeros((len(molecules), ndata))
-    for i in np.arange(len(molecules)):
-        for j in np.arange(ndata):
-            abundances[i] = data[:, i+3]
+    abundances = data[:, 3:3+len(molecules)].T.copy()
 
     # recognize which columns to take from the atmospheric file
-    headers = lines[start-1].split()
     columns = np.zeros(len(molfit), dtype=int)
     for i in np.arange(len(molfit)):
         for j in np.arange(len(headers)):
@@ -240,26 +218,11 @@ def write_atmfile(atmfile, abun_file, molfit, T_line, abun_fact, date_dir,
 
     # open best fit atmospheric file
     fout = open(date_dir + 'bestFit.atm', 'w')
-    fout.writelines(lines[:start])
+    fout.writelines(header)
 
-    # Write atm file for each run
-    for i in np.arange(ndata):
-        # Radius, pressure, and temp for the current line
-        radi  = str('%10.3f'%rad[i])
-        presi = str('%10.4e'%pressure[i])
-        tempi = str('%7.2f'%T_line[i])
-
-        # Insert radii array
-        fout.write(radi.ljust(10) + ' ')
-
-        # Insert results from the current line (T-P) to atm file
-        fout.write(presi.ljust(10) + ' ')
-        fout.write(tempi.ljust(7) + ' ')
-
-        # Write current abundances
-        for j in np.arange(len(headers) - 3):
-            fout.write('%1.4e'%abundances[j][i] + ' ')
-        fout.write('\n')
+    # Write radius, pressure, temperature, and abundances of each layer:
+    aio.write_layers(fout, rad, pressure, T_line,
+                     abundances[:len(headers)-3].T)
 
     # Close atm file
     fout.close()
@@ -289,6 +252,146 @@ def bestFit_tconfig(tconfig, date_dir, radius=None):
   f.close()
 
 
+def unique_samples(posterior, burnin):
+    """
+    Compress the MCMC chains into their unique parameter sets and the
+    number of times each one was visited.  Consecutive repetitions
+    (rejected proposals) are collapsed chain by chain, so no stacked
+    copy of the chains is made.
+
+    Parameters
+    ----------
+    posterior: 3D array. MCMC chains of shape (nchains, npars, niter),
+               can be a memory-mapped array.
+    burnin: int. Number of burn-in iterations to discard per chain.
+
+    Returns
+    -------
+    samples: 2D array. Unique parameter sets, shape (nunique, npars).
+    weights: 1D array. Multiplicity of each parameter set.
+    """
+    samples, weights = [], []
+    for c in np.arange(np.shape(posterior)[0]):
+        chain = np.asarray(posterior[c, :, burnin:]).T
+        # Indices where the chain moves to a new state:
+        jumps = np.ones(len(chain), bool)
+        jumps[1:] = np.any(chain[1:] != chain[:-1], axis=1)
+        start = np.where(jumps)[0]
+        samples.append(chain[start])
+        weights.append(np.diff(np.append(start, len(chain))))
+    samples = np.concatenate(samples)
+    weights = np.concatenate(weights)
+
+    # Merge repeated states across (and within) chains:
+    samples, inverse = np.unique(samples, axis=0, return_inverse=True)
+    weights = np.bincount(inverse, weights)
+    return samples, weights
+
+
+def PT_quantiles(pressure, samples, weights, PTparams, ifree, PTfunc,
+                 PTargs, quantiles, nbins=1000, chunksize=10000):
+    """
+    Compute per-layer quantiles of the posterior PT profiles with bounded
+    memory.  The profiles are evaluated in chunks of samples, and the
+    weighted temperature distribution around each quantile of each layer
+    is accumulated into a histogram of nbins bins (plus the weight below
+    and above the histogram range).  The histogram ranges bracket the
+    quantiles of a pilot subsample of the posterior (a second pass over
+    the full temperature range is done where a bracket misses).  The
+    quantiles are linearly interpolated in the cumulative histograms,
+    thus they are accurate to within one bin width.
+
+    Parameters
+    ----------
+    pressure: 1D array. Pressure array (in bar).
+    samples: 2D array. Posterior samples (nsamples, nfree), the first
+             len(ifree) columns are the free PT parameters.
+    weights: 1D array. Multiplicity of each sample.
+    PTparams: 1D array. PT parameters (for the fixed ones).
+    ifree: 1D int array. Indices of the free PT parameters.
+    PTfunc: pointer to function. PT-profile function.
+    PTargs: list. Additional PTfunc arguments (or None).
+    quantiles: 1D array. Quantiles to compute (between 0 and 1).
+    nbins: int. Number of histogram bins per quantile and layer.
+    chunksize: int. Number of profiles evaluated at once.
+
+    Returns
+    -------
+    PTquantiles: 2D array. Temperature quantiles, shape
+                 (len(quantiles), nlayers).
+    """
+    nlayers   = len(pressure)
+    nsamples  = len(samples)
+    quantiles = np.asarray(quantiles, np.double)
+    nq = len(quantiles)
+
+    def profiles(index):
+        # PT profiles and weights of a set of samples:
+        params = np.tile(PTparams, (len(index), 1))
+        params[:, ifree] = samples[index, :len(ifree)]
+        temp = pt.PT_generator_batch(pressure, params, PTfunc, PTargs)
+        valid = ~np.isnan(temp[:,0])
+        return temp[valid], weights[index][valid]
+
+    # Pilot subsample (drawn with the sample weights) to bracket the
+    # quantiles (about four-sigma sampling uncertainty):
+    random = np.random.RandomState(0)
+    npilot = min(nsamples, chunksize)
+    pilot  = random.choice(nsamples, npilot, p=weights/np.sum(weights))
+    temp, wchunk = profiles(pilot)
+    delta = 4*np.sqrt(quantiles*(1-quantiles)/npilot) + 1.0/npilot
+    lo = np.percentile(temp, 100*np.clip(quantiles-delta, 0, 1), axis=0)
+    hi = np.percentile(temp, 100*np.clip(quantiles+delta, 0, 1), axis=0)
+
+    Tmin = np.tile( np.inf, nlayers)
+    Tmax = np.tile(-np.inf, nlayers)
+    offset = np.arange(nlayers) * (nbins+2)
+    hist   = np.zeros((nq, nlayers*(nbins+2)))
+    redo   = np.ones((nq, nlayers), bool)
+    # Quantiles whose histogram already spans the full range:
+    full   = np.zeros((nq, nlayers), bool)
+    while np.any(redo):
+        width = (hi - lo) / nbins
+        width[width == 0] = 1.0
+        # Weighted histograms (the first and last bins count the weight
+        # below and above the range):
+        hist[:] = 0.0
+        for first in np.arange(0, nsamples, chunksize):
+            temp, wchunk = profiles(np.arange(first,
+                                              min(first+chunksize, nsamples)))
+            if len(temp) == 0:
+                continue
+            Tmin = np.minimum(Tmin, np.amin(temp, axis=0))
+            Tmax = np.maximum(Tmax, np.amax(temp, axis=0))
+            wrep = np.repeat(wchunk, nlayers)
+            for i in np.arange(nq):
+                ibin = np.floor((temp-lo[i])/width[i]) + 1
+                # Values at the upper edge belong to the last bin:
+                ibin[(ibin > nbins) & (temp <= hi[i])] = nbins
+                ibin = np.clip(ibin, 0, nbins+1)
+                hist[i] += np.bincount((ibin.astype(int) + offset).flatten(),
+                                       wrep, nlayers*(nbins+2))
+        cdf = np.cumsum(np.reshape(hist, (nq, nlayers, nbins+2)), axis=2)
+        cdf /= cdf[:,:,-1:]
+        # Quantiles that fall out of their range, use the full range
+        # (only once, the full range always contains them):
+        redo = ((cdf[:,:,0]  >= quantiles[:,np.newaxis]) |
+                (cdf[:,:,-2] <  quantiles[:,np.newaxis])) & ~full
+        lo[redo] = np.tile(Tmin, (nq,1))[redo]
+        hi[redo] = np.tile(Tmax, (nq,1))[redo]
+        full |= redo
+
+    # Interpolate the quantiles in the cumulative distributions:
+    PTquantiles = np.zeros((nq, nlayers))
+    layers = np.arange(nlayers)
+    for i in np.arange(nq):
+        j = np.argmax(cdf[i] >= quantiles[i], axis=1)
+        below = cdf[i, layers, j-1]
+        frac  = (quantiles[i] - below) / (cdf[i, layers, j] - below)
+        PTquantiles[i] = lo[i] + (j - 1 + frac) * width[i]
+    return PTquantiles
+
+
 def callTransit(atmfile, tepfile,  MCfile, stepsize,  molfit,  solution, p0, 
                 tconfig, date_dir, burnin, abun_file, PTtype,  PTfunc, 
                 filters, ctf=None):
@@ -334,7 +437,8 @@ def callTransit(atmfile, tepfile,  MCfile, stepsize,  molfit,  solution, p0,
     burnin = int(burnin)
 
     # read atmfile
-    molecules, pressure, temp, abundances = mat.readatm(atmfile)
+    molecules, pressure, temp, abundances = \
+        mat.readatm(aio.prefer_container(atmfile))
     # get surface gravity
     grav, Rp = mat.get_g(tepfile)
     # get star data if needed
@@ -358,8 +462,13 @@ def callTransit(atmfile, tepfile,  MCfile, stepsize,  molfit,  solution, p0,
 
     PTparams  = allParams[:nPTparams]
 
-    # call PT profile generator to calculate temperature
-    best_T = pt.PT_generator(pressure, PTparams, PTfunc, PTargs)
+    # call PT profile generator to calculate temperature (the batched
+    # generator keeps the layer order of pressure, as for the posterior
+    # profiles below and for the MCMC forward model):
+    best_T = pt.PT_generator_batch(pressure, PTparams, PTfunc, PTargs)[0]
+    if np.any(np.isnan(best_T)):
+        raise ValueError("The best-fitting PT parameters give a "
+                         "non-physical profile.")
 
     # Plot best PT profile
     plt.figure(1)
@@ -396,42 +505,20 @@ def callTransit(atmfile, tepfile,  MCfile, stepsize,  molfit,  solution, p0,
 shell=True, cwd=date_dir)
 
     # ========== plot MCMC PT profiles ==========
-    # get MCMC data:
+    # get MCMC data (unique post-burn-in samples and multiplicity):
     MCMCdata = date_dir + "/output.npy"
-    data = np.load(MCMCdata)
-    nchains, npars, niter = np.shape(data)
+    data = np.load(MCMCdata, mmap_mode='r')
+    samples, weights = unique_samples(data, burnin)
 
-    # stuck chains:
-    data_stack = data[0,:,burnin:]
-    for c in np.arange(1, nchains):
-        data_stack = np.hstack((data_stack, data[c, :, burnin:]))
+    # free PT parameters from the MCMC:
+    ifree = np.where(stepsize[:len(PTparams)] != 0.0)[0]
 
-    # create array of PT profiles
-    PTprofiles = np.zeros((np.shape(data_stack)[1], len(pressure)))
-
-    # current PT parameters for each chain, iteration
-    curr_PTparams = PTparams
-
-    # fill-in PT profiles array
     if ctf is None:
         print("  Plotting MCMC PT profile figure.")
-    for k in np.arange(0, np.shape(data_stack)[1]):
-        j = 0
-        for i in np.arange(len(PTparams)):
-            if stepsize[i] != 0.0:
-                curr_PTparams[i] = data_stack[j,k]
-                j +=1
-            else:
-                pass
-        PTprofiles[k] = pt.PT_generator(pressure, curr_PTparams, 
-                                        PTfunc, PTargs)
-
     # get percentiles (for 1,2-sigma boundaries):
-    low1   = np.percentile(PTprofiles, 16.0, axis=0)
-    hi1    = np.percentile(PTprofiles, 84.0, axis=0)
-    low2   = np.percentile(PTprofiles,  2.5, axis=0)
-    hi2    = np.percentile(PTprofiles, 97.5, axis=0)
-    median = np.median(    PTprofiles,       axis=0)
+    low1, hi1, low2, hi2, median = PT_quantiles(pressure, samples, weights,
+                     PTparams, ifree, PTfunc, PTargs,
+                     [0.16, 0.84, 0.025, 0.975, 0.5])
 
     # plot figure
     plt.figure(2, dpi=300)
@@ -482,7 +569,7 @@ shell=True, cwd=date_dir)
 
 
 def plot_bestFit_Spectrum(filters, kurucz, tepfile, solution, output, data,
-                          uncert, date_dir):
+                          uncert, date_dir, kurucz_interp=False):
     '''
     Plot BART best-model spectrum
 
@@ -496,6 +583,8 @@ def plot_bestFit_Spectrum(filters, kurucz, tepfile, solution, output, data,
     data    : 1D array. Eclipse or transit depths.
     uncert  : 1D array. Uncertainties for data values.
     date_dir: string. Path to directory where the plot will be saved.
+    kurucz_interp: bool. If True, interpolate the Kurucz models instead
+                   of taking the nearest model.
     '''
     # get star data
     R_star, T_star, sma, gstar = get_starData(tepfile)
@@ -510,7 +599,8 @@ def plot_bestFit_Spectrum(filters, kurucz, tepfile, solution, output, data,
     rprs = Rp/R_star
 
     # read kurucz file
-    starfl, starwn, tmodel, gmodel = w.readkurucz(kurucz, T_star, gstar)
+    starfl, starwn, tmodel, gmodel = w.readkurucz(kurucz, T_star, gstar,
+                                                  kurucz_interp)
 
     # read best-fit spectrum output file, take wn and spectra values
     if solution == 'eclipse':
@@ -528,37 +618,28 @@ def plot_bestFit_Spectrum(filters, kurucz, tepfile, solution, output, data,
     # number of filters
     nfilters = len(filters)
 
-    # read and resample the filters:
+    # read and resample the filters (through the filter cache):
+    sinterp   = si.interp1d(starwn, starfl)
     nifilter  = [] # Normalized interpolated filter
     istarfl   = [] # interpolated stellar flux
     wnindices = [] # wavenumber indices used in interpolation
     meanwn    = [] # Filter mean wavenumber
     for i in np.arange(nfilters):
-        # read filter:
-        filtwaven, filttransm = w.readfilter(filters[i])
-        meanwn.append(np.sum(filtwaven*filttransm)/sum(filttransm))
-        # resample filter and stellar spectrum:
-        nifilt, strfl, wnind = w.resample(specwn, filtwaven, filttransm,
-                                          starwn, starfl               )
-        nifilter .append(nifilt)
-        istarfl  .append(strfl)
+        ifilt, wnind, norm, wnrange, mwn = w.filterband(filters[i], specwn)
+        meanwn   .append(mwn)
+        nifilter .append(ifilt/norm)
+        istarfl  .append(sinterp(specwn[wnind]))
         wnindices.append(wnind)
 
     # convert mean wn to mean wl
     meanwl = 1e4/np.asarray(meanwn)
 
     # band-integrate the flux-ratio or modulation:
-    bandflux = np.zeros(nfilters, dtype='d')
-    bandmod  = np.zeros(nfilters, dtype='d')
-    for i in np.arange(nfilters):
-        fluxrat = (bestspectrum[wnindices[i]]/istarfl[i]) * rprs*rprs
-        bandflux[i] = w.bandintegrate(fluxrat, specwn, nifilter[i],
-                                                                 wnindices[i])
-        bandmod[i]  = w.bandintegrate(bestspectrum[wnindices[i]],
-                                            specwn, nifilter[i], wnindices[i])
+    bandflux = w.bandoperator(specwn, nifilter, wnindices,
+                              istarfl, rprs).dot(bestspectrum)
+    bandmod  = w.bandoperator(specwn, nifilter, wnindices).dot(bestspectrum)
 
     # stellar spectrum on specwn:
-    sinterp = si.interp1d(starwn, starfl)
     sflux   = sinterp(specwn)
     frat    = bestspectrum/sflux * rprs * rprs
 
@@ -0,0 +1,382 @@
+# Copyright (C) 2015-2016 University of Central Florida. All rights reserved.
+# BART is under an open-source, reproducible-research license (see LICENSE).
+
+"""
+    Content-addressed file cache for BART.
+
+    Cache entries are named after a hash of the content they derive
+    from, so a modified input file never reuses a stale entry.  The cache
+    directory is set by the BART_CACHE environment variable (default:
+    ~/.cache/BART).  If the directory cannot be created, caching is
+    disabled (cache_dir returns None).
+
+    The file caches (parsed Kurucz models, resampled filters, and the
+    memoized file digests) are used by default, and can be turned off
+    (see enable, and BART's file_cache option).
+
+    The stage cache keeps the output files of the BART setup stages
+    (pressure, abundances, pre-atmosphere, TEA, atmosphere, opacity),
+    keyed by a hash of each stage's inputs (parameters and content of
+    the input files).  It also records which stage produced a file, so
+    that a file left by a previous run is told apart from a file given
+    by the user.
+
+    Functions
+    ---------
+    file_hash:
+          SHA-1 digest of the content of a file.
+    array_hash:
+          SHA-1 digest of the values of an array.
+    file_digest:
+          file_hash memoized by file path, size, and modification time.
+    enable:
+          Enable or disable the file caches.
+    cache_dir:
+          Directory of the cache.
+    file_cache_dir:
+          Directory of the cache, if the file caches are enabled.
+    atomic_save:
+          Save an array into a .npy file, atomically.
+    atomic_write:
+          Write a string into a file, atomically.
+    atomic_savez:
+          Save a set of arrays into a .npz file, atomically.
+    atomic_copy:
+          Copy a file, atomically.
+    link:
+          Link a file (hard link, or symbolic link across file systems).
+    stage_key:
+          Key of a setup stage from its inputs.
+    stage_restore:
+          Copy the cached outputs of a stage.
+    stage_store:
+          Store the outputs of a stage into the cache.
+    origin:
+          Key of the stage that produced a file.
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+
+def file_hash(filename, blocksize=2**20):
+  """
+  Compute the SHA-1 digest of the content of a file.
+
+  Parameters:
+  -----------
+  filename: String
+     File path.
+  blocksize: Integer
+     Number of bytes read at a time.
+
+  Returns:
+  --------
+  digest: String
+     Hexadecimal SHA-1 digest.
+  """
+  sha = hashlib.sha1()
+  f = open(filename, "rb")
+  block = f.read(blocksize)
+  while block:
+    sha.update(block)
+    block = f.read(blocksize)
+  f.close()
+  return sha.hexdigest()
+
+
+def array_hash(array):
+  """
+  Compute the SHA-1 digest of the values (and data type and shape) of
+  an array.
+
+  Parameters:
+  -----------
+  array: ndarray
+     Input array.
+
+  Returns:
+  --------
+  digest: String
+     Hexadecimal SHA-1 digest.
+  """
+  array = np.ascontiguousarray(array)
+  sha = hashlib.sha1(str(array.dtype) + str(array.shape))
+  sha.update(array.tobytes())
+  return sha.hexdigest()
+
+
+def file_digest(filename):
+  """
+  Compute the SHA-1 digest of the content of a file (see file_hash).
+  The digest is memoized in the cache directory by the file path, size,
+  and modification time, so large files (line databases, opacity
+  tables) are read only once.
+
+  Parameters:
+  -----------
+  filename: String
+     File path.
+
+  Returns:
+  --------
+  digest: String
+     Hexadecimal SHA-1 digest.
+  """
+  cdir = file_cache_dir()
+  if cdir is None:
+    return file_hash(filename)
+  stat = os.stat(filename)
+  stamp = hashlib.sha1("{:s} {:d} {:.6f}".format(os.path.realpath(filename),
+                                stat.st_size, stat.st_mtime)).hexdigest()
+  memo = os.path.join(cdir, "digest_{:s}".format(stamp))
+  if os.path.isfile(memo):
+    f = open(memo, "r")
+    digest = f.read().strip()
+    f.close()
+    return digest
+  digest = file_hash(filename)
+  atomic_write(memo, digest)
+  return digest
+
+
+def enable(flag=True):
+  """
+  Enable (or disable) the file caches for this process and for the
+  processes it launches, through the BART_FILE_CACHE environment
+  variable.  They are enabled by default.
+
+  Parameters:
+  -----------
+  flag: Bool
+     If True enable the file caches, else disable them.
+  """
+  os.environ["BART_FILE_CACHE"] = str(bool(flag))
+
+
+def file_cache_dir():
+  """
+  Return the cache directory (see cache_dir), or None if the file caches
+  are disabled (see enable).
+  """
+  if os.environ.get("BART_FILE_CACHE", "True") != "True":
+    return None
+  return cache_dir()
+
+
+def cache_dir():
+  """
+  Return the cache directory (created if needed), or None if it cannot
+  be created.
+  """
+  cdir = os.environ.get("BART_CACHE",
+                        os.path.join(os.path.expanduser("~"), ".cache/BART"))
+  try:
+    os.makedirs(cdir)
+  except OSError:
+    pass
+  if not os.access(cdir, os.W_OK):
+    return None
+  return cdir
+
+
+def atomic_save(filename, array):
+  """
+  Save an array into a .npy file.  The array is written into a
+  temporary file that is then renamed, so that concurrent readers
+  (e.g., other MPI workers) never see a partial file.
+
+  Parameters:
+  -----------
+  filename: String
+     Output .npy file.
+  array: ndarray
+     Array to save.
+  """
+  fd, tmpfile = tempfile.mkstemp(suffix=".npy",
+                                 dir=os.path.dirname(filename))
+  f = os.fdopen(fd, "wb")
+  np.save(f, array)
+  f.close()
+  os.rename(tmpfile, filename)
+
+
+def atomic_write(filename, text):
+  """
+  Write a string into a file, atomically (see atomic_save).
+  """
+  fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(filename))
+  f = os.fdopen(fd, "w")
+  f.write(text)
+  f.close()
+  os.rename(tmpfile, filename)
+
+
+def atomic_copy(src, dst):
+  """
+  Copy the file src into dst, atomically (see atomic_save).
+  """
+  fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst)))
+  os.close(fd)
+  shutil.copy2(src, tmpfile)
+  os.rename(tmpfile, dst)
+
+
+def link(src, dst):
+  """
+  Make dst a hard link to src, or a symbolic link if they lie on
+  different file systems.  An existing dst is replaced atomically.
+
+  Parameters:
+  -----------
+  src: String
+     Existing file.
+  dst: String
+     Link name.
+
+  Returns:
+  --------
+  kind: String
+     'hardlink' or 'symlink'.
+  """
+  # Renaming a hard link onto another link of the same file does nothing
+  # (and would leave the temporary file behind):
+  if os.path.exists(dst) and os.path.samefile(src, dst):
+    return "symlink" if os.path.islink(dst) else "hardlink"
+  tmpfile = "{:s}.tmp{:d}".format(dst, os.getpid())
+  if os.path.lexists(tmpfile):
+    os.remove(tmpfile)
+  try:
+    os.link(src, tmpfile)
+    kind = "hardlink"
+  except OSError:
+    os.symlink(os.path.abspath(src), tmpfile)
+    kind = "symlink"
+  os.rename(tmpfile, dst)
+  return kind
+
+
+def atomic_savez(filename, **arrays):
+  """
+  Save a set of arrays into a .npz file, atomically (see atomic_save).
+
+  Parameters:
+  -----------
+  filename: String
+     Output .npz file.
+  arrays: Keyword arguments
+     Arrays to save.
+  """
+  fd, tmpfile = tempfile.mkstemp(suffix=".npz",
+                                 dir=os.path.dirname(filename))
+  f = os.fdopen(fd, "wb")
+  np.savez(f, **arrays)
+  f.close()
+  os.rename(tmpfile, filename)
+
+
+def stage_key(stage, *inputs):
+  """
+  Compute the key of a setup stage: the SHA-1 digest of the stage name
+  and its inputs.
+
+  Parameters:
+  -----------
+  stage: String
+     Stage name.
+  inputs: Strings, numbers, lists, or ndarrays
+     Stage parameters.  Input files enter through their content digest
+     (see file_digest).
+
+  Returns:
+  --------
+  key: String
+     Hexadecimal SHA-1 digest.
+  """
+  sha = hashlib.sha1(stage)
+  for value in inputs:
+    if isinstance(value, np.ndarray):
+      value = array_hash(value)
+    sha.update("\0" + repr(value))
+  return sha.hexdigest()
+
+
+def stage_files(cdir, key, files):
+  """
+  Names of the cached copies of the output files of a stage.
+  """
+  sdir = os.path.join(cdir, "stage_{:s}".format(key))
+  return [os.path.join(sdir, "{:d}_{:s}".format(i, os.path.basename(name)))
+          for i, name in enumerate(files)]
+
+
+def stage_restore(key, files):
+  """
+  Copy the cached outputs of a stage into files.
+
+  Parameters:
+  -----------
+  key: String
+     Stage key (see stage_key).
+  files: List of strings
+     Output files of the stage.
+
+  Returns:
+  --------
+  restored: Bool
+     True if the cache holds all the outputs (and they were copied).
+  """
+  cdir = cache_dir()
+  if cdir is None:
+    return False
+  cached = stage_files(cdir, key, files)
+  if not np.all([os.path.isfile(cfile) for cfile in cached]):
+    return False
+  for cfile, filename in zip(cached, files):
+    atomic_copy(cfile, filename)
+  return True
+
+
+def stage_store(key, files):
+  """
+  Store the outputs of a stage into the cache, and record their origin.
+
+  Parameters:
+  -----------
+  key: String
+     Stage key (see stage_key).
+  files: List of strings
+     Output files of the stage.
+  """
+  cdir = cache_dir()
+  if cdir is None:
+    return
+  cached = stage_files(cdir, key, files)
+  try:
+    os.makedirs(os.path.dirname(cached[0]))
+  except OSError:
+    pass
+  for cfile, filename in zip(cached, files):
+    atomic_copy(filename, cfile)
+    record = os.path.join(cdir, "origin_{:s}".format(file_digest(cfile)))
+    atomic_write(record, key)
+
+
+def origin(filename):
+  """
+  Return the key of the stage that produced a file with the content of
+  filename, or None if no stage in the cache did.
+  """
+  cdir = cache_dir()
+  if cdir is None:
+    return None
+  record = os.path.join(cdir, "origin_{:s}".format(file_digest(filename)))
+  if not os.path.isfile(record):
+    return None
+  f = open(record, "r")
+  key = f.read().strip()
+  f.close()
+  return key
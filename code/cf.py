@@ -22,7 +22,6 @@ cf:
 """
 
 import numpy as np
-from scipy.interpolate import interp1d
 import os
 import matplotlib
 matplotlib.use('Agg')
@@ -145,17 +144,11 @@ def filter_cf(filters, nlayers, wns, cf, normalize=False):
   filt_cf_norm = np.zeros((len(filters), nlayers))
 
   for i in np.arange(nfilters):
-    # Read filter
-    wn, response = w.readfilter(filters[i])
-
-    # Find where filters starts and ends
-    wn_filt = np.asarray(filter(lambda x: x>min(wn) and x<max(wn), wns))
-    start_filt, stop_filt = np.where(wns==min(wn_filt))[0][0], \
-                            np.where(wns==max(wn_filt))[0][0]
-
-    # Interpolate filter response functions
-    inter_filt = interp1d(wn, response)
-    resp_filt = inter_filt(wn_filt)
+    # Read and interpolate filter response functions (cached), and find
+    # where filters starts and ends:
+    resp_filt, wnind, norm, wnrange, meanwn = w.filterband(filters[i], wns)
+    wn_filt = wns[wnind]
+    start_filt, stop_filt = wnind[0], wnind[-1]
 
     # Extract filter contribution functions
     cf_filt = cf[:, start_filt:stop_filt+1]
@@ -0,0 +1,449 @@
+# Copyright (C) 2015-2016 University of Central Florida. All rights reserved.
+# BART is under an open-source, reproducible-research license (see LICENSE).
+
+"""
+    Emulator-accelerated (delayed-acceptance) MCMC for BART.
+
+    During the burn-in, the chains run a standard Metropolis random walk
+    with the full forward model.  The evaluated models train a cheap
+    surrogate (polyharmonic radial-basis-function interpolation) of the
+    band-integrated fluxes as a function of the free parameters.  After
+    the burn-in, each proposal is first screened with the surrogate, and
+    only the proposals that pass the screen are evaluated with the full
+    forward model.  The second acceptance step corrects for the surrogate
+    error, such that the chains sample the same posterior as the
+    standard Metropolis algorithm (Christen & Fox 2005, JCGS, 14, 795).
+
+    Classes
+    -------
+    Emulator:
+          Radial-basis-function surrogate of the band-integrated fluxes.
+    Serial:
+          Adapter of a forward-model function to the Pool interface.
+
+    Functions
+    ---------
+    chisq:
+          Chi-squared of a set of models.
+    mcmc:
+          Delayed-acceptance Metropolis random walk.
+    run:
+          Run the emulator-accelerated MCMC from a BART MCMC config file.
+"""
+
+import sys, os
+import ConfigParser
+import numpy as np
+import scipy.linalg as la
+
+import mpfunc as mpf
+
+filedir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(filedir + "/../modules/MCcubed/")
+import MCcubed.utils as mu
+
+
+class Emulator:
+  """
+  Radial-basis-function surrogate of the band-integrated fluxes.
+
+  Interpolate the models with a cubic polyharmonic spline (phi(r) = r**3)
+  plus a linear polynomial, on the parameter space scaled by the
+  standard deviation of the training points.  This kernel has no shape
+  parameter to tune.
+
+  Parameters:
+  -----------
+  smooth: Float
+     Smoothing factor added to the kernel diagonal (relative to its
+     largest element) to regularize nearly-duplicated training points.
+
+  Example:
+  --------
+  >>> import emulator as em
+  >>> emu = em.Emulator()
+  >>> emu.fit(trainparams, trainmodels)
+  >>> models = emu(params)
+  """
+  def __init__(self, smooth=1e-10):
+    self.smooth = smooth
+    self.ntrain = 0
+
+  def fit(self, params, models):
+    """
+    Train the surrogate.
+
+    Parameters:
+    -----------
+    params: 2D float ndarray
+       Training parameters of shape (ntrain, nfree).
+    models: 2D float ndarray
+       Training models of shape (ntrain, nfilters).
+    """
+    ntrain, nfree = np.shape(params)
+    self.offset = np.mean(params, axis=0)
+    self.scale  = np.std(params, axis=0)
+    self.scale[self.scale == 0] = 1.0
+    self.points = (params - self.offset) / self.scale
+
+    phi = self.kernel(self.points)
+    phi[np.diag_indices(ntrain)] += self.smooth * np.amax(phi)
+    poly = np.hstack((np.ones((ntrain, 1)), self.points))
+    # Solve the interpolation system [[phi, P], [P^T, 0]] w = [models, 0]:
+    system = np.zeros((ntrain+nfree+1, ntrain+nfree+1))
+    system[:ntrain,:ntrain] = phi
+    system[:ntrain,ntrain:] = poly
+    system[ntrain:,:ntrain] = poly.T
+    rhs = np.zeros((ntrain+nfree+1, np.shape(models)[1]))
+    rhs[:ntrain] = models
+    self.weights = la.solve(system, rhs, assume_a="sym")
+    self.ntrain  = ntrain
+
+  def kernel(self, points):
+    """
+    Cubic kernel between points and the training points.
+    """
+    dist2 = (np.sum(points**2, axis=1)[:,np.newaxis]
+             + np.sum(self.points**2, axis=1)
+             - 2.0*np.dot(points, self.points.T))
+    return np.sqrt(np.clip(dist2, 0.0, None))**3
+
+  def __call__(self, params):
+    """
+    Evaluate the surrogate models.
+
+    Parameters:
+    -----------
+    params: 2D float ndarray
+       Parameters of shape (nmodels, nfree).
+
+    Returns:
+    --------
+    models: 2D float ndarray
+       Surrogate models of shape (nmodels, nfilters).
+    """
+    points = (np.atleast_2d(params) - self.offset) / self.scale
+    poly = np.hstack((np.ones((len(points), 1)), points))
+    return (np.dot(self.kernel(points), self.weights[:self.ntrain])
+            + np.dot(poly, self.weights[self.ntrain:]))
+
+
+def chisq(models, data, uncert):
+  """
+  Chi-squared of a set of models.  Non-physical models (flagged by
+  BARTfunc with values of -1) get an infinite chi-squared.
+
+  Parameters:
+  -----------
+  models: 2D float ndarray
+     Band-integrated models of shape (nmodels, nfilters).
+  data: 1D float ndarray
+     Observed eclipse or transit depths.
+  uncert: 1D float ndarray
+     Uncertainties of data.
+
+  Returns:
+  --------
+  chisq: 1D float ndarray
+     Chi-squared of each model.
+  """
+  chisq = np.sum(((models - data)/uncert)**2, axis=1)
+  chisq[np.all(models == -1.0, axis=1)] = np.inf
+  return chisq
+
+
+class Serial:
+  """
+  Adapter of a forward-model function to the asynchronous interface of
+  mpfunc.Pool (submit and collect), for functions without it: the
+  models are evaluated at submit.
+
+  Parameters:
+  -----------
+  func: Callable
+     Forward model, takes a 2D array of parameters (nmodels, npars) and
+     returns the 2D array of band-integrated models.
+  """
+  def __init__(self, func):
+    self.func = func
+
+  def submit(self, params):
+    return self.func(params)
+
+  def collect(self, job):
+    return job
+
+
+def mcmc(func, data, uncert, params, pmin, pmax, stepsize, numit, nchains,
+         burnin, prior=None, priorlow=None, priorup=None, ntrain=1000,
+         verb=1):
+  """
+  Delayed-acceptance Metropolis random walk.
+
+  Parameters:
+  -----------
+  func: Callable
+     Forward model, takes a 2D array of parameters (nmodels, npars) and
+     returns the 2D array of band-integrated models (e.g., mpfunc.Pool).
+     If it has the submit and collect methods of mpfunc.Pool, the full
+     models of one half of the chains are evaluated while the other
+     half proposes and screens its next step.
+  data: 1D float ndarray
+     Observed eclipse or transit depths.
+  uncert: 1D float ndarray
+     Uncertainties of data.
+  params: 1D float ndarray
+     Initial parameters.
+  pmin: 1D float ndarray
+     Lower boundaries of the parameters.
+  pmax: 1D float ndarray
+     Upper boundaries of the parameters.
+  stepsize: 1D float ndarray
+     Random-walk step size of the parameters.  Zero values keep a
+     parameter fixed, a negative value -n shares the value of the
+     n-th parameter (as in MC3).
+  numit: Integer
+     Total number of iterations (over all chains).
+  nchains: Integer
+     Number of parallel chains.
+  burnin: Integer
+     Number of burn-in iterations per chain (full-model Metropolis,
+     used to train the surrogate).
+  prior: 1D float ndarray
+     Gaussian-prior centers (used where priorlow is non-zero).
+  priorlow: 1D float ndarray
+     Lower Gaussian-prior uncertainties (zero for uniform priors).
+  priorup: 1D float ndarray
+     Upper Gaussian-prior uncertainties.
+  ntrain: Integer
+     Maximum number of models to train the surrogate.
+  verb: Integer
+     Verbosity level.
+
+  Returns:
+  --------
+  allparams: 3D float ndarray
+     Free-parameter chains of shape (nchains, nfree, niter).
+  bestp: 1D float ndarray
+     Best-fitting parameters.
+  bestchisq: Float
+     Chi-squared of bestp.
+  ncalls: 1D integer ndarray
+     Number of full-model evaluations during and after the burn-in.
+  """
+  npars  = len(params)
+  niter  = int(numit / nchains)
+  ifree  = np.where(stepsize > 0)[0]
+  ishare = np.where(stepsize < 0)[0]
+  nfree  = len(ifree)
+  if prior is None:
+    prior, priorlow, priorup = np.zeros((3, npars))
+  iprior = np.where(priorlow[ifree] != 0)[0]
+
+  def penalty(free):
+    # Gaussian-prior chi-squared term:
+    dprior = free[:,iprior] - prior[ifree][iprior]
+    sigma  = np.where(dprior < 0, priorlow[ifree][iprior],
+                                  priorup [ifree][iprior])
+    return np.sum((dprior/sigma)**2, axis=1)
+
+  def expand(free):
+    # Full parameter arrays from the free parameters:
+    full = np.tile(params, (len(free), 1))
+    full[:,ifree] = free
+    full[:,ishare] = full[:,-np.asarray(stepsize[ishare], int)-1]
+    return full
+
+  allparams = np.zeros((nchains, nfree, niter))
+  ncalls = np.zeros(2, int)
+  trainp, trainm = [], []
+
+  # Initial state (first chain at params, the others scattered around):
+  current = np.tile(params[ifree], (nchains, 1))
+  current[1:] += np.random.normal(0, stepsize[ifree], (nchains-1, nfree))
+  current = np.clip(current, pmin[ifree], pmax[ifree])
+  models  = func(expand(current))
+  ncalls[0] += nchains
+  cchisq  = chisq(models, data, uncert) + penalty(current)
+  if np.any(np.isinf(cchisq)):
+    mu.error("The initial parameters of some chains give non-physical "
+             "models, adjust params or stepsize.")
+  bestchisq = np.amin(cchisq)
+  bestp     = current[np.argmin(cchisq)]
+
+  # The chains run in two groups: the full models of one group are
+  # evaluated while the other group proposes and screens its next step
+  # (with an asynchronous func, see Serial and mpfunc.Pool.submit):
+  if not hasattr(func, "submit"):
+    func = Serial(func)
+  groups = [group for group in np.array_split(np.arange(nchains), 2)
+            if len(group) > 0]
+  emu  = [None]
+  semu = np.zeros(nchains)  # Surrogate chi-squared of the current state
+
+  def propose(chains, i):
+    # Propose the next step of a group of chains, screen it with the
+    # surrogate (after the burn-in), and submit the full models:
+    proposed = current[chains] + np.random.normal(0, stepsize[ifree],
+                                                  (len(chains), nfree))
+    inside = np.where(np.all((proposed >= pmin[ifree]) &
+                             (proposed <= pmax[ifree]), axis=1))[0]
+    pchisq = penalty(proposed)
+    evaluate, pemu = inside, None
+    if i >= burnin and len(inside) > 0:
+      # First stage, screen the proposals with the surrogate:
+      pemu = chisq(emu[0](proposed[inside]), data, uncert) + pchisq[inside]
+      logu = np.log(np.random.uniform(size=len(inside)))
+      passed = logu < -0.5*(pemu - semu[chains[inside]])
+      evaluate, pemu = inside[passed], pemu[passed]
+    job = None
+    if len(evaluate) > 0:
+      job = func.submit(expand(proposed[evaluate]))
+    return proposed, pchisq, evaluate, pemu, job
+
+  def finish(chains, i, proposal):
+    # Collect the full models of a group of chains and accept or reject
+    # its proposals:
+    proposed, pchisq, evaluate, pemu, job = proposal
+    accept = np.zeros(len(chains), bool)
+    if job is not None:
+      models = func.collect(job)
+      pchisq[evaluate] += chisq(models, data, uncert)
+      dchisq = pchisq[evaluate] - cchisq[chains[evaluate]]
+      logu = np.log(np.random.uniform(size=len(evaluate)))
+      if i < burnin:
+        # Standard Metropolis with the full model:
+        ncalls[0] += len(evaluate)
+        valid = np.all(models != -1.0, axis=1)
+        trainp.extend(proposed[evaluate][valid])
+        trainm.extend(models[valid])
+        accept[evaluate] = logu < -0.5*dchisq
+      else:
+        # Second stage, correct for the surrogate error:
+        ncalls[1] += len(evaluate)
+        accept[evaluate] = logu < (-0.5*dchisq
+                                   +0.5*(pemu - semu[chains[evaluate]]))
+        semu[chains[evaluate[accept[evaluate]]]] = pemu[accept[evaluate]]
+    current[chains[accept]] = proposed[accept]
+    cchisq [chains[accept]] = pchisq[accept]
+    allparams[chains,:,i] = current[chains]
+
+  # Burn-in, then the surrogate-screened phase:
+  for first, last in [(0, min(burnin, niter)), (min(burnin, niter), niter)]:
+    if first == last:
+      continue
+    if first == burnin:
+      # Train the surrogate with (a subsample of) the burn-in models:
+      trainp, trainm = np.asarray(trainp), np.asarray(trainm)
+      uniq = np.unique(trainp, axis=0, return_index=True)[1]
+      if len(uniq) == 0:
+        mu.error("There are no valid burn-in models to train the emulator.")
+      if len(uniq) > ntrain:
+        uniq = np.random.choice(uniq, ntrain, replace=False)
+      emu[0] = Emulator()
+      emu[0].fit(trainp[uniq], trainm[uniq])
+      mu.msg(verb, "Trained the emulator with {:d} models.".
+                    format(emu[0].ntrain), indent=2)
+      # Surrogate chi-squared (including priors) of the current state:
+      semu[:] = chisq(emu[0](current), data, uncert) + penalty(current)
+
+    proposals = [propose(chains, first) for chains in groups]
+    for i in np.arange(first, last):
+      for g in np.arange(len(groups)):
+        finish(groups[g], i, proposals[g])
+        if i+1 < last:
+          proposals[g] = propose(groups[g], i+1)
+
+      if np.amin(cchisq) < bestchisq:
+        bestchisq = np.amin(cchisq)
+        bestp     = np.copy(current[np.argmin(cchisq)])
+
+      if verb and (i+1) % max(niter/10, 1) == 0:
+        mu.msg(verb, "{:3.0f}% completed, best chi-squared: {:.4f}, model "
+               "calls: {:d}.".format(100.0*(i+1)/niter, bestchisq,
+                                     np.sum(ncalls)), indent=2)
+
+  return allparams, expand(bestp[np.newaxis])[0], bestchisq, ncalls
+
+
+def run(cfile, nworkers=None, nbatch=1, ntrain=1000):
+  """
+  Run the emulator-accelerated MCMC from a BART MCMC configuration file
+  (as generated by makecfg.makeMCMC).  Save the chains into loc_dir as
+  output.npy and the best-fitting parameters into logfile, in the MC3
+  formats read by the BART post-processing routines.
+
+  Parameters:
+  -----------
+  cfile: String
+     MCMC configuration file.
+  nworkers: Integer
+     Number of forward-model worker processes.
+  nbatch: Integer
+     Number of models per worker task.
+  ntrain: Integer
+     Maximum number of models to train the surrogate.
+  """
+  config = ConfigParser.SafeConfigParser()
+  config.optionxform = str
+  config.read([cfile])
+  section = "MCMC"
+  get = lambda key: mu.parray(config.get(section, key))
+
+  params   = get("params")
+  pmin     = get("pmin")
+  pmax     = get("pmax")
+  stepsize = get("stepsize")
+  data     = get("data")
+  uncert   = get("uncert")
+  numit    = int(config.get(section, "numit"))
+  nchains  = int(config.get(section, "nchains"))
+  burnin   = int(config.get(section, "burnin"))
+  loc_dir  = config.get(section, "loc_dir")
+  logfile  = config.get(section, "logfile")
+  prior, priorlow, priorup = None, None, None
+  if config.has_option(section, "prior"):
+    prior, priorlow, priorup = get("prior"), get("priorlow"), get("priorup")
+
+  # Each submission holds up to one half of the chains:
+  pool = mpf.Pool(cfile, nworkers, nmodels=nchains, nbatch=nbatch)
+  try:
+    allparams, bestp, bestchisq, ncalls = mcmc(pool, data, uncert, params,
+          pmin, pmax, stepsize, numit, nchains, burnin, prior, priorlow,
+          priorup, ntrain)
+    # Busy, queue-wait, and between-submission time of the workers:
+    pool.report()
+  finally:
+    pool.close()
+  np.save(loc_dir + "/output.npy", allparams)
+
+  # Posterior statistics of the free and shared parameters:
+  ifree = stepsize > 0
+  posterior = np.swapaxes(allparams[:,:,burnin:], 0, 1)
+  posterior = np.reshape(posterior, (np.sum(ifree), -1))
+  std  = np.zeros(len(params))
+  mean = np.copy(bestp)
+  std [ifree] = np.std (posterior, axis=1)
+  mean[ifree] = np.mean(posterior, axis=1)
+  ishare = np.where(stepsize < 0)[0]
+  std [ishare] = std [-np.asarray(stepsize[ishare], int)-1]
+  mean[ishare] = mean[-np.asarray(stepsize[ishare], int)-1]
+
+  niter = allparams.shape[2]
+  log = open(logfile, "w")
+  log.write("\n Emulator-accelerated MCMC (delayed acceptance)\n"
+            "\n Full-model calls during burn-in:    {:d}"
+            "\n Full-model calls after burn-in:     {:d}"
+            "\n Proposals after burn-in:            {:d}\n"
+            "\n Best-parameter's chi-squared:       {:.4f}\n\n".format(
+            ncalls[0], ncalls[1], nchains*(niter-burnin), bestchisq))
+  log.write(" Best-fit params   Uncertainties   Signal/Noise       "
+            "Sample Mean\n")
+  for i in np.where(stepsize != 0)[0]:
+    log.write(" {: 15.7e}  {:15.7e}   {:12.2f}   {: 15.7e}\n".format(
+              bestp[i], std[i], np.abs(bestp[i])/std[i], mean[i]))
+  log.write("\n")
+  log.close()
+  mu.msg(1, "Full-model calls: {:d} during burn-in, {:d} for {:d} proposals "
+         "after burn-in.".format(ncalls[0], ncalls[1],
+                                 nchains*(niter-burnin)), indent=2)
@@ -1,162 +1,190 @@
 # Copyright (C) 2015-2016 University of Central Florida. All rights reserved.
 # BART is under an open-source, reproducible-research license (see LICENSE).
 
+import os
 import numpy as np
-import scipy.interpolate as si
 import scipy.constants   as sc
 
-def interp(inten, grav, temp, wgrav, wtemp, log=False, kf=False):
+import cache
+
+def grid(grav, temp):
   """
- NAME:
-  INTERP
-
- PURPOSE:
-  This function finds the brightness spectrum of a star by
-  interpolating temperature and gravity in a grid of Kurucz
-  models.  Wavelengths/frequencies are not interpolated.
-
- CATEGORY:
-  Astronomy
-
- CALLING SEQUENCE:
-
-  Result = INTERP(Inten, Grav, Temp, Wgrav, Wtemp)
-
- INPUTS:
-  Inten:  [nwavl, nmod] array of model brightnesses
-    (erg cm-2 s-1 sr-1 Hz-1).
-
-  Grav:  [nmod] array of the base-10 log of stellar surface
-    gravities for the models (cm s-2).
-
-  Temp:  [nmod] array of temperatures for the models (K).
-
-  Wgrav:  Wanted log(gravity) (cm s-2).
-
-  Wtemp:  Wanted temperature (K).
-
- KEYWORD PARAMETERS:
-  LOG:  If set, interpolate in the log.
-  KF:  [nwavl, ngrav, ntemp] array of Kurucz models (returned)
-    (returned, erg cm-2 s-1 sr-1 Hz-1).
-
- OUTPUTS:
-  This function returns an [nwavl] array of brightnesses
-  (erg cm-2 s-1 sr-1 Hz-1).
-
- PROCEDURE:
-  Uses cubic convolution in 2D, done explicitly at each
-  wavelength.  Note that /log makes very little difference (see
-  example).
-
-  Kurucz's modeled grav and temp do not cover a rectangular
-  grid, since he does not calculate low gravities for large
-  stars that never have them.  The code currently just takes the
-  rectangular region filled by his cooler models and makes a
-  grid out of them, ignoring the rest.  If your parameters are
-  too close to the edge of this grid, the code warns and exits.
-  It will not be hard to recode to accomodate more models.
-
- EXAMPLE:
-  ;Example is still in IDL:
-  inten = kurucz_inten_read('fp00ak2odfnew.pck', $
-        wave, grav, temp, nainten, head)
-  ; find the Sun's spectrum
-  wgrav = 4.44d ; log(cm s-2)
-  wtemp = 5770d ; Kelvins
-  kinten = kurucz_inten_interp(inten, grav, temp, wgrav, wtemp)
-  c     = 2.99792458d8 ; speed of light in m/s
-  freq  = reverse(c / wave)
-  fsun  = reverse(kinten)
-  plot, freq, fsun, /xlog, $
-    xtitle='Frequency (Hz)', ytitle='I (W m-2 sr-1 Hz-1)'
-
-  ; find the Sun's luminosity
-  ; extra factor of !dpi converts brightness to flux
-  print, int_tabulated(freq, fsun, /d) * !dpi * 4d * !dpi * 6.96d8^2
-  ;   3.8392897e+26
-
-  ; Compare to blackbody...
-  pf = planckfreq(freq, wtemp) / !dpi * 1d-7 * 1d4 ; flux -> inten., MKS
-  plot, freq, fsun, /xlog, $
-    xtitle='Frequency (Hz)', ytitle='I (W m-2 sr-1 Hz-1)'
-  oplot, freq, pf
-  print, int_tabulated(freq, pf, /d) * !dpi * 4d * !dpi * 6.96d8^2
-  ;   3.8260749e+26
-
-  ; check the ratio
-  irat = fsun / pf
-  plot, freq, irat, /xlog, $
-    xtitle='Frequency (Hz)', ytitle='Ikurucz / Iplanck'
-
-  ; how much difference does log interpolation make?
-  kinten2 = kurucz_inten_interp(inten, grav, temp, wgrav, wtemp, /log)
-  afd = abs( (kinten-kinten2) / ((kinten+kinten2) / 2) )
-  plot, wave, afd[where(kinten gt max(kinten) * 1e-2)], /xlog, /ylog
-
-  For the sun, the fractional difference is 2e-3 or better for
-  brightnesses greater than 1% of the peak, except for one spike
-  to 5e-3.  Differences longward of 0.1 um are below 5e-5 and
-  fall rapidly with increasing wavelength.
-
- MODIFICATION HISTORY:
-   Written by:  Joseph Harrington, Cornell.  2006-02-02
-      jh@oobleck.astro.cornell.edu
-  2006-02-03 jh  Swapped wgrav and wtemp in calling order to
-      match grav and temp.  Updated example for
-      change of kurucz_flux_read to MKS.
-  2006-02-10 jh  Fixed example, added kf keyword, changed name
-      to kurucz_inten_interp.
-  2006-02-11 jh  Header tweak.
-  2006-02-12 jh  Converted variable names flux -> inten.
-      Changed messages to printed warnings, since
-      they make Monte Carlo trials bomb.
-  2008-08-11 kevin
-      Converted to Python
+  Map the (possibly ragged) grid of Kurucz models onto a rectangular
+  table of temperatures and gravities.
+
+  Parameters:
+  -----------
+  grav: 1D ndarray
+     Log10 of the surface gravity of each model.
+  temp: 1D ndarray
+     Temperature of each model.
+
+  Returns:
+  --------
+  tgrid: 1D ndarray
+     Sorted unique temperatures.
+  ggrid: 1D ndarray
+     Sorted unique gravities.
+  imodel: 2D integer ndarray
+     Array of shape (ntemp, ngrav) with the index of the model at each
+     temperature and gravity (-1 where there is no model).
   """
+  tgrid, it = np.unique(temp, return_inverse=True)
+  ggrid, ig = np.unique(grav, return_inverse=True)
+  imodel = np.tile(-1, (len(tgrid), len(ggrid)))
+  imodel[it, ig] = np.arange(len(temp))
+  return tgrid, ggrid, imodel
 
-  dim    = inten.shape
-  nwav   = dim[1]
-  iinten = np.zeros(nwav)
-  
-  # FINDME: HARDWIRED!
-  ilograv = 0
-  ihigrav = 10 # the full range of gravities
-  ilotemp = 0
-  ihitemp = 16 # the temp where Kurucz starts skipping gravities
-  ngrav = ihigrav - ilograv + 1
-  ntemp = ihitemp - ilotemp + 1
-  
-  kg = grav[ilograv:ihigrav+1]
-  it = np.arange(ntemp) * ngrav + ilotemp
-  kt = temp[it]
-  
-  # FINDME: this only works if the low indices are both 0 and we're not
-  # at temps where Kurucz starts skipping gravities...
-  if kg[ihigrav] < wgrav:   
-    print('kurucz_inten.interp: wgrav ' + str(wgrav) +
-          ' higher than ' + str(kg[ihigrav]) +
-          ', see FINDME in code to fix.')
-  if kt[ihitemp] < wtemp:   
-    print('kurucz_inten.interp: wtemp ' + str(wtemp) +
-          ' higher than ' + str(kt[ihitemp]) +
-          ', see FINDME in code to fix.')
-  kf = np.reshape(inten[0:ngrav*ntemp, :], (ntemp, ngrav, nwav))
-
-  # Calculate the indices of the parameters we want:
-  itemp, igrav = np.mgrid[kt[0]:kt[-1]+1:250, kg[0]:kg[-1]+0.1:0.5]
+
+def stencil(x, x0, order=3):
+  """
+  Lagrange-interpolation stencil of a sorted array at x0.
+
+  Parameters:
+  -----------
+  x: 1D ndarray
+     Sorted sampling points.
+  x0: Float
+     Interpolation point.
+  order: Integer
+     Polynomial order (1: linear, 3: cubic).  Reduced if x has fewer
+     than order+1 points.
+
+  Returns:
+  --------
+  index: 1D integer ndarray
+     Indices of the stencil points in x.
+  weights: 1D ndarray
+     Interpolation weights of the stencil points (None, None if x0 is
+     outside the range of x).
+  """
+  n = len(x)
+  if n == 0 or x0 < x[0] or x0 > x[-1]:
+    return None, None
+  npts  = min(order+1, n)
+  i     = np.searchsorted(x, x0, side="right") - 1
+  first = min(max(i - (npts-1)/2, 0), n - npts)
+  index = np.arange(first, first+npts)
+  weights = np.ones(npts)
+  for j in np.arange(npts):
+    for k in np.arange(npts):
+      if k != j:
+        weights[j] *= (x0 - x[index[k]]) / (x[index[j]] - x[index[k]])
+  return index, weights
+
+
+def interp(inten, grav, temp, wgrav, wtemp, log=False, order=3):
+  """
+  Compute the brightness spectrum of a star by interpolating a grid of
+  Kurucz models in temperature and gravity.  Wavelengths/frequencies
+  are not interpolated.
+
+  Parameters:
+  -----------
+  inten: 2D ndarray
+     Array of shape (nmod, nwavl) of model brightnesses.
+  grav: 1D ndarray
+     Array of size nmod with the log10 of the surface gravity of the
+     models (g in cm s-2).
+  temp: 1D ndarray
+     Array of size nmod with the temperature of the models (K).
+  wgrav: Float
+     Wanted log10(gravity) (cm s-2).
+  wtemp: Float
+     Wanted temperature (K).
+  log: Boolean
+     If True, interpolate the log of the brightnesses.
+  order: Integer
+     Interpolation order in temperature and gravity (1: linear,
+     3: cubic).
+
+  Returns:
+  --------
+  iinten: 1D ndarray
+     Array of size nwavl of interpolated brightnesses (same units as
+     inten).
+
+  Notes:
+  ------
+  The spectrum is a tensor-product Lagrange interpolation: a weight
+  per model (non-zero only for the (order+1)**2 models of the stencil
+  around (wtemp, wgrav)) times the model spectra, evaluated for all
+  wavelengths at once.  At a grid point the weights select the model
+  spectrum exactly.
+
+  Kurucz's grid is not rectangular, he does not calculate low gravities
+  for hot stars.  The gravity stencil is chosen among the gravities
+  available at each temperature, and the temperature stencil among the
+  temperatures whose gravities cover wgrav.  A ValueError is raised if
+  (wtemp, wgrav) lies outside the grid.
+
+  Example:
+  --------
+  >>> import kurucz_inten as ki
+  >>> inten, wave, grav, temp, nainten, head = ki.read(kfile, freq=True)
+  >>> # The Sun's spectrum:
+  >>> fsun = ki.interp(inten, grav, temp, 4.44, 5770.0)
+  >>> # Luminosity (the first pi converts from brightness to flux):
+  >>> print(np.trapz(fsun, wave) * np.pi * 4 * np.pi * 6.96e8**2)
+
+  Modification History:
+  ---------------------
+  2006-02-02  jh        Written by Joseph Harrington, Cornell.
+                                               jh@oobleck.astro.cornell.edu
+  2006-02-12  jh        Changed messages to printed warnings, since
+                        they make Monte Carlo trials bomb.
+  2008-08-11  kevin     Converted to Python.
+  """
+  tgrid, ggrid, imodel = grid(grav, temp)
+
+  # Gravity stencil at each temperature:
+  gindex  = []
+  gweight = []
+  for i in np.arange(len(tgrid)):
+    available = np.where(imodel[i] >= 0)[0]
+    index, weights = stencil(ggrid[available], wgrav, order)
+    gindex.append(None if index is None else imodel[i, available[index]])
+    gweight.append(weights)
+
+  # Temperature stencil among the temperatures that cover wgrav:
+  covered = np.array([index is not None for index in gindex])
+  tindex, tweights = stencil(tgrid[covered], wtemp, order)
+  if tindex is None:
+    raise ValueError("Requested temperature ({:.1f} K) and log(g) ({:.2f}) "
+                     "lie outside the grid of Kurucz models.".
+                     format(wtemp, wgrav))
+  tindex = np.where(covered)[0][tindex]
+
+  # Weight per model:
+  models  = np.concatenate([gindex[i] for i in tindex])
+  weights = np.concatenate([tw * gweight[i]
+                            for i, tw in zip(tindex, tweights)])
 
   if log:
-    kf = np.log(kf)
+    logint = np.log(np.clip(inten[models], np.finfo(float).tiny, np.inf))
+    return np.exp(np.dot(weights, logint))
+  return np.dot(weights, inten[models])
 
-  for i in np.arange(nwav):
-    tck = si.bisplrep(itemp, igrav, kf[:,:,i], kx=3, ky=3)
-    iinten[i] = si.bisplev(wtemp, wgrav, tck)
 
-  if log:   
-    iinten = exp(iinten)
+def fixed_width(string, width=10):
+  """
+  Convert a string of concatenated fixed-width numeric fields into a
+  float array (in bulk, same values as float() of each field).
 
-  return iinten
+  Parameters:
+  -----------
+  string: String
+     Concatenated fields.
+  width: Integer
+     Number of characters per field.
+
+  Returns:
+  --------
+  values: 1D float ndarray
+     The field values.
+  """
+  nfields = len(string) / width
+  return np.frombuffer(string, "S{:d}".format(width), nfields).astype(float)
 
 
 def read(filename, freq=False):
@@ -259,34 +287,18 @@ def read(filename, freq=False):
 
   # Get, parse, and count header lines:
   # Record effective temperatures and gravities:
-  head      = []
-  temp      = np.zeros(len(filetxt))
-  grav      = np.zeros(len(filetxt))-1
-  header    = np.zeros(len(filetxt), int)
-  startwave = 0
-  for i in np.arange(len(filetxt)):
-    if filetxt[i].startswith("TEFF"):
-      head.append(filetxt[i])
-      temp[i]   = float(filetxt[i][ 5:12])
-      grav[i]   = float(filetxt[i][22:29])
-      header[i] = i
-    elif filetxt[i].endswith("END"):
-      startwave = i + 1
-
-  temp   = temp  [np.where(temp   !=  0)]
-  grav   = grav  [np.where(grav   != -1)]
-  header = header[np.where(header !=  0)]
+  header = np.array([i for i, line in enumerate(filetxt)
+                     if line.startswith("TEFF")], int)
+  head   = [filetxt[i] for i in header]
+  temp   = np.array([float(line[ 5:12]) for line in head])
+  grav   = np.array([float(line[22:29]) for line in head])
+  startwave = [i for i in np.arange(header[0]) if filetxt[i].endswith("END")]
+  startwave = startwave[-1] + 1 if len(startwave) > 0 else 0
   nmod   = header.size
   nline  = (header[2] - header[1] - 1) / 2  # Omit the header line itself
 
-  # Read and count wavelengths:
-  wave = np.zeros(header[0]*len(filetxt[startwave])/10)
-  k = 0
-  string = ''.join(filetxt[startwave:header[0]])
-  for j in np.arange(0, len(string), 10):
-    wave[k] = float(string[j:j+10])
-    k += 1
-
+  # Read wavelengths (fixed-width fields of 10 characters):
+  wave = fixed_width(''.join(filetxt[startwave:header[0]]))
   wave = wave[np.where(wave != 0)] * 1e-9  # Convert nm to meters
   nwavl = wave.size
 
@@ -296,13 +308,12 @@ def read(filename, freq=False):
 
   #LOOP OVER MODELS
   for i in range(0, nmod):
-    k = 0
     string1 = ''.join(filetxt[header[i]+1      :header[i]+nline+1  ])
     string2 = ''.join(filetxt[header[i]+nline+1:header[i]+2*nline+1])
-    for j in range(0,len(string1),10):
-      inten[i,k]   = float(string1[j:j+10])
-      nainten[i,k] = float(string2[j:j+10])
-      k += 1
+    values1 = fixed_width(string1)
+    values2 = fixed_width(string2)
+    inten  [i,:len(values1)] = values1
+    nainten[i,:len(values2)] = values2
 
   # Convert Eddington fluxes to brightnesses, CGS (erg cm-2) -> MKS (J m-2)
   inten   *= 4.0 * 1e-3
@@ -315,3 +326,60 @@ def read(filename, freq=False):
     nainten = np.fliplr(nainten)
   
   return inten, wave, grav, temp, nainten, head
+
+
+def load(filename, freq=False):
+  """
+  Load a Kurucz file through a binary cache.  The first call parses
+  the file with read() and stores the models into the BART cache
+  directory (see cache.py), keyed by the SHA-1 digest of the file (see
+  cache.file_digest): an .npy file with the intensities (memory-mapped
+  when loaded) and an .npz header with the wavelengths, gravities,
+  temperatures, and model headers.  Later calls on a file with the same
+  content load the cache without parsing.  If the file caches are
+  disabled (see cache.enable), just call read().
+
+  Parameters:
+  -----------
+  filename: String
+     Name of model file.
+  freq: Boolean
+     If True, reverse first dimension of model grid and return frequencies
+     instead of wavelengths in Wave.
+
+  Returns:
+  --------
+  The same as read().  inten and nainten are read-only memory-mapped
+  arrays (when the cache is enabled).
+
+  Example:
+  --------
+  >>> import kurucz_inten as ki
+  >>> kfile = '/home/esp01/ancil/kurucz/fp00ak2odfnew.pck'
+  >>> inten, freq, grav, temp, nainten, head = ki.load(kfile, freq=True)
+  """
+  cdir = cache.file_cache_dir()
+  if cdir is None:
+    return read(filename, freq)
+
+  base = os.path.join(cdir, "kurucz_" + cache.file_digest(filename))
+  if not os.path.isfile(base + ".npz"):
+    inten, wave, grav, temp, nainten, head = read(filename)
+    cache.atomic_save(base + ".npy", np.array([inten, nainten]))
+    # The header goes last, it flags a complete entry:
+    cache.atomic_savez(base + ".npz", wave=wave, grav=grav, temp=temp,
+                       head=np.asarray(head))
+
+  models = np.load(base + ".npy", mmap_mode="r")
+  inten, nainten = models[0], models[1]
+  with np.load(base + ".npz") as header:
+    wave, grav, temp = header["wave"], header["grav"], header["temp"]
+    head = list(header["head"])
+
+  # Convert to frequency if requested:
+  if freq:
+    wave    = np.flipud(sc.c / wave)
+    inten   = np.fliplr(inten)
+    nainten = np.fliplr(nainten)
+
+  return inten, wave, grav, temp, nainten, head
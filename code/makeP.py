@@ -18,14 +18,17 @@ def makeP(n_layers, p_top, p_bottom, filename, log=True):
     p_bottom: Float
        Pressure at the bottom of the atmopshere (in bars).
     filename: String
-       Name of the ASCII file to be produced.
+       Name of the ASCII file to be produced (if None, do not write a
+       file).
     log: Boolean
        If True, logarithmic sampling of the pressure range is chosen,
        else linear.
 
     Returns:
     --------
-    None
+    pressure: 1D float ndarray
+       The pressure array, as stored in the file (with 5 significant
+       digits).
 
     Developers:
     -----------
@@ -46,15 +49,21 @@ def makeP(n_layers, p_top, p_bottom, filename, log=True):
     else:
       pres = np.linspace(p_top, p_bottom, n_layers)   
 
-    # Header line
-    header = "Layer  P (bar)\n"
+    # Pressure values as written in the file:
+    values = ["{:.4e}".format(p) for p in pres]
 
-    # Open file to write
-    f = open(str(filename), 'w')
-    f.write(header)
+    if filename is not None:
+      # Header line
+      header = "Layer  P (bar)\n"
 
-    # Write layer index number and pressure
-    for i in np.arange(n_layers):
-      f.write("{:5d}  {:.4e}\n".format(i+1, pres[i]))
-    f.close()
+      # Open file to write
+      f = open(str(filename), 'w')
+      f.write(header)
+
+      # Write layer index number and pressure
+      for i in np.arange(n_layers):
+        f.write("{:5d}  {:s}\n".format(i+1, values[i]))
+      f.close()
+
+    return np.asarray(values, np.double)
 
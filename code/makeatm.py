@@ -6,11 +6,11 @@ import shutil
 import re
 import numpy as np
 import scipy.constants as sc
-from scipy.interpolate import interp1d
 
 import PT        as pt
 import reader    as rd
 import constants as c
+import atmio     as aio
 
 """
     This code produces a pre-atm file in the format that TEA can read it.
@@ -26,10 +26,17 @@ import constants as c
     radpress:
           Calculates the radii for each layer given planetary surface gravity
           and the pressure, temperature, and mean-molecular-mass arrays.
+    radpress_batch:
+          Same as radpress for a set of temperature and mean-molecular-mass
+          profiles.
     readAbun:
           Trims the elemental data of interest from 'abundances.txt' file.
     stoich:
           Calculates stoichiometric values of output species.
+    stoich_matrix:
+          Stoichiometry matrix of a list of species.
+    molar_mass:
+          Molar mass of a list of species (memoized).
     mean_molar_mass:
           Calculates mean molecular mass of all output species.
     makeRadius:
@@ -199,62 +206,98 @@ def radpress(pressure, temperature, mu, p0, R0, g):
      Reference radius level in km.
   g: Float
      Atmospheric gravity in m s-2.
+
+  Returns:
+  --------
+  rad: 1D float ndarray
+     Atmospheric layers' radius (same units as R0).
   """
-  # Number of layers in the atmosphere:
-  n = len(pressure)
+  return radpress_batch(pressure, np.atleast_2d(temperature),
+                        np.atleast_2d(mu), p0, R0, g)[0]
 
-  # Allocate array of radii:
-  rad = np.zeros(n)
 
-  # Interpolate temp and mu in lin-log space (1bar)
-  interPT = interp1d(np.log10(pressure), temperature)
-  intermu = interp1d(np.log10(pressure), mu)
+def radpress_batch(pressure, temperature, mu, p0, R0, g):
+  """
+  Calculate the radii of the atmospheric layers of a set of
+  temperature and mean-molecular-mass profiles (see radpress).
+  The hypsometric equation is integrated with the trapezoidal rule
+  (cumulative sums) upwards and downwards from the layer closest to p0.
 
-  # Get temp and mu at surface pressure (1bar)
-  try:
-    temp_1bar = interPT(np.log10(p0))
-    mu_1bar   = intermu(np.log10(p0))
-  except IOError:
-    print("Referenced surface pressure of {:.3e} bar is not in the "
-          "range of pressures: [{}, {}] bar.".
-           format(p0, np.amin(pressure), np.amax(pressure)))
+  Parameters:
+  -----------
+  pressure: 1D float ndarray
+     Atmospheric layers' pressure in bars.
+  temperature: 2D float ndarray
+     Array of shape (nprofiles, nlayers) with the layers' temperature
+     in K.
+  mu: 2D float ndarray
+     Array of shape (nprofiles, nlayers) with the layers' mean molecular
+     mass.
+  p0: Float
+     Reference pressure level, i.e. R(p0) = R0, in bars.
+  R0: Float
+     Reference radius level in km.
+  g: Float
+     Atmospheric gravity in m s-2.
+
+  Returns:
+  --------
+  rad: 2D float ndarray
+     Array of shape (nprofiles, nlayers) with the layers' radius (same
+     units as R0).
+  """
+  # Number of layers in the atmosphere:
+  n = len(pressure)
+
+  # Reference pressure must be within the range of pressures:
+  if p0 < np.amin(pressure) or p0 > np.amax(pressure):
+    raise ValueError("Referenced surface pressure of {:.3e} bar is not in "
+                     "the range of pressures: [{}, {}] bar.".
+                      format(p0, np.amin(pressure), np.amax(pressure)))
 
   # Return back to desending order for radius calculation
-  press = pressure   [::-1]
-  temp  = temperature[::-1]
-  mu    = mu         [::-1]
+  press = pressure         [::-1]
+  temp  = temperature[:, ::-1]
+  mu    = mu         [:, ::-1]
+  tmu   = temp / mu
 
   # Find the index of the closest pressure point to p0:
   idx = np.argmin(np.abs(press - p0))
 
-  # If p0 is not in press:
+  # If p0 is not in press, interpolate temp and mu in lin-log space:
   if press[idx] != p0:
-      # If the point is above p0:
-      if press[idx] > p0:
-          rad[idx] = R0 + 0.5 * (temp[idx] / mu[idx] + temp_1bar / mu_1bar) *\
-                     (sc.Avogadro * sc.k * np.log(p0/press[idx]) / g)
-      # If the point is below p0:
-      else:
-          rad[idx] = R0 - 0.5 * (temp[idx] / mu[idx] + temp_1bar / mu_1bar) *\
-                     (sc.Avogadro * sc.k * np.log(press[idx]/p0) / g)
-
+    logp  = np.log10(press)
+    order = np.argsort(logp)
+    j = np.clip(np.searchsorted(logp[order], np.log10(p0)) - 1, 0, n-2)
+    lo, hi = order[j], order[j+1]
+    dlogp = (np.log10(p0) - logp[lo]) / (logp[hi] - logp[lo])
+    temp_1bar = temp[:,lo] + (temp[:,hi] - temp[:,lo]) * dlogp
+    mu_1bar   = mu  [:,lo] + (mu  [:,hi] - mu  [:,lo]) * dlogp
+    # If the point is above p0:
+    if press[idx] > p0:
+      rad0 = R0 + 0.5 * (tmu[:,idx] + temp_1bar / mu_1bar) * \
+                  (sc.Avogadro * sc.k * np.log(p0/press[idx]) / g)
+    # If the point is below p0:
+    else:
+      rad0 = R0 - 0.5 * (tmu[:,idx] + temp_1bar / mu_1bar) * \
+                  (sc.Avogadro * sc.k * np.log(press[idx]/p0) / g)
   else:
-      rad[idx] = R0
+    rad0 = np.tile(float(R0), len(tmu))
+
+  # Radius difference between consecutive layers:
+  drad = 0.5 * (tmu[:,:-1] + tmu[:,1:]) * \
+         (sc.Avogadro * sc.k * np.log(press[:-1]/press[1:]) / g)
 
-  # Calculate radius below p0:
-  for i in reversed(np.arange(idx)):
-      rad[i] = rad[i+1] - 0.5 * (temp[i] / mu[i] + temp[i+1] / mu[i+1]) * \
-               (sc.Avogadro * sc.k * np.log(press[i]/press[i+1]) / g)
-  # Calculate radius above p0:
-  for i in np.arange(idx+1, n):
-      rad[i] = rad[i-1] + 0.5 * (temp[i] / mu[i] + temp[i-1] / mu[i-1]) * \
-               (sc.Avogadro * sc.k * np.log(press[i-1]/press[i]) / g)
+  # Cumulative sums below and above p0:
+  rad = np.zeros((len(tmu), n))
+  rad[:, idx::-1] = np.cumsum(np.hstack((rad0[:,np.newaxis],
+                                         -drad[:,:idx][:,::-1])), axis=1)
+  rad[:, idx:   ] = np.cumsum(np.hstack((rad0[:,np.newaxis],
+                                          drad[:,idx:])),         axis=1)
 
   # Reverse the order of calculated radii to write them in the right order
   # in pre-atm file:
-  rad = rad[::-1]
-
-  return rad
+  return rad[:, ::-1]
 
 
 def makeAbun(solar_abun, abun_file, solar_times=1, COswap=False):
@@ -435,19 +478,74 @@ def stoich(species):
     return stoich_info
 
 
+def stoich_matrix(species, elements):
+  """
+  Stoichiometry matrix of a list of species.
+
+  Parameters:
+  -----------
+  species: List of strings
+     Species names (a JANAF extension, e.g., '_g', is ignored).
+  elements: 1D string ndarray
+     Elemental chemical symbols.
+
+  Returns:
+  --------
+  matrix: 2D float ndarray
+     Array of shape (nspecies, nelements) with the number of atoms of
+     each element in each species.
+  """
+  elements = list(elements)
+  matrix = np.zeros((len(species), len(elements)))
+  for i in np.arange(len(species)):
+    for elem, count in stoich(species[i].partition('_')[0]):
+      if elem not in elements:
+        raise ValueError("Element '{:s}' of species '{:s}' is not in the "
+                         "elemental-abundances file.".format(elem, species[i]))
+      matrix[i, elements.index(elem)] += float(count)
+  return matrix
+
+
+# Molar masses of species lists, by (abundances file, file modification
+# time, species):
+molar_mass_cache = {}
+
+def molar_mass(abun_file, species):
+  """
+  Molar mass of a list of species: the stoichiometry matrix times the
+  elemental masses.  The result is memoized, so the elemental-abundances
+  file and the species names are parsed once per list of species.
+
+  Parameters:
+  -----------
+  abun_file: String
+     Name of the elemental-abundances file.
+  species: List of strings
+     Species names.
+
+  Returns:
+  --------
+  mass: 1D float ndarray
+     Molar mass of each species (in g mol-1).
+  """
+  key = (os.path.realpath(abun_file), os.path.getmtime(abun_file),
+         tuple(species))
+  if key not in molar_mass_cache:
+    index, element, dex, name, weights = read_eabun(abun_file)
+    molar_mass_cache[key] = np.dot(stoich_matrix(species, element), weights)
+  return molar_mass_cache[key]
+
+
 # calculates mean molecular mass
 def mean_molar_mass(abun_file, atmfile=None, spec=None, pressure=None,
                     temp=None, abundances=None):
     """
     This function calculates mean molar mass at each layer in the atmosphere.
-    For input elements it trims the data from the abundances file, and
-    extracts elemental molar mass. Then, it reads the final TEA
-    output atmospheric file to get all the data, trims the names of the
-    output species and makes a stoichiometric array to store the values of
-    all output species. It calls the stoich() function to get each species
-    stoichiometric values, multiplies elemental weights with each element
-    number in a species and sum them for all output species at each layer
-    in the atmosphere. It stores the values in the mu array for every layer.
+    It reads the final TEA output atmospheric file (unless the species and
+    abundances are given), gets the molar mass of each species from the
+    (memoized) stoichiometry matrix and elemental masses (see molar_mass),
+    and sums the species masses weighted by their abundances at each
+    layer with a single matrix product.
 
     Parameters
     ----------
@@ -455,51 +553,29 @@ def mean_molar_mass(abun_file, atmfile=None, spec=None, pressure=None,
        Name of the file carrying abundance information
     atmfile: String
        Name of TEA atmospheric ASCII file.
+    spec: List of strings
+       Species names (if atmfile is None).
+    abundances: 2D or 3D float ndarray
+       Species abundances (if atmfile is None) of shape (nlayers, nspec),
+       or (nsamples, nlayers, nspec) for a set of atmospheres.
 
     Returns
     -------
-    mu: 1D array of floats
-       Array containing mean molecular mass for each layer in the atmosphere.
+    mu: 1D or 2D array of floats
+       Array containing mean molecular mass for each layer in the atmosphere
+       (of shape (nsamples, nlayers) for a set of atmospheres).
 
     Revisions
     ---------
     2014-09-29  Jasmina   Written by.
     2015-03-05  Patricio  Simplified a few calculations.
     """
-
-    # Read the elemental abundances file:
-    index, element, dex, name, weights = read_eabun(abun_file)
-
     # Read the atmospheric file:
     if atmfile is not None:
       spec, pressure, temp, abundances = readatm(atmfile)
 
-    # Number of molecules:
-    nspec   = len(spec)
-    # Number of layers in the atmosphere:
-    nLayers = len(abundances)
-
-    spec_weight = np.zeros(nspec)
-    # Get the mass of each species:
-    for i in np.arange(nspec):
-      # Remove the JANAF extension from species name and get the
-      #  stoichiometric data:
-      spec_stoich = stoich(spec[i].partition('_')[0])
-      # Add the mass from each element in this species:
-      for j in np.arange(len(spec_stoich)):
-        # Find the element:
-        elem_idx = np.where(element == spec_stoich[j][0])
-        # Add the weighted mass:
-        spec_weight[i] += weights[elem_idx][0] * float(spec_stoich[j][1])
-
-    # Allocate array (for each layer) of mean molar mass:
-    mu = np.zeros(nLayers)
-
     # Sum of all species weight in the layer:
-    for i in np.arange(nLayers):
-        mu[i] = sum(spec_weight * abundances[i])
-
-    return mu
+    return np.dot(abundances, molar_mass(abun_file, spec))
 
 
 def makeRadius(out_spec, atmfile, abun_file, tepfile, p0):
@@ -536,65 +612,101 @@ def makeRadius(out_spec, atmfile, abun_file, tepfile, p0):
   molecules, pressure, temperature, abundances = readatm(atmfile)
 
   # Calculate the mean molecular mass of each layer:
-  mu = mean_molar_mass(abun_file, atmfile)
+  mu = mean_molar_mass(abun_file, spec=molecules, abundances=abundances)
+
+  # Retrieve planet name and surface radius
+  g, Rp = get_g(tepfile)
+
+  # Calculate the radius of each layer:
+  rad = radpress(pressure, temperature, mu, p0, Rp, g)
 
   # Open atmfile to overwrite:
   fout = open(atmfile, 'w')
 
-  # Write a header file
-  header = (
-  "# This is a final TEA output file with calculated abundances (mixing fractions) for all listed species.\n"
-  "# Units: pressure (bar), temperature (K), abundance (unitless).")
-  fout.write(header + '\n\n')
+  # Write header, species names, and labels:
+  fout.writelines(radius_header(out_spec, molecules))
 
-  # Retrieve planet name and surface radius
-  g, Rp = get_g(tepfile)
+  # Write radius, pressure, temperature, and abundances of each layer:
+  aio.write_layers(fout, rad, pressure, temperature,
+                   abundances[:,:len(molecules)])
 
-  # Write species names
-  fout.write('#SPECIES\n' + out_spec + '\n\n')
-
-  # Write TEA data
-  fout.write('#TEADATA\n')
+  # Close atm file
+  fout.close()
 
-  # Calculate the radius of each layer:
-  rad = radpress(pressure, temperature, mu, p0, Rp, g)
 
-  # Number of layers in the atmosphere
-  nLayers = len(abundances)
+def radius_header(out_spec, molecules):
+  """
+  Header lines (comments, species, and column labels) of a TEA
+  atmospheric file with a radius column, as written by makeRadius.
 
-  # Number of molecules
-  nspec = len(molecules)
+  Parameters
+  ----------
+  out_spec: String
+      String containing all output molecular species.
+  molecules: List of strings
+      Species names of the abundance columns.
 
+  Returns
+  -------
+  header: List of strings
+      Lines of the file before the data.
+  """
   # Make a list of labels
   label = ['#Radius'.ljust(11)] + ['Pressure'.ljust(11)] + ['Temp'.ljust(8)]
-  for i in np.arange(nspec):
-       label = label + [molecules[i].ljust(14)]
-  label = ''.join(label)
-
-  # Write new label
-  fout.write(label + '\n')
+  label = ''.join(label + [mol.ljust(14) for mol in molecules])
 
-  # Write atm file for each run
-  for i in np.arange(nLayers):
-      # Radius, pressure, and temp for the current line
-      radi = str('%10.3f'%rad[i])
-      presi = str('%10.4e'%pressure[i])
-      tempi = str('%7.2f'%temperature[i])
+  return ["# This is a final TEA output file with calculated abundances "
+          "(mixing fractions) for all listed species.\n",
+          "# Units: pressure (bar), temperature (K), abundance (unitless).\n",
+          "\n",
+          "#SPECIES\n",
+          out_spec + "\n",
+          "\n",
+          "#TEADATA\n",
+          label + "\n"]
 
-      # Insert radii array
-      fout.write(radi.ljust(10) + ' ')
 
-      # Insert results from the current line (T-P) to atm file
-      fout.write(presi.ljust(10) + ' ')
-      fout.write(tempi.ljust(7) + ' ')
-
-      # Write current abundances
-      for j in np.arange(nspec):
-          fout.write('%1.4e'%abundances[i][j] + ' ')
-      fout.write('\n')
+def write_atm(atmfile, out_spec, molecules, rad, pressure, temperature,
+              abundances, container=False):
+  """
+  Write a transit atmospheric file in a single pass.  The output is the
+  same as that of makeRadius followed by reformat, without writing and
+  reading back the intermediate file.  Optionally, also save the layer
+  arrays (as read back from atmfile) into its binary container (see
+  atmio.write).
 
-  # Close atm file
-  fout.close()
+  Parameters
+  ----------
+  atmfile: String
+      Name of the output atmospheric file.
+  out_spec: String
+      String containing all output molecular species.
+  molecules: List of strings
+      Species names of the abundance columns.
+  rad: 1D float ndarray
+      Radius of each layer.
+  pressure: 1D float ndarray
+      Pressure of each layer (bar).
+  temperature: 1D float ndarray
+      Temperature of each layer (K).
+  abundances: 2D float ndarray
+      Array of shape (nlayers, nspecies) with the species abundances.
+  container: Bool
+      If True, also write the binary container of atmfile.
+  """
+  header = "".join(reformat_lines(radius_header(out_spec, molecules)))
+  header = header.splitlines(True)
+  imol = aio.markers(header)[0]
+  # Layers from bottom to top, as written in (and read back from) the
+  # file:
+  data = np.column_stack((aio.quantize(rad,         "%10.3f"),
+                          aio.quantize(pressure,    "%10.4e"),
+                          aio.quantize(temperature, "%7.2f"),
+                          aio.quantize(abundances,  "%1.4e")))[::-1]
+  npzfile = None
+  if container:
+    npzfile = aio.container(atmfile)
+  aio.write(atmfile, header, header[imol].split(), data, npzfile)
 
 
 def make_preatm(tepfile, press_file, abun_file, in_elem, out_spec,
@@ -611,8 +723,8 @@ def make_preatm(tepfile, press_file, abun_file, in_elem, out_spec,
   ----------
   tepfile: String
      Name of the tepfile.
-  press_file: String
-     Name of the pressure file.
+  press_file: String or 1D float ndarray
+     Name of the pressure file (or the pressure array).
   abun_file: String
      Name of the abundances file.
   in_elem: String
@@ -677,15 +789,73 @@ def make_preatm(tepfile, press_file, abun_file, in_elem, out_spec,
         "".join(["{:<18s}".format(elem) for elem in in_symbol]) + "\n")
 
   # Write data for each layer:
-  for i in np.arange(n_layers):
-    # Pressure, and Temperature:
-    f.write("{:10.4e} {:8.2f}  ".format(pres[i], Temp[i]))
-    # Elemental abundance list:
-    f.write("  ".join(["{:16.10e}".format(abun) for abun in out_abn]) + "\n")
+  aio.write_tea(f, pres, Temp, np.tile(out_abn, (n_layers, 1)))
+  f.close()
+
+
+def split_preatm(preatm_file, layers, prefix):
+  """
+  Split a pre-atmospheric file into files with subsets of its layers
+  (e.g., to run TEA on each of them concurrently).
+
+  Parameters
+  ----------
+  preatm_file: String
+     Pre-atmospheric filename.
+  layers: List of 1D integer ndarrays
+     Indices of the layers of each output file.
+  prefix: String
+     Prefix of the output filenames (followed by a three-digit index and
+     '.atm').
+
+  Returns
+  -------
+  files: List of strings
+     Output pre-atmospheric filenames.
+  """
+  f = open(preatm_file, 'r')
+  lines = f.readlines()
+  f.close()
+  imol, start = aio.markers(lines)
+
+  files = []
+  for i in np.arange(len(layers)):
+    files.append("{:s}{:03d}.atm".format(prefix, i))
+    f = open(files[i], 'w')
+    f.writelines(lines[:start] + [lines[start+j] for j in layers[i]])
+    f.close()
+  return files
+
+
+def merge_tea(teafiles, teafile):
+  """
+  Merge TEA output files of consecutive subsets of layers into a single
+  TEA output file (with the header of the first one).
+
+  Parameters
+  ----------
+  teafiles: List of strings
+     TEA output files, in layer order.
+  teafile: String
+     Merged TEA output file.
+  """
+  merged = []
+  for i in np.arange(len(teafiles)):
+    f = open(teafiles[i], 'r')
+    lines = f.readlines()
+    f.close()
+    imol, start = aio.markers(lines)
+    if i == 0:
+      merged += lines[:start]
+    merged += lines[start:]
+
+  f = open(teafile, 'w')
+  f.writelines(merged)
   f.close()
 
 
-def uniform(atmfile, press_file, abun_file, tepfile, species, abundances, temp, p0):
+def uniform(atmfile, press_file, abun_file, tepfile, species, abundances, temp, p0,
+            container=False):
   """
   Generate an atmospheric file with uniform abundances.
 
@@ -693,8 +863,8 @@ def uniform(atmfile, press_file, abun_file, tepfile, species, abundances, temp,
   -----------
   atmfile: String
      Name of output atmospheric file.
-  press_file: String
-     Input pressure-array filename.
+  press_file: String or 1D float ndarray
+     Input pressure-array filename (or the pressure array).
   abun_file: String
      Input elemental-abundances filename.
   tepfile: String
@@ -707,6 +877,25 @@ def uniform(atmfile, press_file, abun_file, tepfile, species, abundances, temp,
      Temperature profile.
   p0: Float
      Reference pressure level (corresponding to Rp from the tepfile).
+  container: Bool
+     If True, also write the binary container of atmfile (see write_atm).
+
+  Returns:
+  --------
+  rad: 1D float ndarray
+     Radius of each layer.
+  press: 1D float ndarray
+     Pressure of each layer.
+  temp: 1D float ndarray
+     Temperature of each layer.
+  abun: 2D float ndarray
+     Array of shape (nlayers, nspecies) with the species abundances.
+
+  Notes:
+  ------
+  The profiles are handed to makeRadius and reformat in memory, rounded
+  as they would be read back from the intermediate TEA-format file, so
+  the atmfile is written only once (and is the same as before).
 
   Modification History:
   ---------------------
@@ -718,34 +907,23 @@ def uniform(atmfile, press_file, abun_file, tepfile, species, abundances, temp,
   # Read pressure array:
   press = pt.read_press_file(press_file)
   # Put species names into an array:
-  spec = np.asarray(species.split())
+  spec = species.split()
   # Put abundance values into an array:
-  abun = np.asarray(abundances, np.double)
+  abun = np.tile(np.asarray(abundances, np.double), (len(press), 1))
 
-  # Write to file:
-  f = open(atmfile, 'w')
+  # Profiles as stored in a TEA-format file:
+  press = aio.quantize(press, "%10.4e")
+  temp  = aio.quantize(temp,  "%8.2f")
+  abun  = aio.quantize(abun,  "%16.10e")
 
-  # Write species names:
-  f.write('#SPECIES\n' + species + '\n\n')
-
-  # Write header of TEA data:
-  f.write('#TEADATA\n')
-  # Column's header:
-  f.write("#Pressure   Temp     " +
-        "".join(["{:<18s}".format(mol) for mol in spec]) + "\n")
-
-  # For each layer write TEA data
-  for i in np.arange(len(press)):
-      # Pressure, and Temperature
-      f.write("{:10.4e} {:8.2f}  ".format(press[i], temp[i]))
-      # Elemental abundance list
-      f.write("  ".join(["{:16.10e}".format(ab) for ab in abun]) + "\n")
-  f.close()
+  # Calculate the radius of each layer:
+  mu = mean_molar_mass(abun_file, spec=spec, abundances=abun)
+  g, Rp = get_g(tepfile)
+  rad = radpress(press, temp, mu, p0, Rp, g)
 
-  # Calculate the radius of each layer and put it into the atmfile:
-  makeRadius(species, atmfile, abun_file, tepfile, p0)
-  # Reformat to use in transit:
-  reformat(atmfile)
+  # Write the atmfile in the transit format:
+  write_atm(atmfile, species, spec, rad, press, temp, abun, container)
+  return rad, press, temp, abun
 
 
 # reads final TEA atmospheric file
@@ -784,49 +962,20 @@ def readatm(atmfile):
                           radius array in it.
     """
 
-    # Open the atmospheric file and read
-    f = open(atmfile, 'r')
-    lines = np.asarray(f.readlines())
-    f.close()
-
-    # Get the molecules
-    imol = np.where(lines == "#SPECIES\n")[0][0] + 1
-    molecules = lines[imol].split()
+    # Read the species and the data block:
+    header, molecules, data = aio.read(atmfile)
 
-    # Find the line where the layers info begins
-    start = np.where(lines == "#TEADATA\n")[0][0] + 2
-
-    # Number of columns
-    ncol = len(lines[start].split())
-
-    # Number of layers
-    ndata = len(lines) - start
-
-    # Read atmfile without radius array in it or with it
-    pressure = np.zeros(ndata, np.double)
-    temp     = np.zeros(ndata, np.double)
-    if ncol == len(molecules) + 2:
-        # Number of abundances (elements per line except Press and T)
-        nabun = len(lines[start].split()) - 2
-        abundances = np.zeros((ndata, nabun), np.double)
-
-        # Extract pressure, temperature, and abundance data
-        for i in np.arange(ndata):
-            line = lines[start+i].strip().split()
-            pressure[i]   = line[0]
-            temp[i]       = line[1]
-            abundances[i] = line[2:]
+    # Index of the pressure column, for an atmfile without radius array
+    # in it or with it:
+    if data.shape[1] == len(molecules) + 2:
+        ipress = 0
     else:
-        # Number of abundances (elements per line except Radius, Press and T)
-        nabun = len(lines[start].split()) - 3
-        abundances = np.zeros((ndata, nabun), np.double)
+        ipress = 1
 
-        # Extract pressure, temperature, and abundance data
-        for i in np.arange(ndata):
-            line = lines[start+i].strip().split()
-            pressure[i]   = line[1]
-            temp[i]       = line[2]
-            abundances[i] = line[3:]
+    # Extract pressure, temperature, and abundance data
+    pressure   = np.ascontiguousarray(data[:,ipress])
+    temp       = np.ascontiguousarray(data[:,ipress+1])
+    abundances = np.ascontiguousarray(data[:,ipress+2:])
 
     return molecules, pressure, temp, abundances
 
@@ -850,11 +999,34 @@ def reformat(atmfile):
 
     # Open the atmospheric file to read and write
     f = open(atmfile, 'r')
-    lines = np.asarray(f.readlines())
+    lines = f.readlines()
     f.close()
 
+    # Save file with the updated lines
+    f = open(atmfile, 'w')
+    f.writelines(reformat_lines(lines))
+    f.close()
+
+
+def reformat_lines(lines):
+    """
+    Re-format the lines of a TEA output file to work for transit (see
+    reformat).
+
+    Parameters
+    ----------
+    lines: List of strings
+       Lines of a TEA atmospheric file with radius column.
+
+    Returns
+    -------
+    lines: List of strings
+       Lines of the transit atmospheric file.
+    """
+    lines = list(lines)
+
     # Find the Molecule names and remove their suffix
-    imol = np.where(lines == "#SPECIES\n")[0][0] + 1
+    imol, start = aio.markers(lines)
     molecules = lines[imol].split()
     for m in np.arange(len(molecules)):
         molecules[m] = molecules[m].replace('_ion_p', '+')
@@ -863,14 +1035,13 @@ def reformat(atmfile):
     lines[imol] = " ".join(molecules) + "\n"
 
     # Repeat for the column headers
-    start = np.where(lines == "#TEADATA\n")[0][0] + 1
+    start -= 1
     molecules = lines[start].split()
     for m in np.arange(len(molecules) - 1):
         molecules[m] = "{:10s}".format(molecules[m].replace('_ion_p', '+').replace('_ion_n', '-').partition('_')[0])
     molecules[len(molecules) - 1] = molecules[len(molecules) - 1].replace('_ion_p', '+').replace('_ion_n', '-').partition('_')[0]
     lines[start] = " ".join(molecules) + "\n"
 
-    lines = list(lines)
     # Reverse order to have layers from bottom to top
     datalines = lines[start+1:]
     datalines.reverse()
@@ -884,7 +1055,4 @@ def reformat(atmfile):
     # Radius in kilometers:
     lines.insert(imol-2, "\n#Values units:\nur 1e5\n")
 
-    # Save file with the updated lines
-    f = open(atmfile, 'w')
-    f.writelines(lines)
-    f.close()
+    return lines
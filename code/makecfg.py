@@ -92,7 +92,7 @@ def makeTransit(cfile, tepfile, shareOpacity):
   tcfile.close()
 
 
-def makeMCMC(cfile, MCMC_cfile, logfile):
+def makeMCMC(cfile, MCMC_cfile, logfile, nchains=10, nbatch=1):
   """
   Reformat configuration file to remove relative paths.  This output 
   configuration file is used by the BART's MCMC program.
@@ -105,6 +105,10 @@ def makeMCMC(cfile, MCMC_cfile, logfile):
      Reformated configuration file.
   logfile: String
      Default logfile argument if not specified in cfile.
+  nchains: Integer
+     Number of parallel chains.
+  nbatch: Integer
+     Number of parameter sets evaluated by each worker per MPI exchange.
   """
 
   # Name of the configuration-file section:
@@ -145,6 +149,16 @@ def makeMCMC(cfile, MCMC_cfile, logfile):
   # Add mpi:
   Bconfig.set(section, "mpi", "True")
 
+  # Each worker evaluates nbatch chains, MC3 must spawn nchains/nbatch:
+  nproc = nchains // nbatch
+  if "nproc" in args and int(Bconfig.get(section, "nproc")) != nproc:
+    mu.error("The number of processes (nproc={:s}) must be nchains/nbatch "
+             "({:d}/{:d} = {:d}).".format(Bconfig.get(section, "nproc"),
+                                          nchains, nbatch, nproc))
+  Bconfig.set(section, "nchains", str(nchains))
+  Bconfig.set(section, "nbatch",  str(nbatch))
+  Bconfig.set(section, "nproc",   str(nproc))
+
   # Add func:
   Bconfig.set(section, "func", "hack BARTfunc {:s}".format(filedir))
 
@@ -0,0 +1,422 @@
+# Copyright (C) 2015-2016 University of Central Florida. All rights reserved.
+# BART is under an open-source, reproducible-research license (see LICENSE).
+
+"""
+    Single-node (MPI-free) backend for the BART forward model.
+
+    The Pool class runs the same model evaluation as BARTfunc on a set of
+    local worker processes.  Parameters and models are exchanged through
+    shared-memory arrays, thus no pickling nor MPI is involved.  When the
+    transit configuration file sets shareOpacity, the workers attach the
+    opacity table from OS shared memory (handled by transit).
+
+    BART uses the Pool only for the emulator MCMC (--emulator); the MC3
+    MCMC evaluates the forward model with BARTfunc under MPI.
+
+    The tasks are placed on a single queue from which each worker pulls
+    as soon as it is free (dynamic load balancing), the results are
+    written back into the rows of the requesting parameters.  Each
+    worker records the time spent idle (waiting for tasks) and busy
+    (evaluating models).  The Pool splits the idle time into the time
+    spent waiting on the queue while a submission is being evaluated
+    (load imbalance), and the time between submissions (when the
+    caller is busy, e.g., fitting the surrogate or proposing the next
+    step), see Pool.load and Pool.report.  As for the rest
+    of the Pool, this scheduling applies only to the emulator MCMC; MC3
+    assigns a fixed block of chains to each of its MPI workers.
+
+    The shared buffers are doubled, such that a new set of parameters
+    can be submitted (Pool.submit) while the workers evaluate the
+    previous one, and its results collected later (Pool.collect).  The
+    emulator MCMC runs its chains in two halves, such that the full
+    models of one half are evaluated while the other half proposes and
+    screens its next step.  This overlap applies only to the emulator
+    MCMC; the MPI exchange of BARTfunc (MC3 MCMC) remains synchronous.
+
+    Classes
+    -------
+    Pool:
+          Pool of local processes evaluating the BART forward model.
+
+    Functions
+    ---------
+    worker:
+          Worker-process loop, evaluates the models requested by the Pool.
+"""
+
+import sys, os
+import time
+import traceback
+import Queue
+import multiprocessing as mp
+import numpy as np
+
+import BARTfunc as bf
+
+filedir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(filedir + "/../modules/MCcubed/")
+import MCcubed.utils as mu
+
+
+def shared_array(shape):
+  """
+  Allocate a double-precision array in shared memory.
+
+  Parameters:
+  -----------
+  shape: Tuple of integers
+     Shape of the array.
+
+  Returns:
+  --------
+  raw: multiprocessing RawArray
+     The shared-memory buffer (to be passed to the worker processes).
+  array: ndarray
+     A numpy view of the buffer with the requested shape.
+  """
+  raw = mp.RawArray('d', int(np.prod(shape)))
+  array = np.frombuffer(raw, np.double).reshape(shape)
+  return raw, array
+
+
+def worker(argv, index, nbatch, rawpars, rawmodels, rawload, shape, tasks,
+           done, verb=False):
+  """
+  Worker-process loop.  Initialize the forward model, then evaluate the
+  rows of the shared parameter array requested through the tasks queue,
+  storing the results in the shared model array.
+
+  Parameters:
+  -----------
+  argv: List of strings
+     BARTfunc command-line arguments.
+  index: Integer
+     Worker index.
+  nbatch: Integer
+     Maximum number of models per task.
+  rawpars: multiprocessing RawArray
+     Shared-memory (double-buffered) parameters array.
+  rawmodels: multiprocessing RawArray
+     Shared-memory (double-buffered) models array.
+  rawload: multiprocessing RawArray
+     Shared-memory array where to store the idle time, busy time, and
+     number of tasks of each worker.
+  shape: 3-element tuple of integers
+     Number of models, parameters, and filters of each buffer.
+  tasks: multiprocessing Queue
+     Queue (shared by all workers) of (buffer, first, last) indices to
+     evaluate (None to quit).
+  done: multiprocessing Queue
+     Queue where to report (index, status, message) back to the Pool,
+     message is the buffer index and end time of a finished task.
+  verb: Boolean
+     Verbosity.
+  """
+  nmodels, npars, nfilters = shape
+  params = np.frombuffer(rawpars,   np.double).reshape((2, nmodels, npars))
+  models = np.frombuffer(rawmodels, np.double).reshape((2, nmodels, nfilters))
+  load   = np.frombuffer(rawload,   np.double).reshape((-1, 3))[index]
+
+  try:
+    model = bf.Model(bf.parse_args(argv), nbatch, verb)
+  except BaseException:
+    done.put((index, "error", traceback.format_exc()))
+    return
+  done.put((index, "ready", None))
+
+  while True:
+    start = time.time()
+    task = tasks.get()
+    load[0] += time.time() - start
+    if task is None:
+      break
+    start = time.time()
+    ibuf, first, last = task
+    try:
+      model(params[ibuf, first:last], models[ibuf, first:last])
+    except BaseException:
+      done.put((index, "error", traceback.format_exc()))
+      break
+    load[1] += time.time() - start
+    load[2] += 1
+    done.put((index, "done", (ibuf, time.time())))
+
+  model.free()
+
+
+class Pool:
+  """
+  Pool of local processes evaluating the BART forward model.
+
+  Parameters:
+  -----------
+  cfile: String
+     BART (MCMC) configuration file.
+  nworkers: Integer
+     Number of worker processes (default: number of CPUs).
+  nmodels: Integer
+     Maximum number of models per submit (size of each shared buffer).
+     Default: nworkers*nbatch.
+  nbatch: Integer
+     Maximum number of models evaluated by a worker per task.
+  verb: Boolean
+     Verbosity (of the first worker).
+
+  Example:
+  --------
+  >>> import sys
+  >>> sys.path.append("BART/code")
+  >>> sys.path.append("BART/modules/MCcubed")
+  >>> import numpy as np
+  >>> import mpfunc
+  >>> pool = mpfunc.Pool("MCMC_BART.cfg", nworkers=4)
+  >>> # Evaluate the band-integrated models of a set of parameters:
+  >>> params = np.tile(pool.args.params, (8,1))
+  >>> models = pool(params)
+  >>> # Or asynchronously, overlapping the evaluation with other work:
+  >>> job = pool.submit(params)
+  >>> # ... (e.g., propose the next set of parameters)
+  >>> models = pool.collect(job)
+  >>> pool.close()
+  """
+  def __init__(self, cfile, nworkers=None, nmodels=None, nbatch=1,
+               verb=False):
+    if nworkers is None:
+      nworkers = mp.cpu_count()
+    if nmodels is None:
+      nmodels = nworkers * nbatch
+    self.argv     = ["-c", cfile]
+    self.args     = bf.parse_args(self.argv)
+    self.nworkers = nworkers
+    self.nmodels  = nmodels
+    self.nbatch   = nbatch
+    self.npars    = len(self.args.params)
+    self.nfilters = len(self.args.filters)
+
+    # Double-buffered shared memory for the parameters and models:
+    shape = (nmodels, self.npars, self.nfilters)
+    rawpars,   self.params = shared_array((2, nmodels, self.npars))
+    rawmodels, self.models = shared_array((2, nmodels, self.nfilters))
+    # Number of pending tasks and number of models in each buffer:
+    self.pending = [0, 0]
+    self.nrows   = [0, 0]
+    # Idle time, busy time, and number of tasks of each worker:
+    rawload,   self.workload = shared_array((nworkers, 3))
+    # Number of submissions, time with submissions being evaluated, time
+    # between them, and start/end times of the current/last evaluation:
+    self.nsubmit = 0
+    self.active  = 0.0
+    self.between = 0.0
+    self.tstart  = None
+    self.tend    = None
+
+    # Queue of pending tasks (shared by the workers), and queue of
+    # finished tasks:
+    self.tasks = mp.Queue()
+    self.done  = mp.Queue()
+
+    self.workers = []
+    for i in np.arange(nworkers):
+      proc = mp.Process(target=worker,
+                        args=(self.argv, i, nbatch, rawpars, rawmodels,
+                              rawload, shape, self.tasks, self.done,
+                              verb and i==0))
+      proc.daemon = True
+      proc.start()
+      self.workers.append(proc)
+
+    # Wait until all workers initialized the forward model:
+    for i in np.arange(nworkers):
+      self.receive()
+
+
+  def receive(self):
+    """
+    Wait for the next message from the workers, abort if a worker
+    failed or died.  Update the count of pending tasks, and the time
+    with submissions being evaluated.
+    """
+    while True:
+      try:
+        index, status, message = self.done.get(timeout=1.0)
+      except Queue.Empty:
+        # Check that no worker died (e.g., from a crash in transit):
+        for i in np.arange(self.nworkers):
+          if not self.workers[i].is_alive():
+            self.terminate()
+            mu.error("BART worker {:d} exited unexpectedly (exit code "
+                     "{}).".format(i, self.workers[i].exitcode))
+        continue
+      if status == "error":
+        self.terminate()
+        mu.error("BART worker {:d} failed:\n{:s}".format(index, message))
+      if status == "done":
+        ibuf, tend = message
+        self.pending[ibuf] -= 1
+        self.tend = max(self.tend, tend)
+        if sum(self.pending) == 0:
+          self.active += self.tend - self.tstart
+      return
+
+
+  def submit(self, params):
+    """
+    Send a set of parameters to the workers and return without waiting
+    for the results.  Up to two submissions can be pending at a time.
+
+    Parameters:
+    -----------
+    params: 2D float ndarray
+       Array of shape (nrows, npars) with the model parameters, with
+       nrows <= nmodels.
+
+    Returns:
+    --------
+    ibuf: Integer
+       Index of the buffer holding the submission (see collect).
+    """
+    params = np.atleast_2d(params)
+    nrows  = len(params)
+    if nrows > self.nmodels:
+      mu.error("Cannot submit more than {:d} models at once ({:d}).".
+               format(self.nmodels, nrows))
+    if self.nrows[0] == 0:
+      ibuf = 0
+    elif self.nrows[1] == 0:
+      ibuf = 1
+    else:
+      mu.error("Both Pool buffers are in use, collect() a submission first.")
+
+    self.params[ibuf, :nrows] = params
+    self.nrows[ibuf] = nrows
+    self.nsubmit += 1
+    if sum(self.pending) == 0:
+      self.tstart = time.time()
+      if self.tend is not None:
+        self.between += self.tstart - self.tend
+      self.tend = self.tstart
+    # Split in tasks of up to nbatch models, the first free worker
+    # takes the next task:
+    for first in np.arange(0, nrows, self.nbatch):
+      self.tasks.put((ibuf, first, min(first+self.nbatch, nrows)))
+      self.pending[ibuf] += 1
+    return ibuf
+
+
+  def collect(self, ibuf):
+    """
+    Wait for a submission to finish and return its models.
+
+    Parameters:
+    -----------
+    ibuf: Integer
+       Buffer index returned by submit.
+
+    Returns:
+    --------
+    models: 2D float ndarray
+       Array of shape (nrows, nfilters) with the band-integrated models.
+    """
+    while self.pending[ibuf] > 0:
+      self.receive()
+    models = np.copy(self.models[ibuf, :self.nrows[ibuf]])
+    self.nrows[ibuf] = 0
+    return models
+
+
+  def __call__(self, params):
+    """
+    Evaluate the band-integrated models for a set of parameters.
+
+    Parameters:
+    -----------
+    params: 2D float ndarray
+       Array of shape (nmodels, npars) with the model parameters.
+       A 1D array is evaluated as a single model.
+
+    Returns:
+    --------
+    models: 2D float ndarray
+       Array of shape (nmodels, nfilters) with the band-integrated models
+       (or 1D array for a 1D params input).
+    """
+    single = np.ndim(params) == 1
+    params = np.atleast_2d(params)
+    models = np.zeros((len(params), self.nfilters), np.double)
+    if len(params) == 0:
+      return models
+
+    # Evaluate in blocks that fit in the shared buffers, submit the
+    # next block before collecting the current one so that the workers
+    # do not idle between blocks:
+    first = np.arange(0, len(params), self.nmodels)
+    last  = np.append(first[1:], len(params))
+    jobs  = []
+    for i in np.arange(len(first)):
+      jobs.append(self.submit(params[first[i]:last[i]]))
+      if i > 0:
+        models[first[i-1]:last[i-1]] = self.collect(jobs[i-1])
+    models[first[-1]:last[-1]] = self.collect(jobs[-1])
+
+    if single:
+      return models[0]
+    return models
+
+
+  def load(self):
+    """
+    Return the workload of the workers.
+
+    Returns:
+    --------
+    wait: 1D float ndarray
+       Time (in seconds) each worker spent waiting for tasks while a
+       submission was being evaluated.
+    idle: 1D float ndarray
+       Time (in seconds) each worker spent waiting for tasks between
+       submissions.
+    busy: 1D float ndarray
+       Time (in seconds) each worker spent evaluating models.
+    ntasks: 1D integer ndarray
+       Number of tasks evaluated by each worker.
+    """
+    workload = np.copy(self.workload)
+    busy = workload[:,1]
+    wait = np.clip(self.active - busy, 0.0, None)
+    idle = np.clip(workload[:,0] - wait, 0.0, None)
+    return wait, idle, busy, np.asarray(workload[:,2], int)
+
+
+  def report(self, verb=1):
+    """
+    Print the busy time of the workers, their queue-wait time (per
+    submission), and their idle time between submissions.
+    """
+    wait, idle, busy, ntasks = self.load()
+    ncalls = max(self.nsubmit, 1)
+    mu.msg(verb, "{:d} submissions, {:.3f} s evaluating them, {:.3f} s "
+           "between them.".format(self.nsubmit, self.active, self.between))
+    mu.msg(verb, "Worker  Tasks   Busy (s)   Wait (s)  Wait/call (s)  "
+                 "Between calls (s)")
+    for i in np.arange(self.nworkers):
+      mu.msg(verb, "{:6d} {:6d} {:10.3f} {:10.3f} {:14.4f} {:18.3f}".format(
+             i, ntasks[i], busy[i], wait[i], wait[i]/ncalls, idle[i]))
+
+
+  def close(self):
+    """
+    Stop the worker processes (after they free the transit memory).
+    """
+    for i in np.arange(self.nworkers):
+      self.tasks.put(None)
+    for proc in self.workers:
+      proc.join()
+
+
+  def terminate(self):
+    """
+    Kill the worker processes.
+    """
+    for proc in self.workers:
+      if proc.is_alive():
+        proc.terminate()
@@ -0,0 +1,576 @@
+# Copyright (C) 2015-2016 University of Central Florida. All rights reserved.
+# BART is under an open-source, reproducible-research license (see LICENSE).
+
+"""
+    In-memory hand-off between the atmospheric-setup stages of BART
+    (pressure array, temperature profile, pre-atmosphere, TEA, radius,
+    transit format).
+
+    The pressure, temperature, abundance, and radius arrays are kept in
+    a Pipeline object and passed from one stage to the next, instead of
+    being written to a file and read back by the following stage.  Files
+    are written only where an external program needs them (the TEA
+    pre-atmospheric file, the final atmospheric file for transit), and
+    optionally as artifacts (the pressure file).  The arrays hold the
+    values as they would be read back from the files, so the results are
+    the same as those of the file-based chain.
+
+    With the stage cache enabled, each stage first computes a key from
+    its inputs (parameters, arrays, and content of its input files, see
+    cache.stage_key).  If the cache holds the outputs of a stage with the
+    same key, they are copied into the output directory and the stage is
+    skipped; otherwise the stage runs and its outputs are stored in the
+    cache.  Since the key of a stage includes the content of the outputs
+    of the previous stages, a change of inputs reruns only the stages
+    downstream of it.  TEA results are also cached per layer (see
+    tea_layers), so a TEA run computes only the layers not seen before.
+
+    Opacity tables are kept in a shared store (a directory, by default
+    the 'opacity' folder of the BART cache), named after a hash of
+    everything that determines the table: the line databases, molecules
+    file, temperature and wavenumber grids, the atmospheric species and
+    pressure layers, and the transit executable.  Runs link the stored
+    table into their directory (hard link, or symbolic link across file
+    systems) instead of regenerating or copying it.
+"""
+
+import os
+import time
+import glob
+import shutil
+import subprocess
+import numpy as np
+
+import makeP     as mp
+import PT        as pt
+import InitialPT as ipt
+import makeatm   as mat
+import atmio     as aio
+import cache
+
+
+class Pipeline:
+  """
+  Atmospheric-setup stages of a BART run with in-memory hand-off.
+
+  Example:
+  --------
+  >>> import pipeline as pl
+  >>> pipe = pl.Pipeline(date_dir, tepfile)
+  >>> pipe.make_pressure(100, 1e-5, 100.0, date_dir + "layers.press")
+  >>> temp = pipe.temperature_profile(PTinit, PTtype, PTfunc)
+  >>> pipe.preatm(abun_file, in_elem, out_spec, date_dir + "elem.atm")
+  >>> pipe.run_tea(TEAdir, date_dir + "elem.atm",
+  >>>              date_dir + "TEA/results/TEA.tea", abun_basic, "100")
+  >>> pipe.tea_atmosphere(date_dir + "TEA/results/TEA.tea",
+  >>>                     date_dir + "atmosphere.atm", out_spec,
+  >>>                     abun_file, 0.1)
+  """
+  def __init__(self, date_dir, tepfile, artifacts=True, stage_cache=False,
+               opacity_store=None):
+    """
+    Parameters:
+    -----------
+    date_dir: String
+       Directory where to store the output files.
+    tepfile: String
+       Transiting extrasolar planet filename.
+    artifacts: Bool
+       If True, also write the intermediate files that no external
+       program needs (the pressure file).
+    stage_cache: Bool
+       If True, reuse the outputs of stages whose inputs did not change
+       from the BART cache (see cache.py).
+    opacity_store: String
+       Directory of the shared opacity-table store.  If None, use the
+       BART cache if stage_cache is True, else do not store the tables.
+    """
+    self.date_dir    = date_dir
+    self.tepfile     = tepfile
+    self.artifacts   = artifacts
+    self.stage_cache = stage_cache
+    # Keys of the stages:
+    self.keys = {}
+    # Layers of the last TEA run reused from the layer cache, and total:
+    self.tea_hits = None
+    # Opacity-table store:
+    if opacity_store is None and stage_cache:
+      cdir = cache.cache_dir()
+      if cdir is not None:
+        opacity_store = os.path.join(cdir, "opacity")
+    self.opacity_store = opacity_store
+    # Atmospheric profiles:
+    self.pressure    = None
+    self.temperature = None
+    self.species     = None
+    self.abundances  = None
+    self.radius      = None
+
+  def restore(self, stage, inputs, files):
+    """
+    Compute the key of a stage from its inputs and, if the stage cache
+    holds the outputs for that key, copy them into files.
+
+    Parameters:
+    -----------
+    stage: String
+       Stage name.
+    inputs: Function
+       Function that returns the list of stage inputs (see
+       cache.stage_key), called only if the stage cache is enabled.
+    files: List of strings
+       Output files of the stage.
+
+    Returns:
+    --------
+    restored: Bool
+       True if the outputs were restored from the cache (the stage can
+       be skipped).
+    """
+    if not self.stage_cache:
+      return False
+    self.keys[stage] = cache.stage_key(stage, *inputs())
+    return cache.stage_restore(self.keys[stage], files)
+
+  def store(self, stage, files):
+    """
+    Store the output files of a stage into the stage cache (after
+    restore() computed its key).
+    """
+    if self.stage_cache:
+      cache.stage_store(self.keys[stage], files)
+
+  def generated(self, filename):
+    """
+    Return True if filename was produced by a cached stage (of this or
+    a previous run), rather than given by the user.
+    """
+    return self.stage_cache and cache.origin(filename) is not None
+
+  def make_pressure(self, n_layers, p_top, p_bottom, press_file, log=True):
+    """
+    Compute the pressure array (see makeP.makeP), write press_file only
+    if artifacts is True.  Return True if restored from the cache.
+    """
+    if not self.artifacts:
+      self.pressure = mp.makeP(n_layers, p_top, p_bottom, None, log)
+      return False
+    inputs = lambda: [n_layers, p_top, p_bottom, log]
+    if self.restore("makeP", inputs, [press_file]):
+      self.read_pressure(press_file)
+      return True
+    self.pressure = mp.makeP(n_layers, p_top, p_bottom, press_file, log)
+    self.store("makeP", [press_file])
+    return False
+
+  def read_pressure(self, press_file):
+    """
+    Read the pressure array from an existing pressure file.
+    """
+    self.pressure = pt.read_press_file(press_file)
+    return self.pressure
+
+  def make_abun(self, abun_basic, abun_file, solar_times=1, COswap=False):
+    """
+    Write the elemental-abundances file (see makeatm.makeAbun).  Return
+    True if restored from the cache.
+    """
+    inputs = lambda: [cache.file_digest(abun_basic), solar_times, COswap]
+    if self.restore("makeAbun", inputs, [abun_file]):
+      return True
+    mat.makeAbun(abun_basic, abun_file, solar_times, COswap)
+    self.store("makeAbun", [abun_file])
+    return False
+
+  def temperature_profile(self, PTinit, PTtype, PTfunc):
+    """
+    Compute the initial temperature profile (see InitialPT.initialPT2).
+    """
+    self.temperature = ipt.initialPT2(self.date_dir, PTinit, self.pressure,
+                                      PTtype, PTfunc, self.tepfile)
+    return self.temperature
+
+  def uniform(self, atmfile, abun_file, species, abundances, p0):
+    """
+    Write a transit atmospheric file with uniform abundances (see
+    makeatm.uniform), and its binary container (see atmio.write).
+    Return True if restored from the cache (the profile arrays are then
+    not updated).
+    """
+    inputs = lambda: [self.pressure, self.temperature,
+                      cache.file_digest(abun_file),
+                      cache.file_digest(self.tepfile), species,
+                      list(abundances), p0]
+    files = [atmfile, aio.container(atmfile)]
+    if self.restore("uniform", inputs, files):
+      return True
+    self.species = species.split()
+    self.radius, self.pressure, self.temperature, self.abundances = \
+        mat.uniform(atmfile, self.pressure, abun_file, self.tepfile, species,
+                    abundances, self.temperature, p0, container=True)
+    self.store("uniform", files)
+    return False
+
+  def preatm(self, abun_file, in_elem, out_spec, preatm_file):
+    """
+    Write the TEA pre-atmospheric file (see makeatm.make_preatm).
+    Return True if restored from the cache.
+    """
+    inputs = lambda: [self.pressure, self.temperature,
+                      cache.file_digest(abun_file), in_elem, out_spec]
+    if self.restore("preatm", inputs, [preatm_file]):
+      return True
+    mat.make_preatm(self.tepfile, self.pressure, abun_file, in_elem,
+                    out_spec, preatm_file, self.temperature)
+    self.store("preatm", [preatm_file])
+    return False
+
+  def run_tea(self, TEAdir, preatm_file, teafile, abun_basic, maxiter,
+              nworkers=1):
+    """
+    Run TEA on the pre-atmospheric file (with the TEA.cfg configuration
+    file of the current directory).  Return True if the TEA output was
+    restored from the cache.
+
+    Parameters:
+    -----------
+    TEAdir: String
+       TEA directory.
+    preatm_file: String
+       TEA pre-atmospheric file.
+    teafile: String
+       TEA output atmospheric file.
+    abun_basic: String
+       Elemental-abundances file used by TEA.
+    maxiter: String
+       Maximum number of TEA iterations.
+    nworkers: Integer
+       Number of concurrent TEA processes (see tea_chunks).
+    """
+    # The TEA source code is part of the inputs:
+    sources = sorted(glob.glob(TEAdir + "tea/*.py"))
+    tea_inputs = lambda: [cache.file_digest(abun_basic), maxiter] + \
+                         [cache.file_digest(source) for source in sources]
+    inputs = lambda: [cache.file_digest(preatm_file)] + tea_inputs()
+    self.tea_hits = None
+    if self.restore("TEA", inputs, [teafile]):
+      return True
+    if self.stage_cache and cache.cache_dir() is not None:
+      self.tea_layers(TEAdir + "tea/runatm.py", preatm_file, teafile,
+                      tea_inputs(), nworkers)
+    elif nworkers > 1:
+      self.tea_chunks(TEAdir + "tea/runatm.py", preatm_file, teafile,
+                      nworkers)
+    else:
+      proc = subprocess.Popen([TEAdir + "tea/runatm.py", preatm_file, 'TEA'])
+      proc.communicate()
+    self.store("TEA", [teafile])
+    return False
+
+  def tea_chunks(self, TEAcall, preatm_file, teafile, nworkers):
+    """
+    Run TEA on chunks of layers of the pre-atmospheric file, with up to
+    nworkers processes at a time, and merge their outputs (in layer
+    order) into teafile.  The layers are independent of each other, so
+    the output is the same as that of a single TEA run.
+
+    Parameters:
+    -----------
+    TEAcall: String
+       TEA executable (runatm.py).
+    preatm_file: String
+       TEA pre-atmospheric file.
+    teafile: String
+       Merged TEA output atmospheric file.
+    nworkers: Integer
+       Maximum number of concurrent TEA processes.
+
+    Notes:
+    ------
+    Each chunk runs as a separate TEA run named 'TEA_chunkNNN', with the
+    output folder of TEA.cfg (date_dir), its pre-atmospheric file is
+    written into the 'TEA/chunks' folder of date_dir.  The chunk runs
+    and their pre-atmospheric files are removed after the merge.
+    """
+    f = open(preatm_file, "r")
+    lines = f.readlines()
+    f.close()
+    nlayers = len(lines) - aio.markers(lines)[1]
+    layers = np.array_split(np.arange(nlayers), min(nworkers, nlayers))
+
+    chunkdir = os.path.join(self.date_dir, "TEA", "chunks")
+    if not os.path.isdir(chunkdir):
+      os.makedirs(chunkdir)
+    chunks = mat.split_preatm(preatm_file, layers,
+                              os.path.join(chunkdir, "preatm_"))
+
+    # Run the chunks, at most nworkers at a time (removing the outputs
+    # of previous runs first, so that they are never merged):
+    procs = []
+    names = []
+    for i in np.arange(len(chunks)):
+      # Wait until any of the running processes finishes:
+      while len(procs) >= nworkers:
+        procs = [proc for proc in procs if proc.poll() is None]
+        if len(procs) >= nworkers:
+          time.sleep(0.1)
+      names.append("TEA_chunk{:03d}".format(i))
+      shutil.rmtree(os.path.join(self.date_dir, names[i]), True)
+      procs.append(subprocess.Popen([TEAcall, chunks[i], names[i]]))
+    for proc in procs:
+      proc.wait()
+
+    teafiles = [os.path.join(self.date_dir, name, "results", name + ".tea")
+                for name in names]
+    for i in np.arange(len(teafiles)):
+      if not os.path.isfile(teafiles[i]):
+        raise ValueError("TEA produced no output for layers {:d}-{:d} "
+                         "('{:s}').".format(layers[i][0], layers[i][-1],
+                                            teafiles[i]))
+    if not os.path.isdir(os.path.dirname(teafile)):
+      os.makedirs(os.path.dirname(teafile))
+    mat.merge_tea(teafiles, teafile)
+
+    # Remove the chunk runs (date_dir is reused across runs):
+    for i in np.arange(len(chunks)):
+      shutil.rmtree(os.path.join(self.date_dir, names[i]), True)
+      os.remove(chunks[i])
+
+  def tea_layers(self, TEAcall, preatm_file, teafile, inputs, nworkers=1):
+    """
+    Run TEA only on the layers of the pre-atmospheric file that are not
+    in the layer cache, and assemble teafile from the cached and new
+    layers.  The hit rate is kept in tea_hits.
+
+    Parameters:
+    -----------
+    TEAcall: String
+       TEA executable (runatm.py).
+    preatm_file: String
+       TEA pre-atmospheric file.
+    teafile: String
+       TEA output atmospheric file.
+    inputs: List
+       TEA inputs other than the pre-atmospheric file (see run_tea).
+    nworkers: Integer
+       Maximum number of concurrent TEA processes (see tea_chunks).
+
+    Notes:
+    ------
+    A layer is keyed by its pressure, temperature, and elemental
+    abundances, as written in the pre-atmospheric file (i.e., quantized
+    to the precision of the file: 5, 6, and 11 significant digits,
+    respectively), within a folder of the cache ('tea_layers') keyed by
+    the output species, input elements, and TEA inputs.  Each entry
+    holds the line of the TEA output for the layer, so the assembled
+    file is the same as that of a TEA run on all layers.
+    """
+    f = open(preatm_file, "r")
+    lines = f.readlines()
+    f.close()
+    imol, start = aio.markers(lines)
+    nlayers = len(lines) - start
+
+    signature = cache.stage_key("TEA layers", lines[imol], lines[start-1],
+                                *inputs)
+    ldir = os.path.join(cache.cache_dir(), "tea_layers", signature)
+    if not os.path.isdir(ldir):
+      os.makedirs(ldir)
+    hfile = os.path.join(ldir, "header")
+
+    # Look up the layers:
+    keys = [cache.stage_key("layer", line.split()) for line in lines[start:]]
+    results = [None] * nlayers
+    if os.path.isfile(hfile):
+      for i in np.arange(nlayers):
+        lfile = os.path.join(ldir, keys[i])
+        if os.path.isfile(lfile):
+          f = open(lfile, "r")
+          results[i] = f.read()
+          f.close()
+    missing = [i for i in np.arange(nlayers) if results[i] is None]
+    self.tea_hits = nlayers - len(missing), nlayers
+
+    if len(missing) > 0:
+      # Run TEA on the missing layers:
+      chunkdir = os.path.join(self.date_dir, "TEA", "chunks")
+      if not os.path.isdir(chunkdir):
+        os.makedirs(chunkdir)
+      subset = mat.split_preatm(preatm_file, [np.asarray(missing)],
+                                os.path.join(chunkdir, "uncached_"))[0]
+      partial = os.path.join(chunkdir, "uncached.tea")
+      self.tea_chunks(TEAcall, subset, partial, nworkers)
+
+      f = open(partial, "r")
+      plines = f.readlines()
+      f.close()
+      os.remove(subset)
+      os.remove(partial)
+      pstart = aio.markers(plines)[1]
+      if len(plines) - pstart != len(missing):
+        raise ValueError("TEA output ('{:s}') has {:d} layers, expected "
+                 "{:d}.".format(partial, len(plines) - pstart, len(missing)))
+      # Store the header first, then the layers:
+      cache.atomic_write(hfile, "".join(plines[:pstart]))
+      for i, line in zip(missing, plines[pstart:]):
+        results[i] = line
+        cache.atomic_write(os.path.join(ldir, keys[i]), line)
+
+    f = open(hfile, "r")
+    header = f.read()
+    f.close()
+    if not os.path.isdir(os.path.dirname(teafile)):
+      os.makedirs(os.path.dirname(teafile))
+    f = open(teafile, "w")
+    f.write(header + "".join(results))
+    f.close()
+
+  def tea_atmosphere(self, teafile, atmfile, out_spec, abun_file, p0):
+    """
+    Read the TEA output file, compute the radius of each layer, and
+    write the transit atmospheric file in a single pass (same output as
+    makeatm.makeRadius followed by makeatm.reformat on a copy of
+    teafile), and its binary container (see atmio.write).  Return True
+    if restored from the cache (the profile arrays are then not updated).
+
+    Parameters:
+    -----------
+    teafile: String
+       TEA output atmospheric file.
+    atmfile: String
+       Output transit atmospheric file.
+    out_spec: String
+       String containing all output molecular species.
+    abun_file: String
+       Name of the elemental-abundances file.
+    p0: Float
+       Reference pressure level (corresponding to Rp from the tepfile).
+    """
+    inputs = lambda: [cache.file_digest(teafile), out_spec,
+                      cache.file_digest(abun_file),
+                      cache.file_digest(self.tepfile), p0]
+    files = [atmfile, aio.container(atmfile)]
+    if self.restore("atmfile", inputs, files):
+      return True
+
+    self.species, self.pressure, self.temperature, abundances = \
+        mat.readatm(teafile)
+    self.abundances = abundances[:,:len(self.species)]
+
+    mu = mat.mean_molar_mass(abun_file, spec=self.species,
+                             abundances=abundances)
+    g, Rp = mat.get_g(self.tepfile)
+    self.radius = mat.radpress(self.pressure, self.temperature, mu, p0, Rp, g)
+
+    mat.write_atm(atmfile, out_spec, self.species, self.radius, self.pressure,
+                  self.temperature, self.abundances, container=True)
+    self.store("atmfile", files)
+    return False
+
+  def in_store(self, filename):
+    """
+    Return True if filename is (a link to) a table of the opacity store.
+    """
+    if self.opacity_store is None or not os.path.isdir(self.opacity_store):
+      return False
+    return np.any([os.path.samefile(filename, stored) for stored in
+                   glob.glob(os.path.join(self.opacity_store, "opacity_*"))])
+
+  def opacity(self, Tcall, tconfig, opacityfile):
+    """
+    Run transit to generate the opacity table.  With an opacity store,
+    link the stored table instead if there is one for the same inputs,
+    else store the new table.  Return True if the table was linked from
+    the store.
+
+    Parameters:
+    -----------
+    Tcall: String
+       Transit executable.
+    tconfig: String
+       Transit configuration file.
+    opacityfile: String
+       Output opacity file.
+    """
+    if self.opacity_store is None:
+      subprocess.call(["{:s} -c {:s} --justOpacity".format(Tcall, tconfig)],
+                      shell=True, cwd=self.date_dir)
+      return False
+
+    key = opacity_key(tconfig, Tcall)
+    stored = os.path.join(self.opacity_store, "opacity_{:s}{:s}".
+                          format(key, os.path.splitext(opacityfile)[1]))
+    if os.path.isfile(stored):
+      cache.link(stored, opacityfile)
+      return True
+
+    # Do not let transit write through a link into a stored table:
+    if os.path.lexists(opacityfile):
+      os.remove(opacityfile)
+    subprocess.call(["{:s} -c {:s} --justOpacity".format(Tcall, tconfig)],
+                    shell=True, cwd=self.date_dir)
+    try:
+      os.makedirs(self.opacity_store)
+    except OSError:
+      pass
+    # Hard link the new table into the store (copy across file systems),
+    # and replace the run's table by a link to the stored one:
+    try:
+      os.link(opacityfile, stored)
+    except OSError:
+      if not os.path.isfile(stored):
+        cache.atomic_copy(opacityfile, stored)
+    if not os.path.samefile(opacityfile, stored):
+      cache.link(stored, opacityfile)
+    return False
+
+
+def opacity_key(tconfig, Tcall):
+  """
+  Key of the opacity table of a transit configuration: a hash of the
+  line databases, molecules file, temperature grid, wavenumber grid,
+  line-profile settings, the species and pressure layers of the
+  atmospheric file, and the transit executable.  Other arguments (and
+  the file names) do not enter the key, so runs in different
+  directories share the tables.
+
+  Parameters:
+  -----------
+  tconfig: String
+     Transit configuration file.
+  Tcall: String
+     Transit executable.
+
+  Returns:
+  --------
+  key: String
+     Hexadecimal SHA-1 digest.
+  """
+  # Grid and line-profile arguments:
+  grid = ["tlow",  "thigh",  "tempdelt",
+          "wllow", "wlhigh", "wlfct",
+          "wnlow", "wnhigh", "wndelt", "wnfct", "wnosamp",
+          "nwidth", "allowq"]
+
+  # Read the arguments (some, like linedb, may be repeated):
+  args = {}
+  f = open(tconfig, "r")
+  for line in f.readlines():
+    values = line.split()
+    if len(values) > 0:
+      args.setdefault(values[0], []).append(" ".join(values[1:]))
+  f.close()
+
+  # Input files are relative to the transit working directory:
+  path = os.path.dirname(os.path.realpath(tconfig))
+  def digests(arg):
+    return [cache.file_digest(os.path.join(path, name))
+            for name in args.get(arg, [])]
+
+  species, pressure = mat.readatm(os.path.join(path, args["atm"][0]))[0:2]
+  inputs = [(arg, args.get(arg)) for arg in grid]
+  inputs += [("linedb",  digests("linedb")),
+             ("molfile", digests("molfile")),
+             ("species", species), ("pressure", pressure),
+             ("transit", cache.file_digest(Tcall))]
+  return cache.stage_key("opacity", *inputs)
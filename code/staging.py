@@ -0,0 +1,200 @@
+# Copyright (C) 2015-2016 University of Central Florida. All rights reserved.
+# BART is under an open-source, reproducible-research license (see LICENSE).
+
+"""
+    Staging of input files into a run directory.
+
+    Each file is staged with the cheapest safe strategy available: a
+    reflink (copy-on-write clone, on file systems that support it), a
+    hard link, a symbolic link (across file systems), and a full copy
+    only as a fallback.  Small files (below a size threshold) are always
+    copied, which costs nothing and keeps the run independent of later
+    edits of the source.  Files that a later stage may rewrite are only
+    cloned or copied, since writing into a link would modify the source.
+    Every staged file is recorded in a manifest
+    with its strategy, size, modification time, and source (plus the
+    SHA-1 checksum of copied files; linked files are not read), so that
+    the run stays reproducible (see verify).
+
+    Functions
+    ---------
+    reflink:
+          Clone a file (copy-on-write).
+    symlink:
+          Symbolic link to the absolute path of a file.
+    stage:
+          Stage a file into the run directory.
+    record:
+          Add a staged file to the manifest.
+    verify:
+          Check that the sources of linked files did not change.
+"""
+
+import os
+import shutil
+import fcntl
+
+import cache
+
+# Linux ioctl request to clone a file (FICLONE):
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+  """
+  Make dst a copy-on-write clone of src.  Raise IOError if the file
+  system (or operating system) does not support it.
+
+  Parameters:
+  -----------
+  src: String
+     Existing file.
+  dst: String
+     Clone name.
+  """
+  fsrc = open(src, "rb")
+  fdst = open(dst, "wb")
+  try:
+    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+  finally:
+    fsrc.close()
+    fdst.close()
+  shutil.copystat(src, dst)
+
+
+def symlink(src, dst):
+  """
+  Make dst a symbolic link to the absolute path of src.
+  """
+  os.symlink(os.path.abspath(src), dst)
+
+
+def stage(src, dst, manifest=None, threshold=2**20, writable=False):
+  """
+  Stage the file src as dst.  An existing dst is replaced atomically.
+
+  Parameters:
+  -----------
+  src: String
+     Input file.
+  dst: String
+     Staged file (in the run directory).
+  manifest: String
+     If not None, record the staged file in this manifest file.
+  threshold: Integer
+     Files smaller than this (in bytes) are copied.
+  writable: Bool
+     If True, dst may be rewritten later: only clone (reflink) or copy
+     it, so that the source is never modified through a link.
+
+  Returns:
+  --------
+  strategy: String
+     'reflink', 'hardlink', 'symlink', 'copy', or 'in place' (if dst is
+     already src).
+  """
+  if os.path.exists(dst) and os.path.samefile(src, dst):
+    strategy = "in place"
+  else:
+    tmpfile = "{:s}.tmp{:d}".format(dst, os.getpid())
+    strategy = None
+    if os.path.getsize(src) >= threshold:
+      strategies = [("reflink",  reflink),
+                    ("hardlink", os.link),
+                    ("symlink",  symlink)]
+      if writable:
+        strategies = strategies[0:1]
+      for name, link in strategies:
+        if os.path.lexists(tmpfile):
+          os.remove(tmpfile)
+        try:
+          link(src, tmpfile)
+          strategy = name
+          break
+        except (OSError, IOError):
+          pass
+    if strategy is None:
+      if os.path.lexists(tmpfile):
+        os.remove(tmpfile)
+      shutil.copy2(src, tmpfile)
+      strategy = "copy"
+    os.rename(tmpfile, dst)
+
+  if manifest is not None:
+    record(manifest, src, dst, strategy)
+  return strategy
+
+
+def record(manifest, src, dst, strategy):
+  """
+  Add a staged file to the manifest: a tab-separated line with the
+  strategy, SHA-1 checksum, size, modification time, staged file, and
+  source file.  Only copies are checksummed ('-' otherwise): a link
+  (or clone) is recorded without reading it, which would cost as much
+  as a copy for large files.
+
+  Parameters:
+  -----------
+  manifest: String
+     Manifest file (created if needed).
+  src: String
+     Source file.
+  dst: String
+     Staged file.
+  strategy: String
+     Staging strategy (see stage).
+  """
+  sha1 = "-"
+  if strategy == "copy":
+    sha1 = cache.file_hash(dst)
+  stat = os.stat(dst)
+  new = not os.path.isfile(manifest)
+  f = open(manifest, "a")
+  if new:
+    f.write("# strategy\tsha1\tsize\tmtime\tstaged file\tsource\n")
+  f.write("{:s}\t{:s}\t{:d}\t{:.6f}\t{:s}\t{:s}\n".format(strategy, sha1,
+          stat.st_size, stat.st_mtime, os.path.abspath(dst),
+          os.path.realpath(src)))
+  f.close()
+
+
+def verify(manifest):
+  """
+  Check that the hard- and symbolically-linked files of a manifest did
+  not change since they were staged (i.e., that nobody modified their
+  source), by their size and modification time.  Copies and clones are
+  independent of their source, and files used in place may be rewritten
+  by BART, they are not checked.
+
+  Parameters:
+  -----------
+  manifest: String
+     Manifest file.
+
+  Returns:
+  --------
+  changed: List of strings
+     Linked files that are missing or that changed (for files staged
+     more than once, the last record is checked).
+  """
+  records = {}
+  f = open(manifest, "r")
+  for line in f.readlines():
+    if line.startswith("#"):
+      continue
+    strategy, sha1, size, mtime, dst, src = line.rstrip("\n").split("\t")
+    records[dst] = strategy, int(size), float(mtime)
+  f.close()
+
+  changed = []
+  for dst in sorted(records.keys()):
+    strategy, size, mtime = records[dst]
+    if strategy not in ["hardlink", "symlink"]:
+      continue
+    if not os.path.isfile(dst):
+      changed.append(dst)
+      continue
+    stat = os.stat(dst)
+    if stat.st_size != size or abs(stat.st_mtime - mtime) > 1e-6:
+      changed.append(dst)
+  return changed
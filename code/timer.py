@@ -0,0 +1,154 @@
+# Copyright (C) 2015-2016 University of Central Florida. All rights reserved.
+# BART is under an open-source, reproducible-research license (see LICENSE).
+
+"""
+    Low-overhead wall-clock instrumentation of the BART forward-model loop.
+
+    Each call to Timer.tick() records the time elapsed since the previous
+    tick into a log-spaced histogram of the given stage.  Timer.count()
+    increments named counters (e.g., number of rejected samples).
+
+    Classes
+    -------
+    Timer:
+          Per-stage timing histograms and event counters.
+
+    Functions
+    ---------
+    summary:
+          Print a summary of the timing files of a run.
+"""
+
+import time
+import math
+import numpy as np
+
+
+class Timer:
+  """
+  Per-stage timing histograms and event counters.
+
+  Parameters:
+  -----------
+  stages: List of strings
+     Names of the timed stages.
+  counters: List of strings
+     Names of the event counters.
+  enabled: Boolean
+     If False, tick() and count() do nothing.
+  nbins: Integer
+     Number of log-spaced histogram bins between tmin and tmax.
+  tmin: Float
+     Lower edge of the histogram (in seconds).
+  tmax: Float
+     Upper edge of the histogram (in seconds).
+
+  Notes:
+  ------
+  The histograms have two extra bins, the first one counts the ticks
+  shorter than tmin, the last one the ticks longer than tmax.
+
+  Example:
+  --------
+  >>> import timer
+  >>> t = timer.Timer(["wait", "compute"], ["rejected"])
+  >>> t.reset()
+  >>> t.tick("wait")
+  >>> t.tick("compute")
+  >>> t.count("rejected")
+  >>> t.dump("timing.npz")
+  """
+  def __init__(self, stages, counters=[], enabled=True, nbins=90,
+               tmin=1e-6, tmax=1e3):
+    self.enabled  = enabled
+    self.stages   = list(stages)
+    self.istage   = dict([(stage, i) for i, stage in enumerate(self.stages)])
+    self.counters = dict([(name, 0) for name in counters])
+    self.nbins    = nbins
+    self.logtmin  = math.log10(tmin)
+    self.dlogt    = (math.log10(tmax) - self.logtmin) / nbins
+    self.edges    = np.logspace(math.log10(tmin), math.log10(tmax), nbins+1)
+    self.hist     = np.zeros((len(self.stages), nbins+2), int)
+    self.total    = np.zeros(len(self.stages), np.double)
+    self.start    = time.time()
+    self.last     = self.start
+
+  def reset(self):
+    """
+    Set the starting point of the next tick.
+    """
+    self.last = time.time()
+
+  def tick(self, stage):
+    """
+    Record the time elapsed since the last tick (or reset) into stage.
+    """
+    if not self.enabled:
+      return
+    now = time.time()
+    dt  = now - self.last
+    self.last = now
+    i = self.istage[stage]
+    self.total[i] += dt
+    if dt > 0.0:
+      ibin = int((math.log10(dt) - self.logtmin) / self.dlogt) + 1
+      ibin = min(max(ibin, 0), self.nbins+1)
+    else:
+      ibin = 0
+    self.hist[i, ibin] += 1
+
+  def count(self, name, n=1):
+    """
+    Increment the counter name by n.
+    """
+    if self.enabled:
+      self.counters[name] += n
+
+  def dump(self, filename):
+    """
+    Save the histograms, total times, and counters into a .npz file.
+    """
+    if not self.enabled:
+      return
+    names = sorted(self.counters.keys())
+    np.savez(filename, stages=self.stages, edges=self.edges, hist=self.hist,
+             total=self.total, elapsed=time.time()-self.start,
+             counter_names=names,
+             counters=np.asarray([self.counters[n] for n in names], int))
+
+
+def summary(files):
+  """
+  Print the fraction of wall time, number of calls, and median time per
+  stage, summed over a set of Timer dump files (e.g., from all ranks).
+
+  Parameters:
+  -----------
+  files: List of strings
+     Timer dump files.
+  """
+  hist, total, counters = 0, 0.0, {}
+  elapsed = 0.0
+  for tfile in files:
+    with np.load(tfile) as data:
+      stages, edges = data["stages"], data["edges"]
+      hist    = hist  + data["hist"]
+      total   = total + data["total"]
+      elapsed += float(data["elapsed"])
+      for name, n in zip(data["counter_names"], data["counters"]):
+        counters[name] = counters.get(name, 0) + int(n)
+
+  # Bin centers (including under- and over-flow bins):
+  centers = np.concatenate(([edges[0]], np.sqrt(edges[1:]*edges[:-1]),
+                            [edges[-1]]))
+  print("Stage            Calls   Total (s)  Fraction  Median (s)")
+  for i in np.arange(len(stages)):
+    ncalls = np.sum(hist[i])
+    if ncalls == 0:
+      median = 0.0
+    else:
+      median = centers[np.searchsorted(np.cumsum(hist[i]), 0.5*ncalls)]
+    print("{:14s} {:7d}  {:10.3f}  {:8.4f}  {:10.3e}".format(stages[i],
+          ncalls, total[i], total[i]/elapsed, median))
+  for name in sorted(counters.keys()):
+    print("{:14s} {:7d}".format(name, counters[name]))
@@ -1,10 +1,14 @@
 # Copyright (C) 2015-2016 University of Central Florida. All rights reserved.
 # BART is under an open-source, reproducible-research license (see LICENSE).
 
+import os
 import numpy as np
 import kurucz_inten      as ki
 import scipy.constants   as sc
 import scipy.interpolate as si
+import scipy.sparse      as ss
+
+import cache
 
 """
 WINE: Waveband INtegrated Emission module
@@ -50,14 +54,19 @@ def readfilter(filt):
   while lines[0].startswith("#") or not lines[0].strip():
     comment = lines.pop(0)
 
-  # Allocate arrays for the wavelength and response:
+  # Parse all values at once (requires the same number of columns in
+  # every line), else line by line:
   nlines = len(lines)
-  wavel  = np.zeros(nlines, np.double) # filter's wavelengths  (in microns)
-  transm = np.zeros(nlines, np.double) # filter's pass bands
+  ncols  = len(lines[0].split())
+  values = np.fromstring(''.join(lines), np.double, sep=" ")
+  if len(values) == nlines*ncols:
+    values = np.reshape(values, (nlines, ncols))
+  else:
+    values = np.array([line.split()[0:2] for line in lines], np.double)
 
-  # Read the data and store in reverse order:
-  for i in np.arange(nlines):
-    wavel[nlines-1-i], transm[nlines-1-i] = lines[i].strip().split()[0:2]
+  # Wavelength (in microns) and response, in reverse order:
+  wavel  = values[::-1, 0].copy()
+  transm = values[::-1, 1].copy()
 
   m2cm  = 1e-4 # Microns to cm conversion factor
   # Get wavenumber in cm-1:
@@ -66,10 +75,11 @@ def readfilter(filt):
   return waven, transm
 
 
-def readkurucz(kfile, temperature, logg):
+def readkurucz(kfile, temperature, logg, interpolate=False):
   """
   Load a the Kurucz stellar spectrum with parameters closest to requested
-  temperature and log(g).
+  temperature and log(g), or interpolate the grid of models at the
+  requested parameters.
 
   Parameters:
   -----------
@@ -79,6 +89,9 @@ def readkurucz(kfile, temperature, logg):
      Surface temperature in K.
   logg: Scalar
      log10 of surface gravity (g in cgs units).
+  interpolate: Boolean
+     If True, interpolate the models (cubic in temperature and log(g))
+     instead of taking the nearest model.
 
   Returns:
   --------
@@ -87,29 +100,34 @@ def readkurucz(kfile, temperature, logg):
   starwn: 1D ndarray
      Array with wavenumber values in cm^-1.
   tmodel: Scalar
-     Surface temperature of the model in K.
+     Surface temperature of the model in K (temperature if interpolate).
   gmodel: Scalar
-     log10 of the surface gravity for the model (g in cgs units).
+     log10 of the surface gravity for the model (g in cgs units, logg
+     if interpolate).
 
   Modification History:
   ---------------------
   2013-01-23  patricio  Initial implementation.   pcubillos@fulbrightmail.org
   """
 
-  inten, freq, grav, temp, nainten, head = ki.read(kfile, freq=True)
+  inten, freq, grav, temp, nainten, head = ki.load(kfile, freq=True)
 
   # Wavenumber in cm^-1
   starwn = freq / sc.c * 1e-2  
   
-  # Find the model index with the nearest temp and log(g):
-  # Nearest sampled temperature:
-  tmodel = temp[np.argmin(np.abs(temp-temperature))]
-  # Nearest sampled log(g):
-  gmodel = grav[np.argmin(np.abs(grav-logg))]
-  imodel = np.where((temp == tmodel) & (grav > gmodel))[0][0]
-
-  # Get the stellar flux:
-  starfl = inten[imodel]  # W m^-2 sr^-1 Hz^-1
+  if interpolate:
+    tmodel, gmodel = temperature, logg
+    starfl = ki.interp(inten, grav, temp, logg, temperature)
+  else:
+    # Find the model index with the nearest temp and log(g):
+    # Nearest sampled temperature:
+    tmodel = temp[np.argmin(np.abs(temp-temperature))]
+    # Nearest sampled log(g):
+    gmodel = grav[np.argmin(np.abs(grav-logg))]
+    imodel = np.where((temp == tmodel) & (grav > gmodel))[0][0]
+
+    # Get the stellar flux:
+    starfl = inten[imodel]  # W m^-2 sr^-1 Hz^-1
 
   # Convert F_freq to F_wavenumber (Hz-1 --> m):
   #   multiply by c.
@@ -174,6 +192,119 @@ def resample(specwn, filterwn, filtertr, starwn, starfl):
   return nifilter, istarfl, wnindices
 
 
+def filterband(filt, specwn):
+  """
+  Read a filter file and interpolate its transmission onto the
+  wavenumber samples of specwn within the filter range, through a
+  content-addressed cache.  The cache entries (in the BART cache
+  directory, see cache.py) are keyed by the SHA-1 digests of the filter
+  file (see cache.file_digest) and of specwn, so the filters are
+  interpolated only once per wavenumber sampling.  If the file caches
+  are disabled (see cache.enable), the filter is always interpolated.
+
+  Parameters:
+  -----------
+  filt: String
+     Filter file name.
+  specwn: 1D ndarray
+     A wavenumber sampling array (in cm-1).
+
+  Returns:
+  --------
+  ifilter: 1D ndarray
+     The interpolated filter transmission curve.
+  wnindices: 1D integer ndarray
+     The indices of specwn where the filter was interpolated into.
+  norm: Float
+     Integral of ifilter over specwn[wnindices] (ifilter/norm
+     integrates to 1.0).
+  wnrange: 1D ndarray
+     The filter wavenumber boundaries (in cm-1).
+  meanwn: Float
+     The transmission-weighted mean wavenumber of the filter (in cm-1).
+  """
+  cdir = cache.file_cache_dir()
+  if cdir is not None:
+    cfile = os.path.join(cdir, "filter_{:s}_{:s}.npz".format(
+                         cache.file_digest(filt), cache.array_hash(specwn)))
+    if os.path.isfile(cfile):
+      with np.load(cfile) as band:
+        return (band["ifilter"], band["wnindices"], float(band["norm"]),
+                band["wnrange"], float(band["meanwn"]))
+
+  filterwn, filtertr = readfilter(filt)
+  # Indices in the spectrum wavenumber array included in the band
+  # wavenumber range:
+  wnindices = np.where((specwn < filterwn[-1]) & (filterwn[0] < specwn))[0]
+  # Evaluate over the spectrum wavenumber array:
+  ifilter = si.interp1d(filterwn, filtertr)(specwn[wnindices])
+  norm    = np.trapz(ifilter, specwn[wnindices])
+  wnrange = np.array([filterwn[0], filterwn[-1]])
+  meanwn  = np.sum(filterwn*filtertr)/sum(filtertr)
+
+  if cdir is not None:
+    cache.atomic_savez(cfile, ifilter=ifilter, wnindices=wnindices,
+                       norm=norm, wnrange=wnrange, meanwn=meanwn)
+  return ifilter, wnindices, norm, wnrange, meanwn
+
+
+def bandsetup(specwn, ffile, kfile, temperature, logg, interpolate=False):
+  """
+  Read the stellar model and the filters, and resample them onto the
+  wavenumber sampling of the spectrum.
+
+  Parameters:
+  -----------
+  specwn: 1D ndarray
+     A wavenumber sampling array (in cm-1).
+  ffile: List of strings
+     Filter file names.
+  kfile: String
+     Path to the kurucz file.
+  temperature: Scalar
+     Stellar surface temperature in K.
+  logg: Scalar
+     log10 of the stellar surface gravity (g in cgs units).
+  interpolate: Boolean
+     If True, interpolate the Kurucz models (see readkurucz).
+
+  Returns:
+  --------
+  nifilter: List of 1D ndarrays
+     The normalized interpolated filter transmission curves.
+  istarfl: List of 1D ndarrays
+     The interpolated stellar flux for each filter.
+  wnindices: List of 1D ndarrays
+     The indices of specwn where each filter was interpolated into.
+
+  Notes:
+  ------
+  Raises a ValueError if specwn does not cover a filter.
+  """
+  # Get stellar model:
+  starfl, starwn, tmodel, gmodel = readkurucz(kfile, temperature, logg,
+                                              interpolate)
+  sinterp = si.interp1d(starwn, starfl)
+  nifilter  = [] # Normalized interpolated filter
+  istarfl   = [] # interpolated stellar flux
+  wnindices = [] # wavenumber indices used in interpolation
+  for i in np.arange(len(ffile)):
+    # Read and resample filter:
+    ifilter, wnind, norm, wnrange, meanwn = filterband(ffile[i], specwn)
+    # Check that filter boundaries lie within the spectrum wn range:
+    if wnrange[0] < specwn[0] or wnrange[1] > specwn[-1]:
+      raise ValueError("Wavenumber array ({:.2f} - {:.2f} cm-1) does not "
+                       "cover the filter[{:d}] wavenumber range ({:.2f} - "
+                       "{:.2f} cm-1).".format(specwn[0], specwn[-1], i,
+                                              wnrange[0], wnrange[1]))
+    # Resample stellar spectrum:
+    nifilter.append(ifilter/norm)
+    istarfl.append(sinterp(specwn[wnind]))
+    wnindices.append(wnind)
+
+  return nifilter, istarfl, wnindices
+
+
 def bandintegrate(spectrum, specwn, nifilter, wnindices):
   """
   Integrate a spectrum over the band transmission.
@@ -197,3 +328,57 @@ def bandintegrate(spectrum, specwn, nifilter, wnindices):
   # fratio = Fplanet / Fstar * rprs**2.0
 
   return np.trapz(spectrum*nifilter, specwn[wnindices])
+
+
+def bandoperator(specwn, nifilter, wnindices, istarfl=None, rprs=None):
+  """
+  Build the band-integration operator of a set of filters, such that
+  the band-integrated values of a spectrum are: bandop.dot(spectrum).
+
+  Parameters:
+  -----------
+  specwn: 1D ndarray
+     Wavenumber of spectrum in cm^-1
+  nifilter: List of 1D ndarrays
+     The normalized interpolated filter transmission curves.
+  wnindices: List of 1D ndarrays
+     Indices of specwn where each filter is evaluated.
+  istarfl: List of 1D ndarrays
+     If not None, the interpolated stellar flux for each filter.  The
+     operator then returns the planet-to-star flux ratio (eclipse
+     geometry) scaled by rprs**2.
+  rprs: Float
+     Planet-to-star radius ratio (required if istarfl is not None).
+
+  Returns:
+  --------
+  bandop: 2D sparse CSR matrix
+     Array of shape (nfilters, nwave) with the trapezoidal-integration
+     weights times the filter (and stellar) factors.
+
+  Notes:
+  ------
+  The operator reproduces bandintegrate (np.trapz) to round-off.
+  """
+  nfilters = len(nifilter)
+  rows, cols, weights = [], [], []
+  for i in np.arange(nfilters):
+    wnind = np.asarray(wnindices[i]).flatten()
+    wn    = specwn[wnind]
+    # Trapezoidal-rule weights:
+    dwn = np.ediff1d(wn)
+    trapw = np.zeros(len(wn))
+    trapw[:-1] += 0.5*dwn
+    trapw[1: ] += 0.5*dwn
+    # Filter (and stellar flux) factors:
+    weight = trapw * nifilter[i]
+    if istarfl is not None:
+      weight *= rprs*rprs / istarfl[i]
+    rows.append(np.tile(i, len(wn)))
+    cols.append(wnind)
+    weights.append(weight)
+
+  rows    = np.concatenate(rows)
+  cols    = np.concatenate(cols)
+  weights = np.concatenate(weights)
+  return ss.csr_matrix((weights, (rows, cols)), shape=(nfilters, len(specwn)))
@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+
+# Copyright (C) 2015-2016 University of Central Florida. All rights reserved.
+# BART is under an open-source, reproducible-research license (see LICENSE).
+
+"""
+Benchmark of the atmospheric-file reader and writer (atmio), comparing
+the bulk parser and formatter against the previous per-line and
+per-value loops on a synthetic atmosphere, and checking that both give
+the same values and byte-identical files.
+
+Usage:
+  ./bench_atmio.py [nlayers] [nspecies]
+"""
+
+import sys, os, timeit, tempfile, shutil
+import numpy as np
+
+scriptsdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(scriptsdir + "/../code")
+import atmio   as aio
+import makeatm as mat
+
+
+def legacy_write(atmfile, header, rad, pressure, temperature, abundances):
+  """
+  Atmospheric-file writer as implemented by makeatm.makeRadius before
+  atmio (reference for the benchmark).
+  """
+  fout = open(atmfile, 'w')
+  fout.writelines(header)
+  for i in np.arange(len(abundances)):
+    radi  = str('%10.3f'%rad[i])
+    presi = str('%10.4e'%pressure[i])
+    tempi = str('%7.2f'%temperature[i])
+    fout.write(radi.ljust(10) + ' ')
+    fout.write(presi.ljust(10) + ' ')
+    fout.write(tempi.ljust(7) + ' ')
+    for j in np.arange(abundances.shape[1]):
+      fout.write('%1.4e'%abundances[i][j] + ' ')
+    fout.write('\n')
+  fout.close()
+
+
+def new_write(atmfile, header, rad, pressure, temperature, abundances):
+  """
+  Atmospheric-file writer with atmio.
+  """
+  fout = open(atmfile, 'w')
+  fout.writelines(header)
+  aio.write_layers(fout, rad, pressure, temperature, abundances)
+  fout.close()
+
+
+def legacy_read(atmfile):
+  """
+  Atmospheric-file reader as implemented by makeatm.readatm before
+  atmio (reference for the benchmark, files with radius).
+  """
+  f = open(atmfile, 'r')
+  lines = np.asarray(f.readlines())
+  f.close()
+  imol = np.where(lines == "#SPECIES\n")[0][0] + 1
+  molecules = lines[imol].split()
+  start = np.where(lines == "#TEADATA\n")[0][0] + 2
+  ndata = len(lines) - start
+  nabun = len(lines[start].split()) - 3
+  pressure   = np.zeros(ndata, np.double)
+  temp       = np.zeros(ndata, np.double)
+  abundances = np.zeros((ndata, nabun), np.double)
+  for i in np.arange(ndata):
+    line = lines[start+i].strip().split()
+    pressure[i]   = line[1]
+    temp[i]       = line[2]
+    abundances[i] = line[3:]
+  return molecules, pressure, temp, abundances
+
+
+def main():
+  nlayers  = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+  nspecies = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+  # Synthetic atmosphere:
+  np.random.seed(0)
+  species     = ["M{:02d}".format(i) for i in np.arange(nspecies)]
+  pressure    = np.logspace(2, -5, nlayers)
+  temperature = 1000.0 + 500.0*np.random.rand(nlayers)
+  abundances  = 10**np.random.uniform(-12, 0, (nlayers, nspecies))
+  rad         = np.linspace(7e4, 8e4, nlayers)
+  header = ["#SPECIES\n", " ".join(species) + "\n", "\n", "#TEADATA\n",
+            "#Radius    Pressure   Temp    " +
+            "".join([mol.ljust(14) for mol in species]) + "\n"]
+
+  tmpdir = tempfile.mkdtemp()
+  before = os.path.join(tmpdir, "before.atm")
+  after  = os.path.join(tmpdir, "after.atm")
+  legacy_write(before, header, rad, pressure, temperature, abundances)
+  new_write   (after,  header, rad, pressure, temperature, abundances)
+  if open(before).read() != open(after).read():
+    print("Warning: the writers give different files.")
+  ref = legacy_read(before)
+  new = mat.readatm(before)
+  if ref[0] != new[0] or not all([np.array_equal(r, n)
+                                  for r, n in zip(ref[1:], new[1:])]):
+    print("Warning: the readers give different values.")
+
+  print("Atmosphere: {:d} layers, {:d} species".format(nlayers, nspecies))
+  for name, func, args in [
+      ("write before", legacy_write,
+       (before, header, rad, pressure, temperature, abundances)),
+      ("write after",  new_write,
+       (after,  header, rad, pressure, temperature, abundances)),
+      ("read before",  legacy_read, (before,)),
+      ("read after",   mat.readatm, (before,))]:
+    times = timeit.repeat(lambda: func(*args), repeat=5, number=3)
+    print("{:12s}: {:8.2f} ms per call".format(name, 1e3*np.amin(times)/3))
+  shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+
+# Copyright (C) 2015-2016 University of Central Florida. All rights reserved.
+# BART is under an open-source, reproducible-research license (see LICENSE).
+
+"""
+Microbenchmark of the BARTfunc input converter (temperature and abundance
+profiles), comparing the preallocated in-place Model.convert against the
+previous implementation (PT_generator, temporaries, and a flattened copy
+of the profiles per model).
+
+Usage:
+  ./bench_converter.py MCMC_BART.cfg [nbatch] [niter]
+"""
+
+import sys, os, timeit
+import numpy as np
+
+scriptsdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(scriptsdir + "/../code")
+import BARTfunc as bf
+import PT       as pt
+
+
+def legacy_convert(model, params):
+  """
+  Input converter as evaluated by BARTfunc before the preallocated
+  workspace (reference for the benchmark).
+  """
+  nmodels   = len(params)
+  profiles  = model.profiles [:nmodels]
+  tprofiles = model.tprofiles[:nmodels]
+  aprofiles = model.aprofiles[:nmodels]
+  iH2, iHe  = [model.iH2], [model.iHe]
+  ratio     = model.ratio
+  imol      = np.atleast_1d(np.arange(aprofiles.shape[1])[model.imol])
+  imetals   = np.atleast_1d(np.arange(aprofiles.shape[1])[model.imetals])
+  PTargs    = list(model.PTargs) or None
+  for k in np.arange(nmodels):
+    tprofiles[k] = pt.PT_generator(model.pressure, params[k, 0:model.nPT],
+                                   model.PTfunc,   PTargs)[::-1]
+  reject = (np.any(tprofiles < model.Tmin, axis=1) |
+            np.any(tprofiles > model.Tmax, axis=1))
+  aprofiles[:, imol] = (model.abundances[:, imol].T *
+                        10.0**params[:, model.imolpar, np.newaxis])
+  q = 1.0 - np.sum(aprofiles[:, imetals], axis=1)
+  reject |= np.any(q < 0.0, axis=1)
+  aprofiles[:, iH2] = (ratio * q / (1.0 + ratio))[:, np.newaxis]
+  aprofiles[:, iHe] = (        q / (1.0 + ratio))[:, np.newaxis]
+  for k in np.arange(nmodels):
+    profiles[k].flatten()
+  return reject
+
+
+def main():
+  cfile  = sys.argv[1]
+  nbatch = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+  niter  = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+
+  args  = bf.parse_args(["-c", cfile])
+  model = bf.Model(args, nbatch)
+  params = np.tile(args.params, (nbatch, 1))
+
+  # Check that both converters give the same profiles:
+  legacy_convert(model, params)
+  reference = np.copy(model.profiles)
+  model.convert(params)
+  if not np.array_equal(reference, model.profiles):
+    print("Warning: the converters give different profiles.")
+
+  def PTonly(model, params):
+    pt.PT_generator_batch(model.pressure, params[:, 0:model.nPT],
+                          model.PTfunc, model.PTargs)
+
+  for name, func in [("before",  legacy_convert),
+                     ("after",   bf.Model.convert),
+                     ("PT only", PTonly)]:
+    times = timeit.repeat(lambda: func(model, params), repeat=20, number=niter)
+    print("{:7s}: {:8.2f} us per iteration ({:d} models per iteration)".
+          format(name, 1e6*np.amin(times)/niter, nbatch))
+  model.free()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,132 @@
+#! /usr/bin/env python
+
+# Copyright (C) 2015-2016 University of Central Florida. All rights reserved.
+# BART is under an open-source, reproducible-research license (see LICENSE).
+
+"""
+Benchmark of the Kurucz-grid and filter-file parsers, comparing the bulk
+NumPy parsers (kurucz_inten.read, wine.readfilter) against the previous
+per-field loops, and checking that both give identical arrays.
+
+Usage:
+  ./bench_parser.py [kurucz_file] [filter_file ...]
+"""
+
+import sys, os, timeit
+import numpy as np
+import scipy.constants as sc
+
+scriptsdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(scriptsdir + "/../code")
+import kurucz_inten as ki
+import wine         as w
+
+
+def legacy_read(filename, freq=False):
+  """
+  Kurucz-grid parser as implemented before the bulk parser (reference
+  for the benchmark).
+  """
+  f = open(filename, 'r')
+  text = f.read()
+  f.close()
+  text = text.replace('\r','\n')
+  filetxt = text.split('\n')
+
+  head      = []
+  temp      = np.zeros(len(filetxt))
+  grav      = np.zeros(len(filetxt))-1
+  header    = np.zeros(len(filetxt), int)
+  startwave = 0
+  for i in np.arange(len(filetxt)):
+    if filetxt[i].startswith("TEFF"):
+      head.append(filetxt[i])
+      temp[i]   = float(filetxt[i][ 5:12])
+      grav[i]   = float(filetxt[i][22:29])
+      header[i] = i
+    elif filetxt[i].endswith("END"):
+      startwave = i + 1
+
+  temp   = temp  [np.where(temp   !=  0)]
+  grav   = grav  [np.where(grav   != -1)]
+  header = header[np.where(header !=  0)]
+  nmod   = header.size
+  nline  = (header[2] - header[1] - 1) / 2
+
+  wave = np.zeros(header[0]*len(filetxt[startwave])/10)
+  k = 0
+  string = ''.join(filetxt[startwave:header[0]])
+  for j in np.arange(0, len(string), 10):
+    wave[k] = float(string[j:j+10])
+    k += 1
+  wave = wave[np.where(wave != 0)] * 1e-9
+  nwavl = wave.size
+
+  inten   = np.zeros((nmod, nwavl))
+  nainten = np.zeros((nmod, nwavl))
+  for i in range(0, nmod):
+    k = 0
+    string1 = ''.join(filetxt[header[i]+1      :header[i]+nline+1  ])
+    string2 = ''.join(filetxt[header[i]+nline+1:header[i]+2*nline+1])
+    for j in range(0,len(string1),10):
+      inten[i,k]   = float(string1[j:j+10])
+      nainten[i,k] = float(string2[j:j+10])
+      k += 1
+
+  inten   *= 4.0 * 1e-3
+  nainten *= 4.0 * 1e-3
+  if freq:
+    wave    = np.flipud(sc.c / wave)
+    inten   = np.fliplr(inten)
+    nainten = np.fliplr(nainten)
+  return inten, wave, grav, temp, nainten, head
+
+
+def legacy_readfilter(filt):
+  """
+  Filter-file parser as implemented before the bulk parser (reference
+  for the benchmark).
+  """
+  data = open(filt, "r")
+  lines = data.readlines()
+  data.close()
+  while lines[0].startswith("#") or not lines[0].strip():
+    comment = lines.pop(0)
+
+  nlines = len(lines)
+  wavel  = np.zeros(nlines, np.double)
+  transm = np.zeros(nlines, np.double)
+  for i in np.arange(nlines):
+    wavel[nlines-1-i], transm[nlines-1-i] = lines[i].strip().split()[0:2]
+  waven = 1.0 / (wavel*1e-4)
+  return waven, transm
+
+
+def compare(name, legacy, new, args, number):
+  """
+  Check that legacy(*args) and new(*args) give identical outputs, and
+  print the time per call of each one.
+  """
+  before, after = legacy(*args), new(*args)
+  same = all([np.array_equal(b, a) for b, a in zip(before, after)])
+  print("{:s}{:s}".format(name, "" if same else
+                          "  (Warning: the parsers give different outputs)"))
+  for label, func in [("before", legacy), ("after", new)]:
+    times = timeit.repeat(lambda: func(*args), repeat=3, number=number)
+    print("  {:6s}: {:10.3f} ms per call".format(label,
+                                                1e3*np.amin(times)/number))
+
+
+def main():
+  kfile   = sys.argv[1] if len(sys.argv) > 1 else "fp00k2odfnew.pck"
+  filters = sys.argv[2:]
+
+  compare("Kurucz grid: {:s}".format(kfile), legacy_read, ki.read,
+          (kfile,), 1)
+  for filt in filters:
+    compare("Filter: {:s}".format(filt), legacy_readfilter, w.readfilter,
+            (filt,), 50)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,71 @@
+# Copyright (C) 2015-2016 University of Central Florida. All rights reserved.
+# BART is under an open-source, reproducible-research license (see LICENSE).
+
+"""
+Regression tests of bestFit.PT_quantiles.
+
+Usage:
+  python -m pytest tests/test_bestFit.py
+"""
+
+import os, sys, signal
+import numpy as np
+
+testdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(testdir + "/../code")
+import matplotlib
+matplotlib.use("Agg")
+import PT      as pt
+import bestFit as bf
+
+
+def alarm(signum, frame):
+  raise RuntimeError("PT_quantiles did not finish.")
+
+
+def test_PT_quantiles_few_weighted_samples():
+  """
+  A short (or stuck) chain: few unique samples, each one holding more
+  than 1-q of the weight, with the last one at the maximum temperature.
+  """
+  pressure  = np.logspace(2, -5, 20)
+  samples   = np.linspace(800.0, 1700.0, 10)[:,np.newaxis]
+  weights   = np.tile(5.0, 10)
+  quantiles = [0.025, 0.16, 0.5, 0.84, 0.975]
+
+  signal.signal(signal.SIGALRM, alarm)
+  signal.alarm(30)
+  try:
+    PTq = bf.PT_quantiles(pressure, samples, weights, np.array([1000.0]),
+                          np.array([0]), pt.PT_iso, None, quantiles)
+  finally:
+    signal.alarm(0)
+
+  # The weighted quantiles of the discrete distribution, to within one
+  # bin width of the full temperature range:
+  expected = [800.0, 900.0, 1200.0, 1600.0, 1700.0]
+  width = (1700.0 - 800.0) / 1000
+  assert np.shape(PTq) == (len(quantiles), len(pressure))
+  for i in np.arange(len(quantiles)):
+    assert np.all(np.abs(PTq[i] - expected[i]) <= width)
+
+
+def test_PT_quantiles_single_sample():
+  """
+  A chain stuck at a single sample.
+  """
+  pressure = np.logspace(2, -5, 10)
+  signal.signal(signal.SIGALRM, alarm)
+  signal.alarm(30)
+  try:
+    PTq = bf.PT_quantiles(pressure, np.array([[1200.0]]), np.array([50.0]),
+                          np.array([1000.0]), np.array([0]), pt.PT_iso, None,
+                          [0.16, 0.5, 0.84])
+  finally:
+    signal.alarm(0)
+  assert np.all(np.isfinite(PTq))
+
+
+if __name__ == "__main__":
+  test_PT_quantiles_few_weighted_samples()
+  test_PT_quantiles_single_sample()